@@ -0,0 +1,37 @@
+import json
+import os
+
+# Minimal project used by benchmarks/run.py. The run configuration (Snoopy
+# settings, output directory...) is passed in by the runner through
+# SNOOPY_BENCHMARK_CONFIG.
+
+SECRET_KEY = 'snoopy-benchmarks'
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+
+INSTALLED_APPS = [
+    'snoopy',
+    'benchproject',
+]
+
+# MIDDLEWARE_CLASSES for Django < 1.10
+MIDDLEWARE = MIDDLEWARE_CLASSES = []
+
+ROOT_URLCONF = 'benchproject.urls'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+LOGGING_CONFIG = None
+
+_config = json.loads(os.environ.get('SNOOPY_BENCHMARK_CONFIG', '{}'))
+
+if _config.get('middleware'):
+    MIDDLEWARE = MIDDLEWARE_CLASSES = ['snoopy.middleware.SnoopyProfilerMiddleware']
+
+for _name, _value in _config.get('settings', {}).items():
+    globals()[_name] = _value
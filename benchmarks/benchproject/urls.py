@@ -0,0 +1,14 @@
+try:
+    from django.urls import re_path as url
+except ImportError:
+    # Django < 2.0
+    from django.conf.urls import url
+
+from benchproject import views
+
+
+urlpatterns = [
+    url(r'^orm/$', views.orm, name='orm'),
+    url(r'^cpu/$', views.cpu, name='cpu'),
+    url(r'^deep/$', views.deep, name='deep'),
+]
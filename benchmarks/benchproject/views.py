@@ -0,0 +1,61 @@
+import json
+
+from django.db.models import Count, Sum
+from django.http import HttpResponse
+
+from benchproject.models import Author, Book
+
+
+AUTHOR_COUNT = 20
+BOOKS_PER_AUTHOR = 5
+
+
+def create_data():
+    for author_index in range(AUTHOR_COUNT):
+        author = Author.objects.create(name='Author %d' % author_index)
+        for book_index in range(BOOKS_PER_AUTHOR):
+            Book.objects.create(
+                title='Book %d-%d' % (author_index, book_index),
+                pages=100 + book_index * 10,
+                author=author)
+
+
+def orm(request):
+    # Lots of small queries: a query per book for its author (N+1), a query
+    # per author for its books, and a couple of aggregates.
+    titles = []
+    for book in Book.objects.all()[:50]:
+        titles.append('%s by %s' % (book.title, book.author.name))
+    pages = {}
+    for author in Author.objects.all():
+        pages[author.name] = sum(book.pages for book in author.books.all())
+    stats = Book.objects.aggregate(total_pages=Sum('pages'))
+    stats['authors'] = Author.objects.annotate(book_count=Count('books')).filter(book_count__gt=0).count()
+    return HttpResponse(json.dumps({'titles': len(titles), 'pages': pages, 'stats': stats}),
+                        content_type='application/json')
+
+
+def cpu(request):
+    # Pure Python work, few function calls
+    total = 0
+    for number in range(20000):
+        total += (number * number) % 7
+    words = sorted(str(number * 7919 % 10007) for number in range(2000))
+    return HttpResponse(json.dumps({'total': total, 'first': words[0]}), content_type='application/json')
+
+
+def fan_out(depth, width):
+    if depth == 0:
+        return 1
+    return sum(fan_out(depth - 1, width) for _ in range(width)) + 1
+
+
+def recurse(depth):
+    if depth == 0:
+        return fan_out(6, 3)
+    return recurse(depth - 1) + 1
+
+
+def deep(request):
+    # Deep and wide call tree: a 40 frame deep stack, then ~1000 tiny calls
+    return HttpResponse(json.dumps({'calls': recurse(40)}), content_type='application/json')
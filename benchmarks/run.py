@@ -0,0 +1,359 @@
+"""
+Measures the overhead of the Snoopy middleware in each collection mode and
+with each output class.
+
+Every configuration runs in its own process against the project in
+`benchproject` (SQLite in memory), so settings and peak memory don't leak
+from one run to the next. For each view, it reports throughput, latency
+percentiles and the peak memory of the process, and writes everything to a
+JSON file that can be compared between releases:
+
+    python benchmarks/run.py --output=results.json
+    python benchmarks/run.py --modes=off,builtin_profiler --views=orm --requests=200
+"""
+from optparse import OptionParser
+
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+
+try:
+    import BaseHTTPServer
+except ImportError:
+    import http.server as BaseHTTPServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(1, os.path.dirname(BENCHMARKS_DIR))
+
+# All collection is off unless a mode turns it on
+BASE_SETTINGS = {
+    'SNOOPY_COLLECT_SQL_QUERIES': False,
+    'SNOOPY_USE_CPROFILE': False,
+    'SNOOPY_USE_BUILTIN_PROFILER': False,
+}
+
+MODES = (
+    ('off', None),
+    ('middleware', {}),
+    ('sql_queries', {'SNOOPY_COLLECT_SQL_QUERIES': True}),
+    ('cprofile', {'SNOOPY_USE_CPROFILE': True}),
+    ('builtin_profiler', {'SNOOPY_USE_BUILTIN_PROFILER': True}),
+    ('tail_capture', {
+        'SNOOPY_COLLECT_SQL_QUERIES': True,
+        'SNOOPY_USE_BUILTIN_PROFILER': True,
+        'SNOOPY_TAIL_CAPTURE': True,
+    }),
+    ('all', {
+        'SNOOPY_COLLECT_SQL_QUERIES': True,
+        'SNOOPY_USE_CPROFILE': True,
+        'SNOOPY_USE_BUILTIN_PROFILER': True,
+    }),
+)
+
+OUTPUT_CLASSES = (
+    'snoopy.output.LogOutput',
+    'snoopy.output.SegmentedLogOutput',
+    'snoopy.output.HTTPOutput',
+    'snoopy.output.ElasticsearchOutput',
+    'snoopy.output.ElasticsearchBulkOutput',
+)
+
+# Output classes are compared with this mode, modes with the first output class
+OUTPUT_COMPARISON_MODE = 'sql_queries'
+
+VIEWS = ('orm', 'cpu', 'deep')
+
+
+class SinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Accepts and discards whatever the HTTP / Elasticsearch outputs send.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"errors": false, "items": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def start_sink():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), SinkHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+def build_configs(modes, outputs):
+    configs = []
+    for mode, settings in MODES:
+        if mode in modes:
+            configs.append((mode, settings, outputs[0]))
+    if OUTPUT_COMPARISON_MODE in modes:
+        mode_settings = dict(MODES)[OUTPUT_COMPARISON_MODE]
+        for output_cls in outputs[1:]:
+            configs.append((OUTPUT_COMPARISON_MODE, mode_settings, output_cls))
+    return configs
+
+
+def get_directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of the current process in bytes.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_view(client, path, requests, warmup):
+    from snoopy.batch_analyzer import percentile
+
+    for _ in range(warmup):
+        client.get(path)
+
+    timer = timeit.default_timer
+    latencies = []
+    start_time = timer()
+    for _ in range(requests):
+        request_start_time = timer()
+        response = client.get(path)
+        latencies.append(timer() - request_start_time)
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %d' % (path, response.status_code))
+    elapsed = timer() - start_time
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'throughput': requests / elapsed,
+        'mean': sum(latencies) / requests,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+    }
+
+
+def run_worker(config):
+    """
+    Runs all views for one configuration, in a fresh process.
+    """
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    from django.test import Client
+
+    from benchproject.views import create_data
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    create_data()
+
+    tracemalloc = None
+    if config['trace_memory']:
+        try:
+            import tracemalloc
+            tracemalloc.start()
+        except ImportError:
+            pass
+
+    client = Client()
+    views = {}
+    for view in config['views']:
+        views[view] = run_view(client, '/%s/' % view, config['requests'], config['warmup'])
+
+    # Time left to get buffered / queued records out
+    timer = timeit.default_timer
+    start_time = timer()
+    if config['middleware']:
+        from snoopy.core import Snoopy
+        from snoopy.helpers import custom_import
+        output_cls = custom_import(Snoopy.get_setting('OUTPUT_CLASS'))
+        if Snoopy.get_setting('OUTPUT_ASYNC'):
+            Snoopy.get_output_pipeline(output_cls).shutdown()
+        else:
+            output_cls.close()
+    flush_time = timer() - start_time
+
+    result = {
+        'views': views,
+        'flush_time': flush_time,
+        'peak_rss': get_peak_rss(),
+    }
+    if tracemalloc is not None:
+        result['peak_traced_memory'] = tracemalloc.get_traced_memory()[1]
+    return result
+
+
+def run_config(mode, settings, output_cls, options, sink_url):
+    output_dir = tempfile.mkdtemp(prefix='snoopy-benchmark-')
+    try:
+        run_settings = {}
+        if settings is not None:
+            run_settings.update(BASE_SETTINGS)
+            run_settings.update(settings)
+            run_settings.update({
+                'SNOOPY_OUTPUT_CLASS': output_cls,
+                'SNOOPY_OUTPUT_ASYNC': options.output_async,
+                'SNOOPY_LOG_OUTPUT_DIR': output_dir,
+                'SNOOPY_HTTP_OUTPUT_URL': sink_url,
+                'SNOOPY_ELASTICSEARCH_OUTPUT_URL': sink_url,
+            })
+        config = {
+            'middleware': settings is not None,
+            'settings': run_settings,
+            'views': options.views,
+            'requests': options.requests,
+            'warmup': options.warmup,
+            'trace_memory': options.trace_memory,
+        }
+        environment = dict(os.environ)
+        environment['DJANGO_SETTINGS_MODULE'] = 'benchproject.settings'
+        environment['SNOOPY_BENCHMARK_CONFIG'] = json.dumps(config)
+        result_path = os.path.join(output_dir, 'result.json')
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), '--worker', result_path],
+            env=environment, stdout=open(os.devnull, 'w'))
+        with open(result_path) as result_file:
+            result = json.load(result_file)
+        os.remove(result_path)
+        result['output_bytes'] = get_directory_size(output_dir)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    result.update({
+        'mode': mode,
+        'output_class': output_cls if settings is not None else None,
+    })
+    return result
+
+
+def get_environment():
+    import django
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+    }
+
+
+def add_overhead(results):
+    # Relative to the run without the middleware
+    baseline = None
+    for result in results:
+        if result['mode'] == 'off':
+            baseline = result
+    if baseline is None:
+        return
+    for result in results:
+        for view, stats in result['views'].items():
+            base_stats = baseline['views'].get(view)
+            if base_stats:
+                stats['p50_overhead'] = stats['p50'] / base_stats['p50'] - 1
+
+
+def print_summary(results):
+    line_format = '%-18s %-40s %-6s %10s %10s %10s %8s'
+    print(line_format % ('Mode', 'Output', 'View', 'req/s', 'p50 ms', 'p99 ms', 'p50 +%'))
+    for result in results:
+        for view in sorted(result['views']):
+            stats = result['views'][view]
+            print(line_format % (
+                result['mode'], result['output_class'] or '-', view,
+                '%0.1f' % stats['throughput'],
+                '%0.3f' % (stats['p50'] * 1000),
+                '%0.3f' % (stats['p99'] * 1000),
+                '%0.1f' % (stats.get('p50_overhead', 0.0) * 100)))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--output', default='snoopy-benchmarks.json',
+                      help='where to write the results (default: %default)')
+    parser.add_option('--modes', default=','.join(mode for mode, _ in MODES),
+                      help='comma separated collection modes (default: %default)')
+    parser.add_option('--outputs', default=','.join(OUTPUT_CLASSES),
+                      help='comma separated output classes. The first one is used to compare modes, '
+                           'the others are compared in the %s mode' % OUTPUT_COMPARISON_MODE)
+    parser.add_option('--views', default=','.join(VIEWS),
+                      help='comma separated views (default: %default)')
+    parser.add_option('--requests', type='int', default=500,
+                      help='measured requests per view (default: %default)')
+    parser.add_option('--warmup', type='int', default=20,
+                      help='unmeasured requests per view before measuring (default: %default)')
+    parser.add_option('--async', action='store_true', dest='output_async', default=False,
+                      help='run with SNOOPY_OUTPUT_ASYNC')
+    parser.add_option('--trace-memory', action='store_true', default=False,
+                      help='also report the tracemalloc peak (Python 3 only, slows everything down)')
+    parser.add_option('--worker', help='internal, runs one configuration')
+    options, _ = parser.parse_args()
+
+    if options.worker:
+        config = json.loads(os.environ['SNOOPY_BENCHMARK_CONFIG'])
+        result = run_worker(config)
+        with open(options.worker, 'w') as result_file:
+            json.dump(result, result_file)
+        return
+
+    options.views = options.views.split(',')
+    modes = options.modes.split(',')
+    outputs = options.outputs.split(',')
+
+    sink, sink_url = start_sink()
+    results = []
+    try:
+        for mode, settings, output_cls in build_configs(modes, outputs):
+            sys.stderr.write('Running %s / %s\n' % (mode, output_cls if settings is not None else '-'))
+            results.append(run_config(mode, settings, output_cls, options, sink_url))
+    finally:
+        sink.shutdown()
+
+    add_overhead(results)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchproject.settings')
+    with open(options.output, 'w') as output_file:
+        json.dump({
+            'environment': get_environment(),
+            'requests': options.requests,
+            'warmup': options.warmup,
+            'output_async': options.output_async,
+            'results': results,
+        }, output_file, indent=4, sort_keys=True)
+    print_summary(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+from collections import Counter
+from multiprocessing import Pool, cpu_count
+
+import glob
+import json
+import math
+import os
+
+from snoopy import segments
+from snoopy.histogram import LogHistogram
+from snoopy.segments import SEGMENT_EXTENSIONS, INDEX_FILE_NAME, iter_segment_records
+from snoopy.streaming import stream_record
+
+
+PERCENTILES = (50, 95, 99)
+
+
+def find_capture_files(paths):
+    """
+    Expands directories and glob patterns into a sorted list of capture files:
+    one-request-per-file logs from `LogOutput` and segments from
+    `SegmentedLogOutput`.
+    """
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, name) for name in os.listdir(path)]
+        else:
+            candidates = glob.glob(path)
+        for candidate in candidates:
+            if os.path.isfile(candidate) and os.path.basename(candidate) != INDEX_FILE_NAME:
+                files.add(candidate)
+    return sorted(files)
+
+
+def is_segment_file(path):
+    return any(path.endswith(extension) for extension in SEGMENT_EXTENSIONS.values())
+
+
+def read_request_summary(path):
+    """
+    Reads a single request capture, streaming over the (possibly huge)
+    trace / query arrays and only keeping query counts and time.
+    """
+    totals = {'query_count': 0, 'sql_time': 0.0}
+
+    def add_query(query):
+        totals['query_count'] += 1
+        totals['sql_time'] += query.get('total_query_time') or 0.0
+
+    with open(path) as capture_file:
+        record = stream_record(capture_file, {
+            'queries': add_query,
+            'profiler_traces': lambda entry: None
+        })
+    record['query_count'] = totals['query_count']
+    record['sql_time'] = totals['sql_time']
+    return record
+
+
+def summarize_record(record):
+    queries = record.get('queries') or []
+    if 'query_count' not in record:
+        record['query_count'] = len(queries)
+        record['sql_time'] = sum(query.get('total_query_time') or 0.0 for query in queries)
+    return record
+
+
+def iter_request_records(path):
+    if is_segment_file(path):
+        for record in iter_segment_records(path):
+            yield summarize_record(record)
+    else:
+        yield read_request_summary(path)
+
+
+def new_partial():
+    # Mergeable, so the workers send back a fixed size summary per endpoint
+    # instead of every request time
+    return {
+        'request_times': LogHistogram(),
+        'sql_time': 0.0,
+        'query_counts': Counter()
+    }
+
+
+def get_endpoint(record):
+    # The URL pattern name, so /users/1/ and /users/2/ end up together. Only
+    # requests that didn't resolve to a view (e.g. 404s) use their path.
+    return record.get('view_name') or record.get('request')
+
+
+def analyze_file(path):
+    """
+    Returns `(partial results keyed by (endpoint, method), number of skipped
+    records)`. Runs in the worker processes.
+    """
+    results = {}
+    skipped = 0
+    try:
+        for record in iter_request_records(path):
+            if record.get('record_type') or 'total_request_time' not in record:
+                # Aggregate snapshots and other non request records
+                skipped += 1
+                continue
+            key = (get_endpoint(record), record.get('method'))
+            partial = results.get(key)
+            if partial is None:
+                partial = results[key] = new_partial()
+            partial['request_times'].add(record['total_request_time'])
+            partial['sql_time'] += record['sql_time']
+            partial['query_counts'][record['query_count']] += 1
+    except (IOError, ValueError):
+        skipped += 1
+    return results, skipped
+
+
+def merge_partials(merged, results):
+    for key, partial in results.items():
+        target = merged.get(key)
+        if target is None:
+            merged[key] = partial
+            continue
+        target['request_times'].merge(partial['request_times'])
+        target['sql_time'] += partial['sql_time']
+        target['query_counts'].update(partial['query_counts'])
+    return merged
+
+
+def count_percentile(counts, percent):
+    """
+    Nearest rank percentile of the values counted in `counts`.
+    """
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = max(1, int(math.ceil(percent / 100.0 * total)))
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= rank:
+            return value
+
+
+def summarize_endpoint(endpoint, method, partial):
+    request_times = partial['request_times']
+    query_counts = partial['query_counts']
+    total_request_time = request_times.total
+    summary = {
+        'endpoint': endpoint,
+        'method': method,
+        'count': request_times.count,
+        'total_request_time': total_request_time,
+        'sql_time_share': partial['sql_time'] / total_request_time if total_request_time else 0.0,
+        'mean_query_count': float(sum(value * count for value, count in query_counts.items())) / request_times.count,
+        'max_query_count': max(query_counts)
+    }
+    for percent in PERCENTILES:
+        summary['p%d' % percent] = request_times.percentile(percent)
+        summary['query_count_p%d' % percent] = count_percentile(query_counts, percent)
+    return summary
+
+
+class BatchAnalyzer(object):
+    """
+    Analyzes a directory or glob of captures in parallel and reports latency
+    percentiles, SQL time share and query counts per endpoint and method.
+    """
+    def __init__(self, paths, processes=None):
+        self.files = find_capture_files(paths)
+        self.processes = processes
+        self.skipped = 0
+        self.endpoints = []
+
+
+    def analyze(self):
+        if segments.zstandard is None and any(path.endswith('.zst') for path in self.files):
+            # Checked here, the workers would only report the files as skipped
+            raise ImportError('Reading zstd segments needs the `zstandard` package')
+
+        merged = {}
+        if self.processes == 1 or len(self.files) < 2:
+            partials = (analyze_file(path) for path in self.files)
+            self.collect(merged, partials)
+        else:
+            pool = Pool(self.processes)
+            try:
+                chunk_size = max(1, len(self.files) // ((self.processes or cpu_count()) * 4))
+                self.collect(merged, pool.imap_unordered(analyze_file, self.files, chunk_size))
+            finally:
+                pool.close()
+                pool.join()
+
+        self.endpoints = [
+            summarize_endpoint(endpoint, method, partial)
+            for (endpoint, method), partial in merged.items()
+        ]
+        self.endpoints.sort(key=lambda summary: summary['total_request_time'], reverse=True)
+        return self.endpoints
+
+
+    def collect(self, merged, partials):
+        for results, skipped in partials:
+            merge_partials(merged, results)
+            self.skipped += skipped
+
+
+    def to_json(self):
+        return json.dumps({
+            'files': len(self.files),
+            'skipped_records': self.skipped,
+            'endpoints': self.endpoints
+        }, indent=4)
+
+
+    def to_table(self):
+        columns = (
+            ('Endpoint', 'endpoint', '%s'),
+            ('Method', 'method', '%s'),
+            ('Count', 'count', '%d'),
+            ('p50', 'p50', '%0.4f'),
+            ('p95', 'p95', '%0.4f'),
+            ('p99', 'p99', '%0.4f'),
+            ('SQL %', 'sql_time_share', '%0.1f'),
+            ('Queries p50', 'query_count_p50', '%d'),
+            ('Queries p95', 'query_count_p95', '%d'),
+            ('Queries max', 'max_query_count', '%d'),
+        )
+        rows = [[title for title, _, _ in columns]]
+        for summary in self.endpoints:
+            row = []
+            for _, field, format_string in columns:
+                value = summary[field]
+                if field == 'sql_time_share':
+                    value *= 100
+                row.append(format_string % value)
+            rows.append(row)
+        widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+        lines = []
+        for row in rows:
+            lines.append('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+        lines.append('')
+        lines.append('%d files, %d skipped records' % (len(self.files), self.skipped))
+        return '\n'.join(lines)
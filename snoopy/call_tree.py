@@ -0,0 +1,236 @@
+import sys
+import time
+
+from snoopy.trace_buffer import EVENT_CALL, now_ns, symbol_table
+
+
+if hasattr(time, 'thread_time_ns'):
+    # Python 3.7+
+    cpu_now_ns = time.thread_time_ns
+    CPU_CLOCK = 'thread'
+else:
+    # Only process wide clocks, which also count the CPU time of the other
+    # threads: no CPU time is recorded
+    cpu_now_ns = None
+    CPU_CLOCK = None
+
+
+class CallTreeNode(object):
+    __slots__ = ('location_id', 'parent', 'children', 'calls', 'wall_ns', 'cpu_ns',
+                 'query_count', 'query_time')
+
+    def __init__(self, location_id, parent):
+        self.location_id = location_id
+        self.parent = parent
+        # code -> CallTreeNode
+        self.children = {}
+        self.calls = 0
+        self.wall_ns = 0
+        self.cpu_ns = 0
+        self.query_count = 0
+        self.query_time = 0.0
+
+
+class CallTree(object):
+    """
+    Calling context tree for the builtin profiler: the calls of a request
+    merged by call path, so a helper called 10,000 times from a loop is one
+    node with a count of 10,000 instead of 10,000 events.
+
+    Each node has its number of calls, its inclusive wall time and thread CPU
+    time (Python 3.7+ only), and the number and time of the SQL queries run
+    directly from it. Exclusive times are worked out when the tree is
+    serialized. A frame with a lot of wall time and little CPU time spent its
+    time waiting, on I/O or on locks.
+
+    Has the same `append` / `pin` / `expand_key` interface as `TraceBuffer` so
+    the profile hook doesn't care which one it fills. Once `max_nodes` nodes
+    exist, calls to new paths are counted in their parent.
+    """
+    def __init__(self, symbols=symbol_table, max_nodes=None):
+        self.symbols = symbols
+        self.max_nodes = max_nodes or sys.maxsize
+        self.cpu_clock = cpu_now_ns
+        self.root = CallTreeNode(None, None)
+        self.node_count = 0
+        self.dropped_calls = 0
+        self.dropped_returns = 0
+        # (node, start wall time, start CPU time, folded) of the calls that have not returned yet
+        self.open_calls = []
+
+
+    def __len__(self):
+        return self.node_count
+
+
+    def append(self, event, frame, key_prefix=None):
+        if event == EVENT_CALL:
+            parent = self.get_current_node() or self.root
+            node = parent.children.get(frame.f_code)
+            folded = False
+            if node is None:
+                if self.node_count >= self.max_nodes:
+                    self.dropped_calls += 1
+                    node = parent
+                    folded = True
+                else:
+                    node = parent.children[frame.f_code] = CallTreeNode(
+                        self.symbols.intern(frame, key_prefix), parent)
+                    self.node_count += 1
+            cpu_clock = self.cpu_clock
+            self.open_calls.append((node, now_ns(), cpu_clock() if cpu_clock is not None else 0, folded))
+            return node
+        if not self.open_calls:
+            # Return of a call made before tracing started
+            self.dropped_returns += 1
+            return None
+        self.close_call(*self.open_calls.pop())
+        return self.get_current_node()
+
+
+    def close_call(self, node, start_ns, start_cpu_ns, folded):
+        if folded:
+            # Its time is already in the parent's
+            return
+        node.calls += 1
+        node.wall_ns += now_ns() - start_ns
+        if self.cpu_clock is not None:
+            node.cpu_ns += self.cpu_clock() - start_cpu_ns
+
+
+    def finish(self):
+        """
+        Closes the calls still running when tracing stops.
+        """
+        while self.open_calls:
+            self.close_call(*self.open_calls.pop())
+
+
+    def pin(self):
+        # Every call path is kept anyway
+        pass
+
+
+    def get_current_node(self):
+        if not self.open_calls:
+            return None
+        return self.open_calls[-1][0]
+
+
+    def record_query(self, function_key, query_time):
+        # Unlike with the trace buffer, the running call is known here, no
+        # need for the key of the last call
+        node = self.get_current_node()
+        if node is not None:
+            node.query_count += 1
+            node.query_time += query_time
+
+
+    def expand_key(self, function_key):
+        node = self.get_current_node()
+        if node is None:
+            return [None, None]
+        return [self.symbols.get_key(node.location_id), None]
+
+
+    def get_stats(self):
+        return {
+            'nodes': self.node_count,
+            'max_nodes': self.max_nodes if self.max_nodes != sys.maxsize else None,
+            'dropped_calls': self.dropped_calls,
+            'dropped_returns': self.dropped_returns,
+            'cpu_clock': CPU_CLOCK if self.cpu_clock is not None else None
+        }
+
+
+    def is_truncated(self):
+        return bool(self.dropped_calls or self.dropped_returns)
+
+
+    def to_representation(self):
+        """
+        Flat list of nodes in depth first order, each with the index of its
+        parent (None for the top level calls):
+
+        {'key': ..., 'parent': ..., 'calls': ..., 'total_time': ..., 'self_time': ...,
+         'cpu_time': ..., 'self_cpu_time': ..., 'query_count': ..., 'query_time': ...}
+
+        `cpu_time` and `self_cpu_time` are left out without a thread CPU clock.
+        """
+        result = []
+        get_key = self.symbols.get_key
+        pending = [(child, None) for child in self.root.children.values()]
+        while pending:
+            node, parent_index = pending.pop()
+            children_wall_ns = sum(child.wall_ns for child in node.children.values())
+            representation = {
+                'key': get_key(node.location_id),
+                'parent': parent_index,
+                'calls': node.calls,
+                'total_time': node.wall_ns / 1000000000.0,
+                'self_time': max(node.wall_ns - children_wall_ns, 0) / 1000000000.0,
+                'query_count': node.query_count,
+                'query_time': node.query_time
+            }
+            if self.cpu_clock is not None:
+                children_cpu_ns = sum(child.cpu_ns for child in node.children.values())
+                representation['cpu_time'] = node.cpu_ns / 1000000000.0
+                representation['self_cpu_time'] = max(node.cpu_ns - children_cpu_ns, 0) / 1000000000.0
+            result.append(representation)
+            index = len(result) - 1
+            pending.extend((child, index) for child in node.children.values())
+        return result
+
+
+def get_function_key(key):
+    # Keys look like `module::function:line`
+    return key.rsplit(':', 1)[0]
+
+
+def summarize_call_tree(nodes):
+    """
+    Totals of the serialized tree per function, whatever path they were
+    called from, sorted by self time. `wait_time` is the self wall time that
+    was not spent on the CPU. Both CPU fields are None for trees recorded
+    without a thread CPU clock.
+    """
+    functions = {}
+    for node in nodes:
+        function_key = get_function_key(node['key'])
+        stats = functions.get(function_key)
+        if stats is None:
+            stats = functions[function_key] = {
+                'function': function_key,
+                'calls': 0,
+                'self_time': 0.0,
+                'self_cpu_time': 0.0 if 'self_cpu_time' in node else None,
+                'query_count': 0,
+                'query_time': 0.0
+            }
+        stats['calls'] += node['calls']
+        stats['self_time'] += node['self_time']
+        if stats['self_cpu_time'] is not None:
+            stats['self_cpu_time'] += node['self_cpu_time']
+        stats['query_count'] += node['query_count']
+        stats['query_time'] += node['query_time']
+    for stats in functions.values():
+        if stats['self_cpu_time'] is None:
+            stats['wait_time'] = None
+        else:
+            stats['wait_time'] = max(stats['self_time'] - stats['self_cpu_time'], 0.0)
+    return sorted(functions.values(), key=lambda stats: stats['self_time'], reverse=True)
+
+
+def format_optional_time(value):
+    return '%12s' % '-' if value is None else '%12.6f' % value
+
+
+def format_call_tree_summary(functions, top=None):
+    lines = ['%10s %12s %12s %12s %8s %12s  %s' % (
+        'calls', 'self', 'cpu', 'wait', 'queries', 'query time', 'function')]
+    for stats in functions[:top] if top else functions:
+        lines.append('%10d %12.6f %s %s %8d %12.6f  %s' % (
+            stats['calls'], stats['self_time'], format_optional_time(stats['self_cpu_time']),
+            format_optional_time(stats['wait_time']), stats['query_count'], stats['query_time'],
+            stats['function']))
+    return '\n'.join(lines)
@@ -0,0 +1,146 @@
+import linecache
+import os
+import sys
+import threading
+
+
+MAX_STACK_DEPTH = 256
+SNOOPY_ROOT = os.path.dirname(os.path.abspath(__file__))
+DJANGO_PATH_MARKER = os.sep + 'django' + os.sep
+
+
+class StackTable(object):
+    """
+    Process wide table of interned call stacks.
+
+    A stack is captured as a tuple of `(code, line_number)` pairs, outermost
+    frame first. Identical stacks share one id and their source text is only
+    rendered once, when the request data is serialized.
+    """
+    def __init__(self, max_size=20000):
+        self.max_size = max_size
+        self.stack_ids = {}
+        self.stacks = []
+        self.rendered = {}
+        self.call_sites = {}
+        self.lock = threading.Lock()
+        # Rendering reads source files, don't hold up captures meanwhile
+        self.render_lock = threading.Lock()
+
+
+    def capture(self, frame):
+        frames = []
+        while frame is not None and len(frames) < MAX_STACK_DEPTH:
+            frames.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        frames.reverse()
+        stack = tuple(frames)
+
+        stack_id = self.stack_ids.get(stack)
+        if stack_id is None:
+            with self.lock:
+                stack_id = self.stack_ids.get(stack)
+                if stack_id is None:
+                    if len(self.stacks) >= self.max_size:
+                        # Table is full, keep the stack without interning it
+                        return CallStack(self, None, stack)
+                    stack_id = len(self.stacks)
+                    self.stacks.append(stack)
+                    self.stack_ids[stack] = stack_id
+        return CallStack(self, stack_id)
+
+
+    def get_stack(self, stack_id):
+        return self.stacks[stack_id]
+
+
+    def render_stack(self, stack):
+        result = []
+        for code, line_number in stack:
+            result.append({
+                'file_name': code.co_filename,
+                'line_number': line_number,
+                'function_name': code.co_name,
+                'line': linecache.getline(code.co_filename, line_number).strip()
+            })
+        return result
+
+
+    def render(self, stack_id):
+        rendered = self.rendered.get(stack_id)
+        if rendered is None:
+            with self.render_lock:
+                rendered = self.rendered.get(stack_id)
+                if rendered is None:
+                    rendered = self.render_stack(self.stacks[stack_id])
+                    self.rendered[stack_id] = rendered
+        return rendered
+
+
+    def find_call_site(self, stack, app_root):
+        """
+        Returns `file:line function` for the innermost frame of the app's own
+        code, or if there is none, the innermost frame outside of Django.
+        """
+        fallback = None
+        for code, line_number in reversed(stack):
+            file_name = code.co_filename
+            if file_name.startswith(SNOOPY_ROOT):
+                continue
+            if app_root and file_name.startswith(app_root):
+                return "%s:%d %s" % (file_name, line_number, code.co_name)
+            if fallback is None and DJANGO_PATH_MARKER not in file_name:
+                fallback = "%s:%d %s" % (file_name, line_number, code.co_name)
+        return fallback
+
+
+    def get_call_site(self, stack_id, app_root):
+        key = (stack_id, app_root)
+        if key not in self.call_sites:
+            with self.render_lock:
+                if key not in self.call_sites:
+                    self.call_sites[key] = self.find_call_site(self.stacks[stack_id], app_root)
+        return self.call_sites[key]
+
+
+class CallStack(object):
+    """
+    Reference to a captured stack, rendered to a list of
+    `{'file_name', 'line_number', 'function_name', 'line'}` dicts on
+    serialization.
+    """
+    __slots__ = ('table', 'stack_id', 'stack')
+
+    def __init__(self, table, stack_id, stack=None):
+        self.table = table
+        self.stack_id = stack_id
+        self.stack = stack
+
+
+    def get_frames(self):
+        if self.stack_id is None:
+            return self.stack
+        return self.table.get_stack(self.stack_id)
+
+
+    def get_call_site(self, app_root):
+        if self.stack_id is None:
+            return self.table.find_call_site(self.stack, app_root)
+        return self.table.get_call_site(self.stack_id, app_root)
+
+
+    def to_representation(self):
+        if self.stack_id is None:
+            return self.table.render_stack(self.stack)
+        return self.table.render(self.stack_id)
+
+
+stack_table = StackTable()
+
+
+def capture_call_stack(skip=1):
+    """
+    Captures the stack of the caller, leaving out `skip` frames (by default
+    the frame calling this function).
+    """
+    return stack_table.capture(sys._getframe(skip + 1))
@@ -0,0 +1,137 @@
+import sys
+import threading
+
+try:
+    import contextvars
+except ImportError:
+    # Python < 3.7
+    contextvars = None
+
+
+class RequestState(object):
+    """
+    Attributes of the request being served in the current context.
+    """
+    pass
+
+
+class ContextRequestLocal(object):
+    """
+    Request state kept in a `ContextVar`, so that requests served concurrently
+    by coroutines on the same thread each see their own state.
+
+    The variable holds a `RequestState` that is replaced by `reset` at the
+    start of every request and mutated in place after that. Code that runs
+    in a copy of the context (e.g. `sync_to_async` running ORM calls in a
+    thread pool) shares the same `RequestState`, so queries recorded there
+    end up in the right request.
+    """
+    def __init__(self):
+        object.__setattr__(self, '_state', contextvars.ContextVar('snoopy_request', default=None))
+
+
+    def reset(self):
+        self._state.set(RequestState())
+
+
+    def get_state(self):
+        """
+        Returns the `RequestState` itself (None before the first request), for
+        hot paths that read several attributes.
+        """
+        return self._state.get()
+
+
+    def __getattr__(self, name):
+        state = self._state.get()
+        if state is None:
+            raise AttributeError(name)
+        return getattr(state, name)
+
+
+    def __setattr__(self, name, value):
+        state = self._state.get()
+        if state is None:
+            state = RequestState()
+            self._state.set(state)
+        setattr(state, name, value)
+
+
+class ThreadRequestLocal(threading.local):
+    """
+    Fallback for Pythons without `contextvars`: one request per thread.
+    """
+    def reset(self):
+        self.__dict__.clear()
+
+
+    def get_state(self):
+        return self
+
+
+def get_request_local():
+    if contextvars is None:
+        return ThreadRequestLocal()
+    return ContextRequestLocal()
+
+
+class ThreadHooks(threading.local):
+    """
+    `sys.setprofile`, `sys.settrace` and cProfile hooks are per thread, while
+    several requests can be served on one thread by an event loop. Counts the
+    requests using the hooks so they are only removed when the last one
+    finishes.
+    """
+    def __init__(self):
+        self.profile_users = 0
+        self.trace_users = 0
+        self.previous_trace = None
+        self.cprofile_in_use = False
+
+
+    def acquire_profile(self, profile_function):
+        if self.profile_users == 0:
+            sys.setprofile(profile_function)
+        self.profile_users += 1
+
+
+    def release_profile(self):
+        self.profile_users -= 1
+        if self.profile_users <= 0:
+            self.profile_users = 0
+            sys.setprofile(None)
+
+
+    def acquire_trace(self, trace_function):
+        if self.trace_users == 0:
+            # Put back whatever was tracing before, e.g. coverage
+            self.previous_trace = sys.gettrace()
+            sys.settrace(trace_function)
+        self.trace_users += 1
+
+
+    def release_trace(self):
+        self.trace_users -= 1
+        if self.trace_users <= 0:
+            self.trace_users = 0
+            sys.settrace(self.previous_trace)
+            self.previous_trace = None
+
+
+    def acquire_cprofile(self):
+        """
+        Returns False if another request on this thread already has cProfile
+        enabled. cProfile can't tell requests apart, so only one at a time
+        gets it.
+        """
+        if self.cprofile_in_use:
+            return False
+        self.cprofile_in_use = True
+        return True
+
+
+    def release_cprofile(self):
+        self.cprofile_in_use = False
+
+
+thread_hooks = ThreadHooks()
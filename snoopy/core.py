@@ -1,20 +1,92 @@
+import os
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper
 from django.db.models.sql.compiler import SQLCompiler, SQLInsertCompiler
 
+from snoopy.cursor_tracker import (
+    cursor_execute, cursor_executemany, cursor_fetchone, cursor_fetchmany, cursor_fetchall, cursor_iter,
+    connection_connect, connection_set_autocommit, connection_commit, connection_rollback)
+from snoopy.fingerprint import query_aggregator
 from snoopy.helpers import custom_import
+from snoopy.histogram import view_metrics
+from snoopy.memory_profiler import memory_profiler
+from snoopy.pipeline import OutputPipeline
 from snoopy.query_tracker import execute_sql, execute_insert_sql
 from snoopy.request import SnoopyRequest
+from snoopy.sampling import RequestSampler
+from snoopy.shared_metrics import get_shared_metrics
 
 
 class Snoopy:
     DEFAULT_SETTINGS = {
         'DEFAULT_USE_CPROFILE': False,
         'DEFAULT_CPROFILE_SHOW_ALL_FUNCTIONS': True,
+        'DEFAULT_CPROFILE_TOP_FUNCTIONS': None,
+        'DEFAULT_CPROFILE_SORT': 'cumulative',
+        'DEFAULT_CPROFILE_COLLAPSED_STACKS': False,
         'DEFAULT_COLLECT_SQL_QUERIES': True,
+        'DEFAULT_COLLECT_CURSOR_QUERIES': False,
+        'DEFAULT_CURSOR_QUERIES_MAX_STATEMENTS': 1000,
         'DEFAULT_USE_BUILTIN_PROFILER': False,
         'DEFAULT_BUILTIN_PROFILER_SHOW_ALL_FUNCTIONS': True,
-        'DEFAULT_OUTPUT_CLASS': 'snoopy.output.LogOutput'
+        'DEFAULT_BUILTIN_PROFILER_INCLUDE_MODULES': (),
+        'DEFAULT_BUILTIN_PROFILER_EXCLUDE_MODULES': ('snoopy', 'snoopy.*'),
+        'DEFAULT_BUILTIN_PROFILER_FILTER_CACHE_SIZE': 10000,
+        'DEFAULT_BUILTIN_PROFILER_MODE': 'trace',
+        'DEFAULT_BUILTIN_PROFILER_MIN_DURATION': 0,
+        'DEFAULT_BUILTIN_PROFILER_MAX_EVENTS': None,
+        'DEFAULT_BUILTIN_PROFILER_MAX_MEMORY': None,
+        'DEFAULT_BUILTIN_PROFILER_TRUNCATION_POLICY': 'stop',
+        'DEFAULT_USE_SAMPLING_PROFILER': False,
+        'DEFAULT_SAMPLING_PROFILER_INTERVAL': 0.005,
+        'DEFAULT_SAMPLING_PROFILER_MODE': 'thread',
+        'DEFAULT_LINE_PROFILER_FUNCTIONS': (),
+        'DEFAULT_LINE_PROFILER_URL_PATTERN': None,
+        'DEFAULT_USE_MEMORY_PROFILER': False,
+        'DEFAULT_MEMORY_PROFILER_TRACE_ALLOCATIONS': True,
+        'DEFAULT_MEMORY_PROFILER_TRACEBACK_LIMIT': 10,
+        'DEFAULT_MEMORY_PROFILER_TOP_ALLOCATIONS': 10,
+        'DEFAULT_MEMORY_PROFILER_SHOW_ALL_FUNCTIONS': False,
+        'DEFAULT_OUTPUT_CLASS': 'snoopy.output.LogOutput',
+        'DEFAULT_OUTPUT_ASYNC': False,
+        'DEFAULT_OUTPUT_QUEUE_SIZE': 1000,
+        'DEFAULT_OUTPUT_BATCH_SIZE': 20,
+        'DEFAULT_OUTPUT_WORKERS': 1,
+        'DEFAULT_OUTPUT_QUEUE_FULL_POLICY': 'drop_oldest',
+        'DEFAULT_OUTPUT_FLUSH_TIMEOUT': 5.0,
+        'DEFAULT_QUERY_AGGREGATION': False,
+        'DEFAULT_QUERY_AGGREGATION_EXPORT_INTERVAL': None,
+        'DEFAULT_DETECT_QUERY_PATTERNS': False,
+        'DEFAULT_N_PLUS_ONE_THRESHOLD': 5,
+        'DEFAULT_DUPLICATE_QUERY_THRESHOLD': 2,
+        'DEFAULT_COLLECT_VIEW_METRICS': False,
+        'DEFAULT_AGGREGATE_ONLY': False,
+        'DEFAULT_VIEW_METRICS_FLUSH_INTERVAL': 60,
+        'DEFAULT_TAIL_CAPTURE': False,
+        'DEFAULT_TAIL_CAPTURE_MIN_DURATION': 1.0,
+        'DEFAULT_TAIL_CAPTURE_MIN_QUERIES': None,
+        'DEFAULT_TAIL_CAPTURE_MIN_STATUS': 500,
+        'DEFAULT_TAIL_CAPTURE_MAX_EVENTS': 100000,
+        'DEFAULT_SHARED_METRICS': False,
+        'DEFAULT_SHARED_METRICS_PATH': None,
+        'DEFAULT_SHARED_METRICS_SLOTS': 1024,
+        'DEFAULT_SAMPLE_RATE': 1.0,
+        'DEFAULT_SAMPLE_RATE_URL_OVERRIDES': (),
+        'DEFAULT_SAMPLE_RATE_VIEW_OVERRIDES': {},
+        'DEFAULT_SAMPLE_FORCE_HEADER': None,
+        'DEFAULT_SAMPLE_FORCE_COOKIE': None,
+        'DEFAULT_SAMPLE_FORCE_TOKEN': None,
+        'DEFAULT_ADAPTIVE_SAMPLING': False,
+        'DEFAULT_ADAPTIVE_SAMPLING_TARGET': 1.0,
+        'DEFAULT_ADAPTIVE_SAMPLING_WINDOW': 10.0
     }
 
+    _sampler = None
+    _output_pipelines = {}
+
     @staticmethod
     def get_setting(setting):
         from django.conf import settings
@@ -38,22 +110,286 @@ class Snoopy:
             SQLInsertCompiler.execute_sql = execute_insert_sql
 
 
+    @staticmethod
+    def _injectCursorTrackers():
+        """
+        Patches the cursor wrapper and connection classes every backend uses,
+        for SQL that doesn't go through the compilers and for connection /
+        transaction events.
+        """
+        if not hasattr(CursorWrapper, '_snoopy_execute'):
+            CursorWrapper._snoopy_execute = CursorWrapper.execute
+            CursorWrapper.execute = cursor_execute
+            CursorWrapper._snoopy_executemany = CursorWrapper.executemany
+            CursorWrapper.executemany = cursor_executemany
+            CursorWrapper.fetchone = cursor_fetchone
+            CursorWrapper.fetchmany = cursor_fetchmany
+            CursorWrapper.fetchall = cursor_fetchall
+            CursorWrapper._snoopy_iter = CursorWrapper.__iter__
+            CursorWrapper.__iter__ = cursor_iter
+        if not hasattr(BaseDatabaseWrapper, '_snoopy_connect'):
+            BaseDatabaseWrapper._snoopy_connect = BaseDatabaseWrapper.connect
+            BaseDatabaseWrapper.connect = connection_connect
+            BaseDatabaseWrapper._snoopy_set_autocommit = BaseDatabaseWrapper.set_autocommit
+            BaseDatabaseWrapper.set_autocommit = connection_set_autocommit
+            BaseDatabaseWrapper._snoopy_commit = BaseDatabaseWrapper.commit
+            BaseDatabaseWrapper.commit = connection_commit
+            BaseDatabaseWrapper._snoopy_rollback = BaseDatabaseWrapper.rollback
+            BaseDatabaseWrapper.rollback = connection_rollback
+
+
+    @staticmethod
+    def _removeCursorTrackers():
+        """
+        Undoes `_injectCursorTrackers`. The fetch methods are not defined by
+        `CursorWrapper` itself, it proxies them to the cursor.
+        """
+        if hasattr(CursorWrapper, '_snoopy_execute'):
+            CursorWrapper.execute = CursorWrapper._snoopy_execute
+            CursorWrapper.executemany = CursorWrapper._snoopy_executemany
+            CursorWrapper.__iter__ = CursorWrapper._snoopy_iter
+            del CursorWrapper.fetchone, CursorWrapper.fetchmany, CursorWrapper.fetchall
+            del CursorWrapper._snoopy_execute, CursorWrapper._snoopy_executemany, CursorWrapper._snoopy_iter
+        if hasattr(BaseDatabaseWrapper, '_snoopy_connect'):
+            BaseDatabaseWrapper.connect = BaseDatabaseWrapper._snoopy_connect
+            BaseDatabaseWrapper.set_autocommit = BaseDatabaseWrapper._snoopy_set_autocommit
+            BaseDatabaseWrapper.commit = BaseDatabaseWrapper._snoopy_commit
+            BaseDatabaseWrapper.rollback = BaseDatabaseWrapper._snoopy_rollback
+            del BaseDatabaseWrapper._snoopy_connect, BaseDatabaseWrapper._snoopy_set_autocommit
+            del BaseDatabaseWrapper._snoopy_commit, BaseDatabaseWrapper._snoopy_rollback
+
+
+    @staticmethod
+    def get_sampler():
+        if Snoopy._sampler is None:
+            Snoopy._sampler = RequestSampler.from_settings(Snoopy.get_setting)
+        return Snoopy._sampler
+
+
+    @staticmethod
+    def get_output_pipeline(output_cls):
+        pipeline = Snoopy._output_pipelines.get(output_cls)
+        if pipeline is None:
+            pipeline = OutputPipeline(
+                output_cls,
+                max_queue_size=Snoopy.get_setting('OUTPUT_QUEUE_SIZE'),
+                batch_size=Snoopy.get_setting('OUTPUT_BATCH_SIZE'),
+                workers=Snoopy.get_setting('OUTPUT_WORKERS'),
+                full_policy=Snoopy.get_setting('OUTPUT_QUEUE_FULL_POLICY'),
+                flush_timeout=Snoopy.get_setting('OUTPUT_FLUSH_TIMEOUT'))
+            Snoopy._output_pipelines[output_cls] = pipeline
+        return pipeline
+
+
+    @staticmethod
+    def collects_view_metrics():
+        return Snoopy.get_setting('COLLECT_VIEW_METRICS') or Snoopy.get_setting('AGGREGATE_ONLY')
+
+
+    @staticmethod
+    def collects_request_metrics():
+        # Metrics that need the timings of every request, sampled or not
+        return Snoopy.collects_view_metrics() or Snoopy.get_setting('SHARED_METRICS')
+
+
+    @staticmethod
+    def check_configuration():
+        """
+        Called once, when the middleware is loaded, for settings that can't
+        work in this environment.
+        """
+        if Snoopy.get_setting('USE_MEMORY_PROFILER') and not memory_profiler.is_available():
+            raise ImproperlyConfigured(
+                'SNOOPY_USE_MEMORY_PROFILER needs tracemalloc or gc.callbacks (Python 3), '
+                'or the resource module (Unix)')
+
+
     @staticmethod
     def register_request(request):
+        if Snoopy.get_setting('AGGREGATE_ONLY'):
+            # Only requests that explicitly ask for it get a full record
+            request._snoopy_sampled = Snoopy.get_sampler().is_forced(request)
+        else:
+            request._snoopy_sampled = Snoopy.get_sampler().should_sample(request)
+
         if Snoopy.get_setting('COLLECT_SQL_QUERIES'):
             Snoopy._injectSQLTrackers()
+        if Snoopy.get_setting('COLLECT_CURSOR_QUERIES'):
+            Snoopy._injectCursorTrackers()
+
+        if not request._snoopy_sampled:
+            SnoopyRequest.unregister_request(count_queries=Snoopy.collects_request_metrics())
+            return
+
+        builtin_profiler_max_events = Snoopy.get_setting('BUILTIN_PROFILER_MAX_EVENTS')
+        if Snoopy.get_setting('TAIL_CAPTURE'):
+            request._snoopy_forced = Snoopy.get_sampler().is_forced(request)
+            # Every request is traced, keep the buffers bounded
+            builtin_profiler_max_events = builtin_profiler_max_events or Snoopy.get_setting('TAIL_CAPTURE_MAX_EVENTS')
 
         SnoopyRequest.register_request(request, {
             'USE_CPROFILE': Snoopy.get_setting('USE_CPROFILE'),
             'CPROFILE_SHOW_ALL_FUNCTIONS': Snoopy.get_setting('CPROFILE_SHOW_ALL_FUNCTIONS'),
+            'CPROFILE_TOP_FUNCTIONS': Snoopy.get_setting('CPROFILE_TOP_FUNCTIONS'),
+            'CPROFILE_SORT': Snoopy.get_setting('CPROFILE_SORT'),
+            'CPROFILE_COLLAPSED_STACKS': Snoopy.get_setting('CPROFILE_COLLAPSED_STACKS'),
             'USE_BUILTIN_PROFILER': Snoopy.get_setting('USE_BUILTIN_PROFILER'),
-            'BUILTIN_PROFILER_SHOW_ALL_FUNCTIONS': Snoopy.get_setting('BUILTIN_PROFILER_SHOW_ALL_FUNCTIONS')
+            'BUILTIN_PROFILER_SHOW_ALL_FUNCTIONS': Snoopy.get_setting('BUILTIN_PROFILER_SHOW_ALL_FUNCTIONS'),
+            'BUILTIN_PROFILER_INCLUDE_MODULES': Snoopy.get_setting('BUILTIN_PROFILER_INCLUDE_MODULES'),
+            'BUILTIN_PROFILER_EXCLUDE_MODULES': Snoopy.get_setting('BUILTIN_PROFILER_EXCLUDE_MODULES'),
+            'BUILTIN_PROFILER_FILTER_CACHE_SIZE': Snoopy.get_setting('BUILTIN_PROFILER_FILTER_CACHE_SIZE'),
+            'BUILTIN_PROFILER_MODE': Snoopy.get_setting('BUILTIN_PROFILER_MODE'),
+            'BUILTIN_PROFILER_MIN_DURATION': Snoopy.get_setting('BUILTIN_PROFILER_MIN_DURATION'),
+            'BUILTIN_PROFILER_MAX_EVENTS': builtin_profiler_max_events,
+            'BUILTIN_PROFILER_MAX_MEMORY': Snoopy.get_setting('BUILTIN_PROFILER_MAX_MEMORY'),
+            'BUILTIN_PROFILER_TRUNCATION_POLICY': Snoopy.get_setting('BUILTIN_PROFILER_TRUNCATION_POLICY'),
+            'USE_SAMPLING_PROFILER': Snoopy.get_setting('USE_SAMPLING_PROFILER'),
+            'SAMPLING_PROFILER_INTERVAL': Snoopy.get_setting('SAMPLING_PROFILER_INTERVAL'),
+            'SAMPLING_PROFILER_MODE': Snoopy.get_setting('SAMPLING_PROFILER_MODE'),
+            'USE_LINE_PROFILER': Snoopy.should_profile_lines(request),
+            'LINE_PROFILER_FUNCTIONS': Snoopy.get_setting('LINE_PROFILER_FUNCTIONS'),
+            'USE_MEMORY_PROFILER': Snoopy.get_setting('USE_MEMORY_PROFILER'),
+            'MEMORY_PROFILER_TRACE_ALLOCATIONS': Snoopy.get_setting('MEMORY_PROFILER_TRACE_ALLOCATIONS'),
+            'MEMORY_PROFILER_TRACEBACK_LIMIT': Snoopy.get_setting('MEMORY_PROFILER_TRACEBACK_LIMIT'),
+            'MEMORY_PROFILER_TOP_ALLOCATIONS': Snoopy.get_setting('MEMORY_PROFILER_TOP_ALLOCATIONS'),
+            'MEMORY_PROFILER_SHOW_ALL_FUNCTIONS': Snoopy.get_setting('MEMORY_PROFILER_SHOW_ALL_FUNCTIONS'),
+            'COLLECT_CURSOR_QUERIES': Snoopy.get_setting('COLLECT_CURSOR_QUERIES'),
+            'CURSOR_QUERIES_MAX_STATEMENTS': Snoopy.get_setting('CURSOR_QUERIES_MAX_STATEMENTS'),
+            'QUERY_AGGREGATION': Snoopy.get_setting('QUERY_AGGREGATION'),
+            'DETECT_QUERY_PATTERNS': Snoopy.get_setting('DETECT_QUERY_PATTERNS'),
+            'N_PLUS_ONE_THRESHOLD': Snoopy.get_setting('N_PLUS_ONE_THRESHOLD'),
+            'DUPLICATE_QUERY_THRESHOLD': Snoopy.get_setting('DUPLICATE_QUERY_THRESHOLD')
         })
 
 
+    @staticmethod
+    def save_output(output_cls, data):
+        if Snoopy.get_setting('OUTPUT_ASYNC'):
+            Snoopy.get_output_pipeline(output_cls).put(data)
+        else:
+            output_cls.save_request_data(data)
+
+
+    @staticmethod
+    def export_query_aggregates(output_cls):
+        """
+        Sends the per fingerprint query aggregates to the output class every
+        `QUERY_AGGREGATION_EXPORT_INTERVAL` seconds, and starts a new period.
+        """
+        interval = Snoopy.get_setting('QUERY_AGGREGATION_EXPORT_INTERVAL')
+        if not interval:
+            return
+        snapshot = query_aggregator.snapshot_if_due(interval)
+        if snapshot is not None:
+            Snoopy.save_output(output_cls, snapshot)
+
+
+    @staticmethod
+    def get_view_name(request):
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None:
+            return None
+        return resolver_match.view_name
+
+
+    @staticmethod
+    def record_view_metrics(output_cls, request, request_time, sql_time, query_count):
+        view_metrics.add(Snoopy.get_view_name(request), request.method, request_time, sql_time, query_count)
+        if view_metrics.flush_pid != os.getpid():
+            if Snoopy.get_setting('OUTPUT_ASYNC'):
+                # Created first, so that its exit handler flushes the queue
+                # after the last snapshot was put on it
+                Snoopy.get_output_pipeline(output_cls)
+            view_metrics.start_flushing(Snoopy.get_setting('VIEW_METRICS_FLUSH_INTERVAL'),
+                                        lambda snapshot: Snoopy.save_output(output_cls, snapshot))
+
+
+    @staticmethod
+    def get_shared_metrics():
+        return get_shared_metrics(Snoopy.get_setting('SHARED_METRICS_PATH'),
+                                  Snoopy.get_setting('SHARED_METRICS_SLOTS'))
+
+
+    @staticmethod
+    def record_shared_metrics(request, request_time, sql_time, query_count, queries):
+        shared_metrics = Snoopy.get_shared_metrics()
+        shared_metrics.add_view(Snoopy.get_view_name(request), request.method, request_time, sql_time, query_count)
+        query_times = {}
+        for query in queries:
+            if query.get('fingerprint'):
+                query_times.setdefault((query['fingerprint'], query['normalized_query']), []).append(
+                    query['total_query_time'].total_seconds())
+        for (query_fingerprint, normalized_query), times in query_times.items():
+            shared_metrics.add_query(query_fingerprint, normalized_query, times)
+
+
+    @staticmethod
+    def should_profile_lines(request):
+        if not Snoopy.get_setting('LINE_PROFILER_FUNCTIONS'):
+            return False
+        url_pattern = Snoopy.get_setting('LINE_PROFILER_URL_PATTERN')
+        return url_pattern is None or re.search(url_pattern, request.path) is not None
+
+
+    @staticmethod
+    def get_tail_capture_reasons(request, response, request_time, query_count):
+        """
+        Returns why a request is worth keeping in tail capture mode, an empty
+        list for the ones that can be thrown away.
+        """
+        reasons = []
+        if getattr(request, '_snoopy_forced', False):
+            reasons.append('forced')
+        min_duration = Snoopy.get_setting('TAIL_CAPTURE_MIN_DURATION')
+        if min_duration is not None and request_time >= min_duration:
+            reasons.append('duration')
+        min_queries = Snoopy.get_setting('TAIL_CAPTURE_MIN_QUERIES')
+        if min_queries is not None and query_count >= min_queries:
+            reasons.append('query_count')
+        min_status = Snoopy.get_setting('TAIL_CAPTURE_MIN_STATUS')
+        if min_status is not None and response.status_code >= min_status:
+            reasons.append('status_code')
+        return reasons
+
+
     @staticmethod
     def record_response(request, response):
-        snoopy_data = SnoopyRequest.register_response(response)
+        if not hasattr(request, '_snoopy_sampled'):
+            # process_request was skipped for this request
+            return
+        if not request._snoopy_sampled and not Snoopy.collects_request_metrics():
+            return
+
         output_cls_name = Snoopy.get_setting('OUTPUT_CLASS')
         output_cls = custom_import(output_cls_name)
-        output_cls.save_request_data(snoopy_data)
+        if request._snoopy_sampled:
+            snoopy_data = SnoopyRequest.stop_request(response)
+            request_time = snoopy_data['total_request_time'].total_seconds()
+            sql_time = sum(query['total_query_time'].total_seconds() for query in snoopy_data['queries'])
+            query_count = len(snoopy_data['queries'])
+            queries = snoopy_data['queries']
+            reasons = None
+            if Snoopy.get_setting('TAIL_CAPTURE'):
+                reasons = Snoopy.get_tail_capture_reasons(request, response, request_time, query_count)
+            if reasons is None or reasons:
+                snoopy_data = SnoopyRequest.register_response()
+                snoopy_data['view_name'] = Snoopy.get_view_name(request)
+                if reasons:
+                    snoopy_data['tail_capture_reasons'] = reasons
+                Snoopy.save_output(output_cls, snoopy_data)
+            else:
+                # A fast request, dropped before the profiler data is turned
+                # into tables
+                SnoopyRequest.discard_request()
+        else:
+            request_time, sql_time, query_count = SnoopyRequest.register_unsampled_response()
+            queries = []
+
+        if Snoopy.collects_view_metrics():
+            Snoopy.record_view_metrics(output_cls, request, request_time, sql_time, query_count)
+
+        if Snoopy.get_setting('SHARED_METRICS'):
+            Snoopy.record_shared_metrics(request, request_time, sql_time, query_count, queries)
+
+        if Snoopy.get_setting('QUERY_AGGREGATION'):
+            Snoopy.export_query_aggregates(output_cls)
@@ -0,0 +1,144 @@
+import time
+
+from snoopy.callsite import capture_call_stack
+from snoopy.fingerprint import DeferredQuery
+from snoopy.request import SnoopyRequest
+
+
+def get_rowcount(cursor):
+    try:
+        rowcount = cursor.rowcount
+    except Exception:
+        return None
+    # -1 when the driver can't tell, e.g. SELECT with sqlite3
+    return rowcount if rowcount >= 0 else None
+
+
+def cursor_execute(self, sql, params=None):
+    """
+    Replaces `CursorWrapper.execute`, so it sees every statement, whether it
+    comes from the ORM, `raw()`, `connection.cursor()` or third party code.
+    """
+    activity = SnoopyRequest.get_database_activity()
+    if activity is None:
+        return self._snoopy_execute(sql, params)
+
+    if not self.db.autocommit:
+        activity.start_transaction(self.db.alias)
+    traceback = capture_call_stack()
+    start_timestamp = time.time()
+    try:
+        return self._snoopy_execute(sql, params)
+    finally:
+        duration = time.time() - start_timestamp
+        self._snoopy_statement = activity.add_statement(
+            self.db.alias, sql if params is None else DeferredQuery(sql, params), start_timestamp, duration,
+            get_rowcount(self.cursor), traceback=traceback)
+
+
+def cursor_executemany(self, sql, param_list):
+    activity = SnoopyRequest.get_database_activity()
+    if activity is None:
+        return self._snoopy_executemany(sql, param_list)
+
+    try:
+        batch_size = len(param_list)
+    except TypeError:
+        # param_list could be an iterator
+        batch_size = None
+    if not self.db.autocommit:
+        activity.start_transaction(self.db.alias)
+    traceback = capture_call_stack()
+    start_timestamp = time.time()
+    try:
+        return self._snoopy_executemany(sql, param_list)
+    finally:
+        duration = time.time() - start_timestamp
+        self._snoopy_statement = activity.add_statement(
+            self.db.alias, sql, start_timestamp, duration,
+            get_rowcount(self.cursor), batch_size=batch_size or 0, traceback=traceback)
+
+
+def add_fetched_rows(cursor_wrapper, rows):
+    activity = SnoopyRequest.get_database_activity()
+    if activity is not None:
+        activity.add_fetched_rows(
+            cursor_wrapper.db.alias, getattr(cursor_wrapper, '_snoopy_statement', None), rows)
+
+
+# `CursorWrapper` proxies these through `__getattr__`, they are defined on the
+# class with the same database error wrapping.
+
+def cursor_fetchone(self):
+    with self.db.wrap_database_errors:
+        row = self.cursor.fetchone()
+    if row is not None:
+        add_fetched_rows(self, 1)
+    return row
+
+
+def cursor_fetchmany(self, *args, **kwargs):
+    with self.db.wrap_database_errors:
+        rows = self.cursor.fetchmany(*args, **kwargs)
+    add_fetched_rows(self, len(rows))
+    return rows
+
+
+def cursor_fetchall(self):
+    with self.db.wrap_database_errors:
+        rows = self.cursor.fetchall()
+    add_fetched_rows(self, len(rows))
+    return rows
+
+
+def cursor_iter(self):
+    # Used by `raw()`
+    rows = 0
+    try:
+        with self.db.wrap_database_errors:
+            for item in self.cursor:
+                rows += 1
+                yield item
+    finally:
+        add_fetched_rows(self, rows)
+
+
+def connection_connect(self, *args, **kwargs):
+    activity = SnoopyRequest.get_database_activity()
+    if activity is None:
+        return self._snoopy_connect(*args, **kwargs)
+
+    start_timestamp = time.time()
+    try:
+        return self._snoopy_connect(*args, **kwargs)
+    finally:
+        activity.add_connect(self.alias, time.time() - start_timestamp)
+
+
+def connection_set_autocommit(self, autocommit, *args, **kwargs):
+    activity = SnoopyRequest.get_database_activity()
+    if activity is not None and not autocommit:
+        # Usually `atomic` starting a transaction, which may run a BEGIN.
+        # With autocommit left off, the statements start the next ones.
+        activity.start_transaction(self.alias)
+    result = self._snoopy_set_autocommit(autocommit, *args, **kwargs)
+    if activity is not None and autocommit:
+        # Turning autocommit back on commits what was pending
+        activity.end_transaction(self.alias, committed=True)
+    return result
+
+
+def connection_commit(self, *args, **kwargs):
+    result = self._snoopy_commit(*args, **kwargs)
+    activity = SnoopyRequest.get_database_activity()
+    if activity is not None:
+        activity.end_transaction(self.alias, committed=True)
+    return result
+
+
+def connection_rollback(self, *args, **kwargs):
+    result = self._snoopy_rollback(*args, **kwargs)
+    activity = SnoopyRequest.get_database_activity()
+    if activity is not None:
+        activity.end_transaction(self.alias, committed=False)
+    return result
@@ -0,0 +1,111 @@
+import datetime
+import time
+
+
+class DatabaseActivity(object):
+    """
+    Cursor and connection level database activity of a single request, per
+    database alias: every statement (raw SQL and `executemany` included) with
+    its rows, connections opened and transactions.
+
+    Statements past `max_statements` are only counted in the per alias
+    totals.
+    """
+    def __init__(self, max_statements=None):
+        self.max_statements = max_statements
+        self.statements = []
+        self.dropped_statements = 0
+        self.aliases = {}
+        # alias -> [start timestamp, statement time at start]
+        self.open_transactions = {}
+
+
+    def get_alias_stats(self, alias):
+        stats = self.aliases.get(alias)
+        if stats is None:
+            stats = self.aliases[alias] = {
+                'connections_opened': 0,
+                'connect_time': 0.0,
+                'statements': 0,
+                'statement_time': 0.0,
+                'rows_affected': 0,
+                'rows_fetched': 0,
+                'transactions': 0,
+                'commits': 0,
+                'rollbacks': 0,
+                'transaction_time': 0.0,
+                'transaction_idle_time': 0.0
+            }
+        return stats
+
+
+    def add_connect(self, alias, connect_time):
+        stats = self.get_alias_stats(alias)
+        stats['connections_opened'] += 1
+        stats['connect_time'] += connect_time
+
+
+    def add_statement(self, alias, query, start_timestamp, duration, rowcount, batch_size=None, traceback=None):
+        """
+        Returns the statement dict that fetched rows get added to, None when
+        it is only counted.
+        """
+        stats = self.get_alias_stats(alias)
+        stats['statements'] += 1
+        stats['statement_time'] += duration
+        if rowcount is not None and rowcount > 0:
+            stats['rows_affected'] += rowcount
+
+        if self.max_statements is not None and len(self.statements) >= self.max_statements:
+            self.dropped_statements += 1
+            return None
+        statement = {
+            'alias': alias,
+            'query': query,
+            'start_time': datetime.datetime.fromtimestamp(start_timestamp),
+            'duration': duration,
+            'rowcount': rowcount,
+            'rows_fetched': 0,
+            'in_transaction': alias in self.open_transactions,
+            'traceback': traceback
+        }
+        if batch_size is not None:
+            statement['batch_size'] = batch_size
+        self.statements.append(statement)
+        return statement
+
+
+    def add_fetched_rows(self, alias, statement, rows):
+        self.get_alias_stats(alias)['rows_fetched'] += rows
+        if statement is not None:
+            statement['rows_fetched'] += rows
+
+
+    def start_transaction(self, alias):
+        if alias not in self.open_transactions:
+            self.open_transactions[alias] = [time.time(), self.get_alias_stats(alias)['statement_time']]
+
+
+    def end_transaction(self, alias, committed):
+        transaction = self.open_transactions.pop(alias, None)
+        if transaction is None:
+            return
+        start_timestamp, start_statement_time = transaction
+        stats = self.get_alias_stats(alias)
+        transaction_time = time.time() - start_timestamp
+        stats['transactions'] += 1
+        stats['commits' if committed else 'rollbacks'] += 1
+        stats['transaction_time'] += transaction_time
+        # Time the transaction was open without a statement running, e.g.
+        # Python code or other databases in between
+        statement_time = stats['statement_time'] - start_statement_time
+        stats['transaction_idle_time'] += max(transaction_time - statement_time, 0.0)
+
+
+    def to_representation(self):
+        return {
+            'aliases': self.aliases,
+            'statements': self.statements,
+            'dropped_statements': self.dropped_statements,
+            'open_transactions': sorted(self.open_transactions)
+        }
@@ -0,0 +1,107 @@
+FINDING_N_PLUS_ONE = 'n_plus_one'
+FINDING_DUPLICATE = 'duplicate'
+
+
+def get_params_key(query):
+    # Inserts carry a list of statements
+    statements = query if isinstance(query, list) else [query]
+    key = []
+    for statement in statements:
+        params = statement.params
+        try:
+            hash(params)
+        except TypeError:
+            params = repr(params)
+        key.append((statement.sql, params))
+    return tuple(key)
+
+
+class QueryPatternDetector(object):
+    """
+    Looks for wasteful query patterns as queries are recorded in a request:
+
+    - N+1: the same query shape run from the same call site with different
+      parameters at least `n_plus_one_threshold` times, usually a query in a
+      loop that could be a single `IN` query / `select_related` / `prefetch_related`.
+    - Duplicates: the exact same query (same parameters) run at least
+      `duplicate_threshold` times, wherever it came from.
+    """
+    def __init__(self, app_root=None, n_plus_one_threshold=5, duplicate_threshold=2):
+        self.app_root = app_root
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.duplicate_threshold = duplicate_threshold
+        self.call_site_groups = {}
+        self.duplicate_groups = {}
+
+
+    def add_to_group(self, groups, key, query_time):
+        group = groups.get(key)
+        if group is None:
+            group = {
+                'count': 0,
+                'total_time': 0.0,
+                'max_time': 0.0
+            }
+            groups[key] = group
+        group['count'] += 1
+        group['total_time'] += query_time
+        if query_time > group['max_time']:
+            group['max_time'] = query_time
+        return group
+
+
+    def add(self, query_data):
+        query_fingerprint = query_data.get('fingerprint')
+        if query_fingerprint is None:
+            return
+        query_time = query_data['total_query_time'].total_seconds()
+        params_key = get_params_key(query_data['query'])
+        call_site = query_data['traceback'].get_call_site(self.app_root)
+
+        group = self.add_to_group(
+            self.call_site_groups, (query_fingerprint, call_site), query_time)
+        group['normalized_query'] = query_data['normalized_query']
+        params_keys = group.setdefault('params_keys', set())
+        if len(params_keys) < 2:
+            # Only need to know if there is more than one distinct set of params
+            params_keys.add(params_key)
+
+        group = self.add_to_group(
+            self.duplicate_groups, (query_fingerprint, params_key), query_time)
+        group['query'] = query_data['query']
+        group.setdefault('call_sites', set()).add(call_site)
+
+
+    def get_findings(self):
+        findings = []
+        for (query_fingerprint, call_site), group in self.call_site_groups.items():
+            if group['count'] < self.n_plus_one_threshold or len(group['params_keys']) < 2:
+                continue
+            findings.append({
+                'type': FINDING_N_PLUS_ONE,
+                'fingerprint': query_fingerprint,
+                'query': group['normalized_query'],
+                'call_site': call_site,
+                'count': group['count'],
+                'total_time': group['total_time'],
+                # Assuming the loop can be replaced with one query that costs
+                # about as much as the slowest one
+                'estimated_savings': group['total_time'] - group['max_time']
+            })
+
+        for (query_fingerprint, _), group in self.duplicate_groups.items():
+            if group['count'] < self.duplicate_threshold:
+                continue
+            findings.append({
+                'type': FINDING_DUPLICATE,
+                'fingerprint': query_fingerprint,
+                'query': group['query'],
+                'call_sites': sorted(call_site for call_site in group['call_sites'] if call_site),
+                'count': group['count'],
+                'total_time': group['total_time'],
+                # Everything but one of the queries could be served from memory
+                'estimated_savings': group['total_time'] * (group['count'] - 1) / group['count']
+            })
+
+        findings.sort(key=lambda finding: finding['estimated_savings'], reverse=True)
+        return findings
@@ -0,0 +1,163 @@
+import datetime
+import hashlib
+import re
+import threading
+
+
+STRING_LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL_REGEX = re.compile(r"(?<![\w.\"`])-?\d+(?:\.\d+)?\b")
+PLACEHOLDER_REGEX = re.compile(r"%s|%\(\w+\)s")
+VALUE_LIST_REGEX = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+REPEATED_VALUE_LIST_REGEX = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+WHITESPACE_REGEX = re.compile(r"\s+")
+
+MAX_FINGERPRINT_CACHE_SIZE = 10000
+
+_fingerprint_cache = {}
+
+
+def normalize_sql(sql):
+    """
+    Strips literals and parameters from a SQL template so that queries of the
+    same shape normalize to the same string, e.g.
+
+    SELECT * FROM foo WHERE id IN (%s, %s, %s) AND name = 'x'
+
+    becomes
+
+    SELECT * FROM foo WHERE id IN (...) AND name = ?
+    """
+    sql = STRING_LITERAL_REGEX.sub('?', sql)
+    sql = PLACEHOLDER_REGEX.sub('?', sql)
+    sql = NUMBER_LITERAL_REGEX.sub('?', sql)
+    sql = VALUE_LIST_REGEX.sub('(...)', sql)
+    # Bulk inserts: VALUES (...), (...), (...)
+    sql = REPEATED_VALUE_LIST_REGEX.sub('(...)', sql)
+    return WHITESPACE_REGEX.sub(' ', sql).strip()
+
+
+def fingerprint(sql):
+    """
+    Returns `(fingerprint, normalized_sql)` for a SQL template. Results are
+    cached since the ORM produces the same templates over and over.
+    """
+    result = _fingerprint_cache.get(sql)
+    if result is None:
+        normalized_sql = normalize_sql(sql)
+        result = (hashlib.md5(normalized_sql.encode('utf-8')).hexdigest()[:16], normalized_sql)
+        if len(_fingerprint_cache) >= MAX_FINGERPRINT_CACHE_SIZE:
+            _fingerprint_cache.clear()
+        _fingerprint_cache[sql] = result
+    return result
+
+
+class DeferredQuery(object):
+    """
+    Keeps the SQL template and parameters apart. The query is only rendered
+    as `sql % params` when the request data is serialized.
+    """
+    __slots__ = ('sql', 'params')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+
+    def to_representation(self):
+        # Raw cursors are often given a list, `%` only takes a tuple
+        params = tuple(self.params) if isinstance(self.params, list) else self.params
+        try:
+            return self.sql % params
+        except (TypeError, ValueError):
+            return "%s %% %r" % (self.sql, self.params)
+
+
+class QueryAggregator(object):
+    """
+    Process wide statistics per query fingerprint: count, total and max time,
+    models and the most common call sites.
+    """
+    def __init__(self, max_fingerprints=5000, max_call_sites=10):
+        self.max_fingerprints = max_fingerprints
+        self.max_call_sites = max_call_sites
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        self.fingerprints = {}
+        self.dropped = 0
+        self.start_time = datetime.datetime.now()
+
+
+    def add(self, query_fingerprint, normalized_sql, query_time, model=None, call_site=None):
+        with self.lock:
+            stats = self.fingerprints.get(query_fingerprint)
+            if stats is None:
+                if len(self.fingerprints) >= self.max_fingerprints:
+                    self.dropped += 1
+                    return
+                stats = {
+                    'fingerprint': query_fingerprint,
+                    'sql': normalized_sql,
+                    'count': 0,
+                    'total_time': 0.0,
+                    'max_time': 0.0,
+                    'models': set(),
+                    'call_sites': {}
+                }
+                self.fingerprints[query_fingerprint] = stats
+            stats['count'] += 1
+            stats['total_time'] += query_time
+            if query_time > stats['max_time']:
+                stats['max_time'] = query_time
+            if model:
+                stats['models'].add(model)
+            if call_site:
+                call_sites = stats['call_sites']
+                if call_site in call_sites or len(call_sites) < self.max_call_sites:
+                    call_sites[call_site] = call_sites.get(call_site, 0) + 1
+
+
+    def build_snapshot(self, reset):
+        # Must be called with the lock held
+        fingerprints = []
+        for stats in self.fingerprints.values():
+            stats = dict(stats)
+            stats['models'] = sorted(stats['models'])
+            stats['call_sites'] = dict(stats['call_sites'])
+            fingerprints.append(stats)
+        result = {
+            'record_type': 'query_aggregates',
+            'start_time': self.start_time,
+            'end_time': datetime.datetime.now(),
+            'dropped_fingerprints': self.dropped,
+            'fingerprints': sorted(fingerprints, key=lambda stats: stats['total_time'], reverse=True)
+        }
+        if reset:
+            self.reset()
+        return result
+
+
+    def snapshot(self, reset=False):
+        """
+        Returns the aggregates sorted by total time, heaviest first.
+        """
+        with self.lock:
+            return self.build_snapshot(reset)
+
+
+    def snapshot_if_due(self, interval):
+        """
+        Returns a snapshot and starts a new period if the current one is at
+        least `interval` seconds old, otherwise None. Only one thread gets the
+        snapshot of a given period.
+        """
+        with self.lock:
+            elapsed = datetime.datetime.now() - self.start_time
+            if elapsed.total_seconds() < interval:
+                return None
+            return self.build_snapshot(True)
+
+
+query_aggregator = QueryAggregator()
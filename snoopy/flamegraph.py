@@ -0,0 +1,208 @@
+from xml.sax.saxutils import escape
+
+import hashlib
+
+from snoopy.profile_stats import collapse_pstats, to_pstats
+from snoopy.trace import Trace, TRACE_THRESHOLD
+
+
+WEIGHT_WALL = 'wall'
+WEIGHT_QUERY = 'query'
+
+# Collapsed stacks are weighted in microseconds
+WEIGHT_SCALE = 1000000
+
+
+
+def get_call_label(node):
+    return "%s::%s" % (node.module, node.function)
+
+
+def get_call_weight(node, weight):
+    if weight == WEIGHT_QUERY:
+        return sum(query['query_time'] or 0.0 for query in node.queries)
+    if node.total_time is None:
+        # Never returned, e.g. the capture ended inside it
+        return 0.0
+    children_time = sum(child.total_time for child in node.next)
+    return max(node.total_time - children_time, 0.0)
+
+
+def add_stack(stacks, stack, value):
+    if value > 0:
+        stacks[stack] = stacks.get(stack, 0.0) + value
+
+
+def collapse_trace(trace, weight=WEIGHT_WALL):
+    """
+    Folds the `FunctionCall` tree of a `Trace` into collapsed stacks
+    (`{'a;b;c': seconds}`). With `WEIGHT_WALL` each stack gets the self time
+    of its calls, with `WEIGHT_QUERY` the time of the SQL queries attributed
+    to them.
+    """
+    stacks = {}
+    pending = [(root, get_call_label(root)) for root in reversed(trace.roots)]
+    while pending:
+        node, stack = pending.pop()
+        add_stack(stacks, stack, get_call_weight(node, weight))
+        for child in reversed(node.next):
+            pending.append((child, stack + ';' + get_call_label(child)))
+    return stacks
+
+
+def collapse_call_tree(nodes, weight=WEIGHT_WALL):
+    """
+    Collapsed stacks of a calling context tree (`profiler_tree`), weighted by
+    the self time of each node or by the time of the queries it ran.
+    """
+    stacks = {}
+    paths = []
+    for node in nodes:
+        label = node['key'].rsplit(':', 1)[0]
+        if node['parent'] is not None:
+            label = paths[node['parent']] + ';' + label
+        paths.append(label)
+        add_stack(stacks, label, node['query_time'] if weight == WEIGHT_QUERY else node['self_time'])
+    return stacks
+
+
+def collapse_samples(samples):
+    """
+    Weights the folded stacks of the sampling profiler by the sampling
+    interval.
+    """
+    interval = samples['interval']
+    return dict((stack, count * interval) for stack, count in samples['stacks'].items())
+
+
+def format_collapsed(stacks):
+    """
+    Returns the stacks in the collapsed format read by flamegraph.pl,
+    speedscope and friends: `a;b;c <weight in microseconds>` per line.
+    """
+    lines = []
+    for stack in sorted(stacks):
+        value = int(round(stacks[stack] * WEIGHT_SCALE))
+        if value > 0:
+            lines.append('%s %d' % (stack, value))
+    return '\n'.join(lines) + '\n'
+
+
+class FlameNode(object):
+    __slots__ = ('name', 'value', 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0.0
+        self.children = {}
+
+
+def build_flame_tree(stacks):
+    root = FlameNode('all')
+    for stack, value in stacks.items():
+        if value <= 0:
+            continue
+        root.value += value
+        node = root
+        for name in stack.split(';'):
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = FlameNode(name)
+            child.value += value
+            node = child
+    return root
+
+
+def get_color(name):
+    # Stable warm colors, similar functions get similar colors
+    digest = hashlib.md5(name.split('::')[-1].encode('utf-8')).digest()
+    value = bytearray(digest)
+    return 'rgb(%d,%d,%d)' % (205 + value[0] % 50, 80 + value[1] % 150, value[2] % 60)
+
+
+def render_svg(stacks, title='Flame Graph', width=1200, frame_height=16, min_width=0.1, unit='s'):
+    """
+    Renders collapsed stacks as a self-contained SVG flame graph, root at the
+    bottom. Hovering a frame shows its name, time and share of the total.
+    """
+    root = build_flame_tree(stacks)
+    rectangles = []
+    max_depth = [0]
+
+    def layout(node, x, depth):
+        node_width = node.value / root.value * width if root.value else 0
+        if node_width < min_width:
+            return
+        rectangles.append((node, x, depth, node_width))
+        max_depth[0] = max(max_depth[0], depth)
+        child_x = x
+        for name in sorted(node.children):
+            child = node.children[name]
+            layout(child, child_x, depth + 1)
+            child_x += child.value / root.value * width
+
+    layout(root, 0.0, 0)
+
+    top_margin = frame_height * 2
+    height = (max_depth[0] + 1) * frame_height + top_margin + frame_height
+    characters_per_pixel = 1 / 7.0
+    lines = [
+        '<?xml version="1.0" standalone="no"?>',
+        '<svg version="1.1" width="%d" height="%d" xmlns="http://www.w3.org/2000/svg">' % (width, height),
+        '<style>text { font-family: Verdana, sans-serif; font-size: 12px; } '
+        'rect:hover { stroke: black; stroke-width: 0.5; }</style>',
+        '<rect x="0" y="0" width="%d" height="%d" fill="rgb(250,250,238)"/>' % (width, height),
+        '<text x="%d" y="%d" text-anchor="middle" style="font-size: 16px">%s</text>' % (
+            width / 2, frame_height + 4, escape(title)),
+    ]
+    for node, x, depth, node_width in rectangles:
+        y = height - (depth + 1) * frame_height - frame_height / 2
+        share = node.value / root.value * 100
+        tooltip = '%s (%0.6f %s, %0.2f%%)' % (node.name, node.value, unit, share)
+        lines.append('<g><title>%s</title>' % escape(tooltip))
+        lines.append('<rect x="%0.2f" y="%d" width="%0.2f" height="%d" fill="%s" rx="2" ry="2"/>' % (
+            x, y, node_width, frame_height - 1, get_color(node.name)))
+        max_characters = int(node_width * characters_per_pixel)
+        if max_characters >= 3:
+            label = node.name
+            if len(label) > max_characters:
+                label = label[:max_characters - 2] + '..'
+            lines.append('<text x="%0.2f" y="%d">%s</text>' % (x + 3, y + frame_height - 4, escape(label)))
+        lines.append('</g>')
+    lines.append('</svg>')
+    return '\n'.join(lines) + '\n'
+
+
+SOURCE_TRACE = 'trace'
+SOURCE_CPROFILE = 'cprofile'
+SOURCE_SAMPLES = 'samples'
+
+
+def collapse_request_data(request_data, source=SOURCE_TRACE, weight=WEIGHT_WALL, trace_threshold=TRACE_THRESHOLD):
+    """
+    Returns the collapsed stacks of a captured request, from the builtin
+    profiler traces, the cProfile data or the sampling profiler. Only builtin traces can be weighted by query
+    time, the other sources don't know when queries ran.
+    """
+    if source != SOURCE_TRACE and weight != WEIGHT_WALL:
+        raise ValueError('Only the builtin profiler traces can be weighted by %s time' % weight)
+
+    if source == SOURCE_TRACE:
+        if request_data.get('profiler_tree'):
+            return collapse_call_tree(request_data['profiler_tree'], weight)
+        if not request_data.get('profiler_traces'):
+            raise ValueError('No builtin profiler traces in this capture (SNOOPY_USE_BUILTIN_PROFILER)')
+        trace = Trace(request_data['profiler_traces'], request_data.get('queries') or [], threshold=trace_threshold)
+        return collapse_trace(trace, weight)
+    if source == SOURCE_CPROFILE:
+        if 'profiler_collapsed_stacks' in request_data:
+            return request_data['profiler_collapsed_stacks']
+        if 'profiler_stats' in request_data:
+            # Only has the whole call graph if the table was neither filtered nor cut
+            return collapse_pstats(to_pstats(request_data['profiler_stats']))
+        raise ValueError('No cProfile data in this capture (SNOOPY_USE_CPROFILE)')
+    if source == SOURCE_SAMPLES:
+        if 'profiler_samples' not in request_data:
+            raise ValueError('No samples in this capture (SNOOPY_USE_SAMPLING_PROFILER)')
+        return collapse_samples(request_data['profiler_samples'])
+    raise ValueError('Unknown source %s' % source)
@@ -0,0 +1,93 @@
+import fnmatch
+
+
+DEFAULT_EXCLUDED_MODULES = ('snoopy', 'snoopy.*')
+
+
+class FrameFilter(object):
+    """
+    Decides whether the builtin profiler should record events for a frame.
+
+    The decision only depends on the code, so it is made once per code
+    location (file, first line and name) and memoized along with the trace
+    key prefix (`module::function:`). Lookups are counted so the savings can
+    be reported with the request data.
+    """
+    def __init__(self, relevant_apps, include_modules=(), exclude_modules=DEFAULT_EXCLUDED_MODULES,
+                 max_size=10000):
+        self.relevant_apps = tuple(relevant_apps)
+        self.include_modules = tuple(include_modules or ())
+        self.exclude_modules = tuple(exclude_modules or ())
+        self.max_size = max_size
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def matches_any(self, module, patterns):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(module, pattern):
+                return True
+        return False
+
+
+    def is_relevant_module(self, module):
+        if module is None:
+            return False
+        if self.matches_any(module, self.exclude_modules):
+            return False
+        if self.include_modules:
+            return self.matches_any(module, self.include_modules)
+        # Snoopy itself is left out by the default `exclude_modules`
+        return module.startswith(self.relevant_apps)
+
+
+    def get_key_prefix(self, frame):
+        """
+        Returns the trace key prefix for the frame, or None if it should not be tracked.
+        """
+        code = frame.f_code
+        # Not the code object itself: code objects with the same body compare
+        # equal even when they come from different modules
+        location = (code.co_filename, code.co_firstlineno, code.co_name)
+        prefix = self.cache.get(location, False)
+        if prefix is not False:
+            self.hits += 1
+            return prefix
+
+        self.misses += 1
+        module = frame.f_globals.get('__name__')
+        prefix = None
+        if self.is_relevant_module(module) and not code.co_name.startswith("_"):
+            prefix = "%s::%s:" % (module, code.co_name)
+
+        if len(self.cache) >= self.max_size:
+            self.cache.clear()
+        self.cache[location] = prefix
+        return prefix
+
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cache_size': len(self.cache),
+            'max_size': self.max_size
+        }
+
+
+_frame_filters = {}
+
+
+def get_frame_filter(relevant_apps, include_modules=(), exclude_modules=DEFAULT_EXCLUDED_MODULES,
+                     max_size=10000):
+    """
+    Filters are shared by every request in the process so the memo survives
+    between requests. A new one is only built if the configuration changes.
+    """
+    config = (tuple(relevant_apps), tuple(include_modules or ()), tuple(exclude_modules or ()), max_size)
+    frame_filter = _frame_filters.get(config)
+    if frame_filter is None:
+        frame_filter = FrameFilter(*config)
+        _frame_filters[config] = frame_filter
+    return frame_filter
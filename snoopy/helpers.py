@@ -1,3 +1,4 @@
+import calendar
 import datetime
 import importlib
 import os
@@ -23,3 +24,23 @@ def get_app_root():
     settings_path = settings_module.__path__[0]
     app_root = os.path.abspath(os.path.join(settings_path, os.pardir))
     return app_root
+
+
+_day_offsets = {}
+
+
+def parse_isoformat(value):
+    """
+    Fast parser for the output of `datetime.isoformat()` on naive datetimes.
+    Returns seconds since the epoch as a float, treating the value as UTC.
+    """
+    day = value[:10]
+    offset = _day_offsets.get(day)
+    if offset is None:
+        offset = calendar.timegm((int(day[0:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+        _day_offsets[day] = offset
+    seconds = offset + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+    if len(value) > 20:
+        # isoformat() leaves out the microseconds when they are 0
+        seconds += int(value[20:26]) / 1000000.0
+    return seconds
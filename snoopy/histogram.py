@@ -0,0 +1,248 @@
+import atexit
+import datetime
+import logging
+import math
+import os
+import threading
+
+
+logger = logging.getLogger('snoopy')
+
+
+class LogHistogram(object):
+    """
+    Mergeable histogram with logarithmically sized buckets.
+
+    Values below `min_value` go to bucket 0. Above that, every power of two
+    is split into `sub_buckets` buckets, so the relative error of a
+    percentile is at most `2 ** (1 / sub_buckets) - 1` (about 4.4% with the
+    default of 16). Two histograms with the same layout are merged by adding
+    their bucket counts.
+    """
+    def __init__(self, min_value=0.000001, sub_buckets=16, bucket_count=512):
+        self.min_value = min_value
+        self.sub_buckets = sub_buckets
+        self.bucket_count = bucket_count
+        self.buckets = [0] * bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+
+    def get_layout(self):
+        return (self.min_value, self.sub_buckets, self.bucket_count)
+
+
+    def get_bucket_index(self, value):
+        if value < self.min_value:
+            return 0
+        index = int(math.log(value / self.min_value, 2) * self.sub_buckets) + 1
+        return min(index, self.bucket_count - 1)
+
+
+    def get_bucket_upper_bound(self, index):
+        if index == 0:
+            return self.min_value
+        return self.min_value * 2 ** (float(index) / self.sub_buckets)
+
+
+    def add(self, value):
+        self.buckets[self.get_bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+
+    def merge(self, other):
+        if other.get_layout() != self.get_layout():
+            raise ValueError('Cannot merge histograms with different bucket layouts')
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        rank = int(math.ceil(percent / 100.0 * self.count))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.get_bucket_upper_bound(index), self.max)
+        return self.max
+
+
+    def to_representation(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'layout': self.get_layout(),
+            # Sparse, only the buckets that were hit
+            'buckets': dict((index, count) for index, count in enumerate(self.buckets) if count)
+        }
+
+
+    @staticmethod
+    def from_representation(data):
+        min_value, sub_buckets, bucket_count = data['layout']
+        histogram = LogHistogram(min_value, sub_buckets, bucket_count)
+        for index, count in data['buckets'].items():
+            histogram.buckets[int(index)] = count
+        histogram.count = data['count']
+        histogram.total = data['sum']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+
+def new_view_histograms():
+    return {
+        'request_time': LogHistogram(),
+        'sql_time': LogHistogram(),
+        'query_count': LogHistogram(min_value=1)
+    }
+
+
+class ViewMetrics(object):
+    """
+    Process wide request time, SQL time and query count histograms per
+    (view, method). Cheap enough to feed from every request.
+
+    Once `start_flushing` was called, snapshots are saved from a background
+    thread every `interval` seconds, whether requests keep coming or not,
+    and the last one at exit.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_interval = None
+        self.flush_output = None
+        self.flush_thread = None
+        self.flush_pid = None
+        self.stop_event = threading.Event()
+        self.registered_exit = False
+        self.reset()
+
+
+    def reset(self):
+        self.views = {}
+        self.start_time = datetime.datetime.now()
+
+
+    def add(self, view, method, request_time, sql_time, query_count):
+        with self.lock:
+            histograms = self.views.get((view, method))
+            if histograms is None:
+                histograms = self.views[(view, method)] = new_view_histograms()
+            histograms['request_time'].add(request_time)
+            histograms['sql_time'].add(sql_time)
+            histograms['query_count'].add(query_count)
+
+
+    def build_snapshot(self, reset):
+        # Must be called with the lock held
+        views = []
+        for (view, method), histograms in self.views.items():
+            views.append({
+                'view': view,
+                'method': method,
+                'request_time': histograms['request_time'].to_representation(),
+                'sql_time': histograms['sql_time'].to_representation(),
+                'query_count': histograms['query_count'].to_representation()
+            })
+        result = {
+            'record_type': 'view_metrics',
+            'pid': os.getpid(),
+            'start_time': self.start_time,
+            'end_time': datetime.datetime.now(),
+            'views': views
+        }
+        if reset:
+            self.reset()
+        return result
+
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            return self.build_snapshot(reset)
+
+
+    def snapshot_if_due(self, interval):
+        with self.lock:
+            elapsed = datetime.datetime.now() - self.start_time
+            if elapsed.total_seconds() < interval:
+                return None
+            return self.build_snapshot(True)
+
+
+    def start_flushing(self, interval, output):
+        """
+        Starts the thread calling `output` with the snapshots. Threads do not
+        survive a fork, so it is (re)started in whichever process ends up
+        serving requests, without the histograms of the parent.
+        """
+        with self.lock:
+            if self.flush_pid == os.getpid():
+                return
+            if self.flush_pid is not None:
+                self.reset()
+            self.flush_pid = os.getpid()
+            self.flush_interval = interval
+            self.flush_output = output
+            self.stop_event = threading.Event()
+            self.flush_thread = threading.Thread(target=self.run_flusher, name='snoopy-view-metrics')
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+            if not self.registered_exit:
+                atexit.register(self.shutdown)
+                self.registered_exit = True
+
+
+    def run_flusher(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                elapsed = (datetime.datetime.now() - self.start_time).total_seconds()
+            if elapsed < self.flush_interval:
+                self.stop_event.wait(self.flush_interval - elapsed)
+            else:
+                self.flush(self.flush_interval)
+
+
+    def flush(self, interval=0):
+        """
+        Saves a snapshot and starts the histograms over, if `interval` seconds
+        have passed since the last one. Empty snapshots are not saved.
+        """
+        if self.flush_pid != os.getpid():
+            return
+        snapshot = self.snapshot_if_due(interval)
+        if snapshot is None or not snapshot['views']:
+            return
+        try:
+            self.flush_output(snapshot)
+        except Exception:
+            logger.exception('Snoopy failed to save view metrics')
+
+
+    def shutdown(self):
+        self.stop_event.set()
+        if self.flush_pid == os.getpid():
+            self.flush_thread.join(1.0)
+        self.flush()
+
+
+view_metrics = ViewMetrics()
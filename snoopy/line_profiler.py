@@ -0,0 +1,221 @@
+import dis
+import importlib
+import inspect
+import linecache
+import logging
+import threading
+import timeit
+
+
+logger = logging.getLogger('snoopy')
+
+# The instruction a generator or coroutine is stopped at when it yields or
+# awaits (YIELD_FROM up to Python 3.10)
+YIELD_OPCODES = frozenset(dis.opmap[name] for name in ('YIELD_VALUE', 'YIELD_FROM') if name in dis.opmap)
+
+
+def resolve_function_codes(path):
+    """
+    Returns the code objects for a dotted path: a function, a method
+    (`module.Class.method`) or a class, for all the functions defined in its
+    body. Decorated functions are unwrapped when the decorator used
+    `functools.wraps`.
+    """
+    parts = path.split('.')
+    target = None
+    for index in range(len(parts) - 1, 0, -1):
+        try:
+            target = importlib.import_module('.'.join(parts[:index]))
+        except ImportError:
+            continue
+        for name in parts[index:]:
+            target = getattr(target, name, None)
+        break
+    if target is None:
+        raise ValueError('Cannot import %s' % path)
+
+    if inspect.isclass(target):
+        functions = list(vars(target).values())
+    else:
+        functions = [target]
+
+    codes = []
+    for function in functions:
+        # staticmethod / classmethod / unbound methods
+        function = getattr(function, '__func__', function)
+        while hasattr(function, '__wrapped__'):
+            function = function.__wrapped__
+        code = getattr(function, '__code__', None)
+        if code is not None:
+            codes.append(code)
+    if not codes:
+        raise ValueError('%s is not a function, method or class' % path)
+    return codes
+
+
+_target_codes = {}
+_target_codes_lock = threading.Lock()
+
+
+def get_target_codes(paths):
+    """
+    Resolves `SNOOPY_LINE_PROFILER_FUNCTIONS` once per process. Paths that
+    can't be resolved are logged and left out.
+    """
+    key = tuple(paths)
+    codes = _target_codes.get(key)
+    if codes is None:
+        with _target_codes_lock:
+            codes = _target_codes.get(key)
+            if codes is None:
+                codes = set()
+                for path in paths:
+                    try:
+                        codes.update(resolve_function_codes(path))
+                    except ValueError as error:
+                        logger.warning('Snoopy line profiler: %s', error)
+                codes = _target_codes[key] = frozenset(codes)
+    return codes
+
+
+def is_suspended(frame):
+    """
+    Tells, on a return event, a generator or coroutine that yields or awaits
+    from a function that returns.
+    """
+    if frame.f_lasti < 0:
+        return False
+    opcode = frame.f_code.co_code[frame.f_lasti]
+    if not isinstance(opcode, int):
+        # Python 2
+        opcode = ord(opcode)
+    return opcode in YIELD_OPCODES
+
+
+class ChainedTrace(object):
+    """
+    Local trace function running the one of the line profiler and the one of
+    the tracer installed before it (coverage, a debugger) in the same frame.
+    """
+    __slots__ = ('first', 'second')
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+
+    def __call__(self, frame, event, arg):
+        if self.first is not None:
+            self.first = self.first(frame, event, arg)
+        if self.second is not None:
+            self.second = self.second(frame, event, arg)
+        if self.first is None and self.second is None:
+            return None
+        return self
+
+
+class LineProfile(object):
+    """
+    Per line hit counts and times of the target functions, for a single
+    request.
+
+    `trace_call` is meant to be called by the `sys.settrace` function: it
+    only returns a local trace function for the frames running one of the
+    target code objects, every other call costs one check. As with
+    line_profiler, the time of a line includes the time of the functions it
+    calls.
+
+    Generators and coroutines coming back after a yield or an await are not
+    counted as new calls, and the time they spend suspended is not counted.
+    """
+    def __init__(self, codes):
+        self.codes = codes
+        self.timer = timeit.default_timer
+        # (code, line number) -> [hits, time]
+        self.lines = {}
+        # code -> [calls, time]
+        self.calls = {}
+        # frame -> [current line number, line start time, call or resume time]
+        self.frames = {}
+
+
+    def trace_call(self, frame, event, arg):
+        if event != 'call' or frame.f_code not in self.codes:
+            return None
+        now = self.timer()
+        state = self.frames.get(frame)
+        if state is None:
+            call_stats = self.calls.get(frame.f_code)
+            if call_stats is None:
+                call_stats = self.calls[frame.f_code] = [0, 0.0]
+            call_stats[0] += 1
+            self.frames[frame] = [None, now, now]
+        else:
+            # Resumed, the line it stopped on goes on
+            state[1] = now
+            state[2] = now
+        return self.trace_line
+
+
+    def trace_line(self, frame, event, arg):
+        now = self.timer()
+        state = self.frames.get(frame)
+        if state is None:
+            return self.trace_line
+        code = frame.f_code
+        if state[0] is not None:
+            self.lines[(code, state[0])][1] += now - state[1]
+        if event == 'line':
+            line_number = frame.f_lineno
+            line_stats = self.lines.get((code, line_number))
+            if line_stats is None:
+                line_stats = self.lines[(code, line_number)] = [0, 0.0]
+            line_stats[0] += 1
+            state[0] = line_number
+            state[1] = now
+        elif event == 'return':
+            self.calls[code][1] += now - state[2]
+            if not is_suspended(frame):
+                del self.frames[frame]
+        return self.trace_line
+
+
+    def to_representation(self):
+        functions = {}
+        for code, (calls, total_time) in self.calls.items():
+            functions[code] = {
+                'function': code.co_name,
+                'file_name': code.co_filename,
+                'first_line_number': code.co_firstlineno,
+                'calls': calls,
+                'total_time': total_time,
+                'lines': []
+            }
+        for (code, line_number), (hits, line_time) in sorted(
+                self.lines.items(), key=lambda item: item[0][1]):
+            functions[code]['lines'].append({
+                'line_number': line_number,
+                'hits': hits,
+                'time': line_time,
+                'line': linecache.getline(code.co_filename, line_number).rstrip()
+            })
+        return sorted(functions.values(), key=lambda function: function['total_time'], reverse=True)
+
+
+def format_line_profile(line_profile):
+    """
+    Renders the `line_profile` of a capture as line_profiler does.
+    """
+    lines = []
+    for function in line_profile:
+        lines.append('%s:%d %s, %d calls, %0.6f seconds' % (
+            function['file_name'], function['first_line_number'], function['function'],
+            function['calls'], function['total_time']))
+        lines.append('%8s %8s %12s %12s %8s  %s' % ('Line', 'Hits', 'Time', 'Per hit', '% Time', 'Line contents'))
+        for line in function['lines']:
+            lines.append('%8d %8d %12.6f %12.6f %8.1f  %s' % (
+                line['line_number'], line['hits'], line['time'], line['time'] / line['hits'],
+                line['time'] / function['total_time'] * 100 if function['total_time'] else 0.0,
+                line['line']))
+        lines.append('')
+    return '\n'.join(lines)
@@ -1,18 +1,96 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 import json
-from optparse import make_option
 
-from snoopy.trace_analyzer import TraceAnalyzer
+from snoopy.batch_analyzer import BatchAnalyzer
+from snoopy.flamegraph import (collapse_request_data, format_collapsed, render_svg,
+                               WEIGHT_WALL, WEIGHT_QUERY, SOURCE_TRACE, SOURCE_CPROFILE, SOURCE_SAMPLES)
+from snoopy.profile_stats import (merge_capture_profiles, format_profile_table,
+                                  SORT_CUMULATIVE, SORT_TOTTIME, SORT_NCALLS)
+from snoopy.trace import TRACE_THRESHOLD
+from snoopy.trace_analyzer import TraceAnalyzer, StreamingTraceAnalyzer
 
 
 class Command(BaseCommand):
-    option_list = BaseCommand.option_list + (
-        make_option('--trace-file-path',
-                    help='trace output file location'),
-    )
+    def add_arguments(self, parser):
+        parser.add_argument('--trace-file-path',
+                            help='trace output file location')
+        parser.add_argument('--stream', action='store_true', default=False,
+                            help='read the trace file incrementally and only report aggregates. '
+                                 'Use this for captures too big to fit in memory')
+        parser.add_argument('--batch', action='append', default=[],
+                            help='directory or glob of captures to aggregate per endpoint. '
+                                 'Can be given several times')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='number of worker processes for --batch, defaults to the number of CPUs')
+        parser.add_argument('--json', action='store_true', dest='as_json', default=False,
+                            help='print --batch / --profile-report results as JSON instead of a table')
+        parser.add_argument('--collapsed',
+                            help='write the collapsed stacks of the capture to this file, - for stdout')
+        parser.add_argument('--flamegraph',
+                            help='write an SVG flame graph of the capture to this file')
+        parser.add_argument('--source', default=SOURCE_TRACE,
+                            choices=[SOURCE_TRACE, SOURCE_CPROFILE, SOURCE_SAMPLES],
+                            help='stacks to use for --collapsed / --flamegraph: trace (builtin profiler, default), '
+                                 'cprofile or samples')
+        parser.add_argument('--weight', default=WEIGHT_WALL, choices=[WEIGHT_WALL, WEIGHT_QUERY],
+                            help='weight stacks by wall time (default) or by SQL query time')
+        parser.add_argument('--trace-threshold', type=float, default=TRACE_THRESHOLD,
+                            help='leave calls that took this many seconds or less out of the call tree')
+        parser.add_argument('--profile-report', action='append', default=[],
+                            help='directory or glob of captures whose cProfile data is merged into one '
+                                 'table of hot functions. Can be given several times')
+        parser.add_argument('--top', type=int, default=30,
+                            help='number of functions in --profile-report (default: 30)')
+        parser.add_argument('--sort', default=SORT_TOTTIME,
+                            choices=[SORT_TOTTIME, SORT_CUMULATIVE, SORT_NCALLS],
+                            help='--profile-report order: tottime (default), cumulative or ncalls')
+
+    def handle(self, trace_file_path=None, stream=False, batch=None, processes=None, as_json=False,
+               collapsed=None, flamegraph=None, source=SOURCE_TRACE, weight=WEIGHT_WALL,
+               profile_report=None, top=30, sort=SORT_TOTTIME, trace_threshold=TRACE_THRESHOLD, **kwargs):
+        if profile_report:
+            table = merge_capture_profiles(profile_report).get_table(top=top, sort=sort)
+            self.stdout.write(json.dumps(table, indent=4) if as_json else format_profile_table(table))
+            return
+
+        if batch:
+            analyzer = BatchAnalyzer(batch, processes=processes)
+            try:
+                analyzer.analyze()
+            except ImportError as error:
+                raise CommandError(str(error))
+            self.stdout.write(analyzer.to_json() if as_json else analyzer.to_table())
+            return
+
+        if stream:
+            with open(trace_file_path) as trace_file:
+                StreamingTraceAnalyzer(trace_file).analyze()
+            return
 
-    def handle(self, trace_file_path, **kwargs):
         request_data = json.loads(open(trace_file_path).read())
-        analyzer = TraceAnalyzer(request_data)
+        if collapsed or flamegraph:
+            self.export_stacks(request_data, collapsed, flamegraph, source, weight, trace_threshold)
+            return
+
+        analyzer = TraceAnalyzer(request_data, trace_threshold=trace_threshold)
         analyzer.analyze()
+
+
+    def export_stacks(self, request_data, collapsed, flamegraph, source, weight, trace_threshold):
+        try:
+            stacks = collapse_request_data(request_data, source, weight, trace_threshold)
+        except ValueError as error:
+            raise CommandError(str(error))
+
+        if collapsed == '-':
+            self.stdout.write(format_collapsed(stacks), ending='')
+        elif collapsed:
+            with open(collapsed, 'w') as collapsed_file:
+                collapsed_file.write(format_collapsed(stacks))
+
+        if flamegraph:
+            title = '%s %s (%s, %s time)' % (
+                request_data.get('method'), request_data.get('request'), source, weight)
+            with open(flamegraph, 'w') as flamegraph_file:
+                flamegraph_file.write(render_svg(stacks, title=title))
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import datetime
+import json
+
+from snoopy.core import Snoopy
+from snoopy.shared_metrics import SharedMetrics, build_snapshot
+
+
+def format_time(value):
+    return '-' if value is None else '%0.4f' % value
+
+
+def format_table(columns, rows):
+    table = [[title for title, _ in columns]]
+    for row in rows:
+        table.append([formatter(row) for _, formatter in columns])
+    widths = [max(len(line[index]) for line in table) for index in range(len(columns))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths)) for line in table)
+
+
+class Command(BaseCommand):
+    help = 'Prints the per host view and query statistics shared by the workers (SNOOPY_SHARED_METRICS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', action='append', default=[],
+                            help='shared metrics file, defaults to SNOOPY_SHARED_METRICS_PATH. '
+                                 'Can be given several times to merge the files of several apps')
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help='start the counters over after reading them')
+        parser.add_argument('--top', type=int, default=20,
+                            help='number of views and queries to list (default: 20)')
+        parser.add_argument('--json', action='store_true', dest='as_json', default=False,
+                            help='print the snapshot as JSON')
+
+    def handle(self, path=None, reset=False, top=20, as_json=False, **kwargs):
+        slot_count = Snoopy.get_setting('SHARED_METRICS_SLOTS')
+        paths = path or [Snoopy.get_setting('SHARED_METRICS_PATH')]
+        try:
+            # Only a reset writes to the files, and they are never created here
+            snapshot = build_snapshot([SharedMetrics(metrics_path, slot_count, create=False, read_only=not reset)
+                                       for metrics_path in paths], reset=reset)
+        except (RuntimeError, ValueError) as error:
+            raise CommandError(str(error))
+
+        if as_json:
+            self.stdout.write(json.dumps(snapshot, indent=4))
+            return
+
+        self.stdout.write('Since %s, %d keys dropped (no free slot)\n' % (
+            datetime.datetime.fromtimestamp(snapshot['start_time']).isoformat(), snapshot['dropped_keys']))
+        self.stdout.write(format_table((
+            ('View', lambda row: row['view']),
+            ('Method', lambda row: row['method']),
+            ('Count', lambda row: '%d' % row['count']),
+            ('Total', lambda row: format_time(row['total_time'])),
+            ('p50', lambda row: format_time(row['p50'])),
+            ('p95', lambda row: format_time(row['p95'])),
+            ('p99', lambda row: format_time(row['p99'])),
+            ('SQL %', lambda row: '%0.1f' % (row['sql_time_share'] * 100)),
+            ('Queries', lambda row: '%0.1f' % row['mean_query_count']),
+        ), snapshot['views'][:top]))
+        self.stdout.write('')
+        self.stdout.write(format_table((
+            ('Fingerprint', lambda row: row['fingerprint']),
+            ('Count', lambda row: '%d' % row['count']),
+            ('Total', lambda row: format_time(row['total_time'])),
+            ('p50', lambda row: format_time(row['p50'])),
+            ('p99', lambda row: format_time(row['p99'])),
+            ('Query', lambda row: row['query'][:100]),
+        ), snapshot['queries'][:top]))
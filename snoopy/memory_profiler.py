@@ -0,0 +1,215 @@
+import gc
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4
+    tracemalloc = None
+
+
+SNOOPY_ROOT = os.path.dirname(os.path.abspath(__file__))
+OTHER_SITE = '<other>'
+
+# ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+MAX_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def get_max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAX_RSS_UNIT
+
+
+def get_allocation_site(traceback, app_root):
+    """
+    Returns `file:line` for the innermost frame of the app's own code in a
+    `tracemalloc.Traceback`, the innermost frame with `app_root` unset, and
+    `OTHER_SITE` when the app code didn't take part in the allocation.
+    """
+    for frame in reversed(traceback):
+        if frame.filename.startswith(SNOOPY_ROOT):
+            continue
+        if not app_root or frame.filename.startswith(app_root):
+            return "%s:%d" % (frame.filename, frame.lineno)
+    return OTHER_SITE
+
+
+class MemoryCollector(object):
+    """
+    Memory and garbage collector activity for a single request.
+    """
+    def __init__(self, trace_allocations, track_gc, track_rusage=False):
+        self.trace_allocations = trace_allocations
+        self.track_gc = track_gc
+        self.track_rusage = track_rusage
+        self.start_max_rss = 0
+        self.max_rss_growth = 0
+        self.start_gc_count = None
+        self.end_gc_count = None
+        self.start_snapshot = None
+        self.start_memory = 0
+        self.peak_memory = 0
+        self.gc_collections = [0, 0, 0]
+        self.gc_collected = 0
+        self.gc_uncollectable = 0
+        self.gc_pause_time = 0.0
+        self.gc_max_pause_time = 0.0
+
+
+    def add_collection(self, generation, pause_time, info):
+        self.gc_collections[generation] += 1
+        self.gc_collected += info.get('collected', 0)
+        self.gc_uncollectable += info.get('uncollectable', 0)
+        self.gc_pause_time += pause_time
+        self.gc_max_pause_time = max(self.gc_max_pause_time, pause_time)
+
+
+    def get_top_allocations(self, snapshot, app_root, top):
+        # Leave out the memory of tracemalloc itself
+        filters = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        snapshot = snapshot.filter_traces(filters)
+        start_snapshot = self.start_snapshot.filter_traces(filters)
+        sites = {}
+        for stat in snapshot.compare_to(start_snapshot, 'traceback'):
+            if stat.size_diff <= 0:
+                continue
+            site = get_allocation_site(stat.traceback, app_root)
+            row = sites.get(site)
+            if row is None:
+                row = sites[site] = {'site': site, 'size': 0, 'count': 0}
+            row['size'] += stat.size_diff
+            row['count'] += max(stat.count_diff, 0)
+        rows = sorted(sites.values(), key=lambda row: row['size'], reverse=True)
+        if top:
+            rows = rows[:top]
+        return rows
+
+
+    def to_representation(self, end_memory, snapshot=None, app_root=None, top=None):
+        result = {}
+        if self.track_gc:
+            result['gc'] = {
+                'collections': self.gc_collections,
+                'collected': self.gc_collected,
+                'uncollectable': self.gc_uncollectable,
+                'pause_time': self.gc_pause_time,
+                'max_pause_time': self.gc_max_pause_time,
+            }
+        if self.trace_allocations:
+            result['peak_memory'] = max(self.peak_memory - self.start_memory, 0)
+            result['net_allocated'] = end_memory - self.start_memory
+            if snapshot is not None:
+                result['top_allocations'] = self.get_top_allocations(snapshot, app_root, top)
+        if self.track_rusage:
+            result['max_rss_growth'] = self.max_rss_growth
+            result['gc_count'] = {'start': self.start_gc_count, 'end': self.end_gc_count}
+        return result
+
+
+class MemoryProfiler(object):
+    """
+    Process wide switch for tracemalloc and the `gc.callbacks` hook.
+
+    Both are global to the interpreter, so tracing is started with the first
+    request that needs it and stopped with the last one. The tracemalloc peak
+    is process wide too: with requests served concurrently, it is the peak
+    of all of them. Garbage collections stop every thread, so their pauses
+    are added to every running request.
+
+    Without tracemalloc (Python < 3.4) no allocations are recorded and without
+    `gc.callbacks` (Python < 3.3) no garbage collections are. When neither is
+    there (Python 2.7), the growth of the process' maximum resident set size
+    and `gc.get_count()` at the start and end of the request are recorded
+    instead. The maximum RSS only grows when the process reaches a new peak,
+    so it says which requests pushed memory up, not how much they allocated.
+    """
+    def __init__(self):
+        self.collectors = set()
+        self.lock = threading.Lock()
+        self.tracing_users = 0
+        self.started_tracing = False
+        self.gc_start = None
+
+
+    def has_gc_callbacks(self):
+        return hasattr(gc, 'callbacks')
+
+
+    def is_available(self):
+        return tracemalloc is not None or self.has_gc_callbacks() or resource is not None
+
+
+    def gc_callback(self, phase, info):
+        if phase == 'start':
+            self.gc_start = time.time()
+        elif self.gc_start is not None:
+            pause_time = time.time() - self.gc_start
+            self.gc_start = None
+            for collector in list(self.collectors):
+                collector.add_collection(info['generation'], pause_time, info)
+
+
+    def start(self, trace_allocations=True, traceback_limit=10):
+        trace_allocations = trace_allocations and tracemalloc is not None
+        track_gc = self.has_gc_callbacks()
+        # Nothing better on Python 2.7
+        track_rusage = not (trace_allocations or track_gc) and resource is not None
+        collector = MemoryCollector(trace_allocations, track_gc, track_rusage)
+        with self.lock:
+            if not self.collectors and collector.track_gc:
+                gc.callbacks.append(self.gc_callback)
+            self.collectors.add(collector)
+            if trace_allocations:
+                if self.tracing_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start(traceback_limit)
+                    self.started_tracing = True
+                self.tracing_users += 1
+                if hasattr(tracemalloc, 'reset_peak'):
+                    # Python 3.9+, otherwise the peak is the one since tracing started
+                    tracemalloc.reset_peak()
+        if trace_allocations:
+            collector.start_snapshot = tracemalloc.take_snapshot()
+            collector.start_memory = tracemalloc.get_traced_memory()[0]
+        if collector.track_rusage:
+            collector.start_max_rss = get_max_rss()
+            collector.start_gc_count = list(gc.get_count())
+        return collector
+
+
+    def stop(self, collector, app_root=None, top=None):
+        end_memory = 0
+        snapshot = None
+        if collector.trace_allocations:
+            end_memory, collector.peak_memory = tracemalloc.get_traced_memory()
+            if top != 0:
+                snapshot = tracemalloc.take_snapshot()
+        if collector.track_rusage:
+            collector.max_rss_growth = max(get_max_rss() - collector.start_max_rss, 0)
+            collector.end_gc_count = list(gc.get_count())
+
+        with self.lock:
+            self.collectors.discard(collector)
+            if not self.collectors and self.has_gc_callbacks() and self.gc_callback in gc.callbacks:
+                gc.callbacks.remove(self.gc_callback)
+            if collector.trace_allocations:
+                self.tracing_users -= 1
+                if self.tracing_users <= 0:
+                    self.tracing_users = 0
+                    if self.started_tracing:
+                        tracemalloc.stop()
+                        self.started_tracing = False
+
+        result = collector.to_representation(end_memory, snapshot, app_root, top)
+        collector.start_snapshot = None
+        return result
+
+
+memory_profiler = MemoryProfiler()
@@ -1,7 +1,43 @@
 from snoopy.core import Snoopy
 
+try:
+    from asgiref.sync import iscoroutinefunction
+except ImportError:
+    try:
+        from asyncio import iscoroutinefunction
+    except ImportError:
+        # Python 2
+        iscoroutinefunction = None
+
 
 class SnoopyProfilerMiddleware(object):
+    """
+    Can be used in `MIDDLEWARE_CLASSES` (old style) as well as in `MIDDLEWARE`.
+    When Django runs the middleware chain asynchronously (ASGI, Django 3.1+),
+    requests are profiled without switching to a thread, see
+    `snoopy.middleware_async`.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None):
+        Snoopy.check_configuration()
+        self.get_response = get_response
+        self.profile_async = None
+        if get_response is not None and iscoroutinefunction is not None and \
+                iscoroutinefunction(get_response):
+            # Only importable on Python 3
+            from snoopy.middleware_async import mark_coroutine, profile_request
+            mark_coroutine(self)
+            self.profile_async = profile_request
+
+    def __call__(self, request):
+        if self.profile_async is not None:
+            return self.profile_async(self, request)
+        self.process_request(request)
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
     def process_request(self, request):
         Snoopy.register_request(request)
 
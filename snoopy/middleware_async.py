@@ -0,0 +1,41 @@
+"""
+Async half of `SnoopyProfilerMiddleware`, only imported when Django hands the
+middleware an async `get_response`. Python 3 only.
+
+Request state lives in a ContextVar (see `snoopy.context`), so requests running
+concurrently on the event loop keep their queries and traces apart. The ORM
+runs in `sync_to_async` threads with a copy of the request's context, so its
+queries are recorded in the right request too.
+
+Hooks that are per thread (the builtin profiler, cProfile and the thread
+sampler) see every coroutine running on the event loop thread:
+
+- Builtin profiler events are sent to the request whose coroutine is running.
+  Code running in `sync_to_async` threads is not traced.
+- cProfile only runs for one request at a time per thread, the others get a
+  `profiler_skipped` note.
+- Stack samples of the event loop thread go to every request being served
+  on it.
+
+Output classes are called on the event loop, so use `SNOOPY_OUTPUT_ASYNC`.
+"""
+import asyncio
+
+from snoopy.core import Snoopy
+
+
+def mark_coroutine(middleware):
+    try:
+        from asgiref.sync import markcoroutinefunction
+    except ImportError:
+        # asgiref < 3.6
+        middleware._is_coroutine = asyncio.coroutines._is_coroutine
+    else:
+        markcoroutinefunction(middleware)
+
+
+async def profile_request(middleware, request):
+    Snoopy.register_request(request)
+    response = await middleware.get_response(request)
+    Snoopy.record_response(request, response)
+    return response
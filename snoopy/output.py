@@ -1,9 +1,26 @@
+import atexit
 import datetime
+import errno
 import json
+import logging
 import os
-import urllib2
+import socket
+import threading
+
+try:
+    import httplib
+    from urllib2 import Request, urlopen
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlparse
 
 from snoopy.helpers import get_app_root, default_json_serializer
+from snoopy.segments import SegmentWriter
+
+
+logger = logging.getLogger('snoopy')
 
 
 class OutputBase:
@@ -11,6 +28,31 @@ class OutputBase:
     def save_request_data(request_data):
         raise NotImplementedError()
 
+    @classmethod
+    def save_batch(cls, batch):
+        """
+        Used by the background output pipeline. Override this if the output
+        can ship several records more efficiently than one at a time.
+        """
+        for request_data in batch:
+            cls.save_request_data(request_data)
+
+    @classmethod
+    def close(cls):
+        """
+        Called at exit once the background output pipeline has been flushed.
+        """
+        pass
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Outputs that buffer records and ship them later return
+        `{'buffered': ..., 'sent': ..., 'failed': ...}` record counts here, so
+        the pipeline doesn't report a buffered record as sent.
+        """
+        return None
+
 
 class LogOutput(OutputBase):
     DEFAULT_FILE_PREFIX = 'snoopy_'
@@ -27,6 +69,53 @@ class LogOutput(OutputBase):
             output.write(result)
 
 
+class SegmentedLogOutput(OutputBase):
+    """
+    Appends one JSON line per request to rolling segment files in
+    `SNOOPY_SEGMENT_OUTPUT_DIR` instead of creating a file per request.
+    """
+    DEFAULT_SEGMENT_PREFIX = 'snoopy'
+    DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+    DEFAULT_SEGMENT_MAX_AGE = 300
+
+    writer = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get_writer(cls):
+        from django.conf import settings
+        with cls.lock:
+            if cls.writer is None:
+                log_dir = getattr(settings, 'SNOOPY_LOG_OUTPUT_DIR', None) or get_app_root()
+                cls.writer = SegmentWriter(
+                    getattr(settings, 'SNOOPY_SEGMENT_OUTPUT_DIR', log_dir),
+                    prefix=getattr(settings, 'SNOOPY_SEGMENT_PREFIX', cls.DEFAULT_SEGMENT_PREFIX),
+                    max_bytes=getattr(settings, 'SNOOPY_SEGMENT_MAX_BYTES', cls.DEFAULT_SEGMENT_MAX_BYTES),
+                    max_age=getattr(settings, 'SNOOPY_SEGMENT_MAX_AGE', cls.DEFAULT_SEGMENT_MAX_AGE),
+                    compression=getattr(settings, 'SNOOPY_SEGMENT_COMPRESSION', None))
+            return cls.writer
+
+    @staticmethod
+    def save_request_data(request_data):
+        SegmentedLogOutput.save_batch([request_data])
+
+    @classmethod
+    def save_batch(cls, batch):
+        records = []
+        for request_data in batch:
+            records.append((
+                json.dumps(request_data, default=default_json_serializer),
+                request_data['start_time'].isoformat(),
+                request_data['end_time'].isoformat()
+            ))
+        cls.get_writer().write(records)
+
+    @classmethod
+    def close(cls):
+        if cls.writer is not None:
+            cls.writer.close()
+
+
 # Example for extension.
 # Future uses: Post to Elasticsearch / InfluxDB / StatsD
 class HTTPOutput(OutputBase):
@@ -36,9 +125,9 @@ class HTTPOutput(OutputBase):
         if hasattr(settings, 'SNOOPY_HTTP_OUTPUT_URL'):
             url = settings.SNOOPY_HTTP_OUTPUT_URL
             data = json.dumps(request_data, default=default_json_serializer)
-            request = urllib2.Request(
-                url, data, {'Content-Type': 'application/json'})
-            response = urllib2.urlopen(request)
+            request = Request(
+                url, data.encode('utf-8'), {'Content-Type': 'application/json'})
+            response = urlopen(request)
             response.read()
             response.close()
 
@@ -53,10 +142,170 @@ class ElasticsearchOutput(OutputBase):
             index = request_data['start_time'].date().isoformat().replace('-', '.')
             url = settings.SNOOPY_ELASTICSEARCH_OUTPUT_URL + 'snoopy-' + index + '/request/'
             data = json.dumps(request_data, default=default_json_serializer)
-            request = urllib2.Request(
-                url, data, {'Content-Type': 'application/json'})
-            response = urllib2.urlopen(request)
+            request = Request(
+                url, data.encode('utf-8'), {'Content-Type': 'application/json'})
+            response = urlopen(request)
             response.read()
             response.close()
             end_time = datetime.datetime.now()
-            print 'Posted to Elasticsearch in %0.4f' % ((end_time - start_time).total_seconds())
+            logger.debug('Posted to Elasticsearch in %0.4f', (end_time - start_time).total_seconds())
+
+
+def is_stale_connection_error(error):
+    """
+    Tells the errors of a keep-alive connection the server closed while it
+    was idle in the pool.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        # Closed without an answer, RemoteDisconnected on Python 3
+        return True
+    return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+class ElasticsearchBulkOutput(OutputBase):
+    """
+    Buffers documents and sends them through the `_bulk` endpoint over a small
+    pool of keep-alive connections. The buffer is flushed when it holds
+    `SNOOPY_ELASTICSEARCH_BULK_SIZE` documents, or
+    `SNOOPY_ELASTICSEARCH_BULK_INTERVAL` seconds after the first buffered
+    document, whichever comes first, and on process exit.
+
+    Documents are sent without a mapping type, which Elasticsearch 8 rejects.
+    Set `SNOOPY_ELASTICSEARCH_DOCUMENT_TYPE` for versions that need one.
+    """
+    DEFAULT_BULK_SIZE = 100
+    DEFAULT_BULK_INTERVAL = 5.0
+    DEFAULT_TIMEOUT = 10.0
+
+    lock = threading.Lock()
+    buffer = []
+    connections = []
+    flush_timer = None
+    sent = 0
+    failed = 0
+
+    @staticmethod
+    def get_index(request_data):
+        index = request_data['start_time'].date().isoformat().replace('-', '.')
+        return 'snoopy-' + index
+
+    @staticmethod
+    def serialize(request_data, document_type=None):
+        action = {'_index': ElasticsearchBulkOutput.get_index(request_data)}
+        if document_type:
+            action['_type'] = document_type
+        document = json.dumps(request_data, default=default_json_serializer)
+        return json.dumps({'index': action}) + '\n' + document + '\n'
+
+    @staticmethod
+    def save_request_data(request_data):
+        ElasticsearchBulkOutput.save_batch([request_data])
+
+    @classmethod
+    def save_batch(cls, batch):
+        from django.conf import settings
+        if not hasattr(settings, 'SNOOPY_ELASTICSEARCH_OUTPUT_URL'):
+            return
+        bulk_size = getattr(settings, 'SNOOPY_ELASTICSEARCH_BULK_SIZE', cls.DEFAULT_BULK_SIZE)
+        bulk_interval = getattr(settings, 'SNOOPY_ELASTICSEARCH_BULK_INTERVAL', cls.DEFAULT_BULK_INTERVAL)
+        document_type = getattr(settings, 'SNOOPY_ELASTICSEARCH_DOCUMENT_TYPE', None)
+
+        lines = [cls.serialize(request_data, document_type) for request_data in batch]
+        with cls.lock:
+            cls.buffer.extend(lines)
+            should_flush = len(cls.buffer) >= bulk_size
+            if not should_flush and cls.flush_timer is None:
+                cls.flush_timer = threading.Timer(bulk_interval, cls.flush)
+                cls.flush_timer.daemon = True
+                cls.flush_timer.start()
+        if should_flush:
+            cls.flush()
+
+    @classmethod
+    def get_connection(cls):
+        from django.conf import settings
+        with cls.lock:
+            if cls.connections:
+                return cls.connections.pop()
+        url = urlparse(settings.SNOOPY_ELASTICSEARCH_OUTPUT_URL)
+        timeout = getattr(settings, 'SNOOPY_ELASTICSEARCH_TIMEOUT', cls.DEFAULT_TIMEOUT)
+        if url.scheme == 'https':
+            return httplib.HTTPSConnection(url.hostname, url.port, timeout=timeout)
+        return httplib.HTTPConnection(url.hostname, url.port, timeout=timeout)
+
+    @classmethod
+    def release_connection(cls, connection):
+        with cls.lock:
+            cls.connections.append(connection)
+
+    @classmethod
+    def post_bulk(cls, body):
+        from django.conf import settings
+        path = urlparse(settings.SNOOPY_ELASTICSEARCH_OUTPUT_URL).path or '/'
+        if not path.endswith('/'):
+            path += '/'
+        headers = {
+            'Content-Type': 'application/x-ndjson',
+            'Connection': 'keep-alive'
+        }
+        # The server may have closed an idle pooled connection, in which case
+        # the request is retried once on a fresh one. Nothing else is retried:
+        # after a timeout the documents may well have been indexed.
+        for attempt in range(2):
+            connection = cls.get_connection()
+            reused = connection.sock is not None
+            try:
+                connection.request('POST', path + '_bulk', body, headers)
+                response = connection.getresponse()
+                result = response.read()
+            except (httplib.HTTPException, IOError) as error:
+                connection.close()
+                if attempt == 1 or not reused or not is_stale_connection_error(error):
+                    raise
+                continue
+            cls.release_connection(connection)
+            if response.status >= 300:
+                raise IOError('Elasticsearch bulk request failed with status %d' % response.status)
+            return json.loads(result.decode('utf-8'))
+
+    @classmethod
+    def flush(cls):
+        with cls.lock:
+            lines, cls.buffer = cls.buffer, []
+            if cls.flush_timer is not None:
+                cls.flush_timer.cancel()
+                cls.flush_timer = None
+        if not lines:
+            return
+        body = ''.join(lines).encode('utf-8')
+        failed = 0
+        try:
+            result = cls.post_bulk(body)
+        except (httplib.HTTPException, IOError):
+            logger.exception('Snoopy failed to post %d documents to Elasticsearch', len(lines))
+            failed = len(lines)
+        except ValueError:
+            logger.exception('Snoopy could not parse the Elasticsearch response to %d documents', len(lines))
+            failed = len(lines)
+        else:
+            if result.get('errors'):
+                failed = len([item for item in result.get('items', [])
+                              if item.get('index', {}).get('error')])
+                logger.error('Elasticsearch rejected %d of %d documents', failed, len(lines))
+        with cls.lock:
+            cls.sent += len(lines) - failed
+            cls.failed += failed
+
+    @classmethod
+    def get_stats(cls):
+        with cls.lock:
+            return {'buffered': len(cls.buffer), 'sent': cls.sent, 'failed': cls.failed}
+
+    @classmethod
+    def close(cls):
+        cls.flush()
+
+
+atexit.register(ElasticsearchBulkOutput.flush)
@@ -0,0 +1,144 @@
+from collections import deque
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger('snoopy')
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DROP_NEWEST = 'drop_newest'
+
+
+class OutputPipeline(object):
+    """
+    Delivers request data to an output class from background threads.
+
+    Records are put on a bounded in-memory queue from `process_response` and
+    worker threads hand them to `output_cls.save_batch` in batches of up to
+    `batch_size`. When the queue is full, either the oldest queued record or
+    the incoming one is dropped depending on `full_policy`.
+    """
+    def __init__(self, output_cls, max_queue_size=1000, batch_size=20, workers=1,
+                 full_policy=POLICY_DROP_OLDEST, flush_timeout=5.0):
+        if full_policy not in (POLICY_DROP_OLDEST, POLICY_DROP_NEWEST):
+            raise ValueError('Unknown queue full policy: %s' % full_policy)
+        self.output_cls = output_cls
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.worker_count = workers
+        self.full_policy = full_policy
+        self.flush_timeout = flush_timeout
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'failed': 0
+        }
+        self.workers = []
+        self.pid = None
+        atexit.register(self.shutdown)
+
+
+    def ensure_workers(self):
+        # Threads do not survive a fork, so workers are (re)started lazily in
+        # whichever process ends up serving requests.
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.workers = []
+        for index in range(self.worker_count):
+            worker = threading.Thread(target=self.run, name='snoopy-output-%d' % index)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+
+    def put(self, request_data):
+        with self.condition:
+            self.ensure_workers()
+            if len(self.queue) >= self.max_queue_size:
+                self.stats['dropped'] += 1
+                if self.full_policy == POLICY_DROP_NEWEST:
+                    return False
+                self.queue.popleft()
+            self.queue.append(request_data)
+            self.stats['queued'] += 1
+            self.condition.notify_all()
+        return True
+
+
+    def take_batch(self):
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            self.in_flight += len(batch)
+            return batch
+
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            try:
+                self.output_cls.save_batch(batch)
+                sent, failed = len(batch), 0
+            except Exception:
+                logger.exception('Snoopy output %s failed to save %d records',
+                                 self.output_cls.__name__, len(batch))
+                sent, failed = 0, len(batch)
+            with self.condition:
+                self.in_flight -= len(batch)
+                self.stats['sent'] += sent
+                self.stats['failed'] += failed
+                self.condition.notify_all()
+
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every queued record has been handed to the output class,
+        or until `timeout` seconds have passed. Returns True if fully flushed.
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        deadline = time.time() + timeout
+        with self.condition:
+            if self.pid != os.getpid():
+                # No workers in this process, nothing will drain the queue.
+                return not self.queue
+            while self.queue or self.in_flight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+    def shutdown(self):
+        self.flush()
+        if hasattr(self.output_cls, 'close'):
+            self.output_cls.close()
+
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['queue_size'] = len(self.queue)
+        output_stats = None
+        if hasattr(self.output_cls, 'get_stats'):
+            output_stats = self.output_cls.get_stats()
+        if output_stats is not None:
+            # What was handed to the output is only buffered there
+            stats['buffered'] = output_stats['buffered']
+            stats['sent'] = output_stats['sent']
+            stats['failed'] += output_stats['failed']
+        return stats
@@ -0,0 +1,232 @@
+import re
+
+
+SORT_CUMULATIVE = 'cumulative'
+SORT_TOTTIME = 'tottime'
+SORT_NCALLS = 'ncalls'
+
+SORT_FIELDS = {
+    SORT_CUMULATIVE: 'cumtime',
+    SORT_TOTTIME: 'tottime',
+    SORT_NCALLS: 'ncalls',
+}
+
+TIME_PRECISION = 6
+
+MAX_COLLAPSE_DEPTH = 256
+MIN_PSTATS_WEIGHT = 0.000001
+
+FUNCTION_LABEL_REGEX = re.compile(r"^(.*):(\d+)\((.*)\)$")
+
+
+def get_function_label(function):
+    file_name, line_number, function_name = function
+    if file_name == '~':
+        # Builtins, e.g. <method 'join' of 'str' objects>
+        return function_name
+    return "%s:%d(%s)" % (file_name, line_number, function_name)
+
+
+def parse_function_label(label):
+    match = FUNCTION_LABEL_REGEX.match(label)
+    if match is None:
+        return ('~', 0, label)
+    file_name, line_number, function_name = match.groups()
+    return (file_name, int(line_number), function_name)
+
+
+def build_profile_table(stats, app_root=None, top=None, sort=SORT_CUMULATIVE):
+    """
+    Turns the `stats` dict of a `pstats.Stats` into a JSON friendly table:
+
+    {
+        'total_calls': ...,
+        'total_time': ...,
+        'dropped_functions': ...,
+        'functions': [
+            {
+                'function': 'file:line(name)',
+                'ncalls': ..., 'primitive_calls': ..., 'tottime': ..., 'cumtime': ...,
+                'callers': {'file:line(name)': [ncalls, primitive_calls, tottime, cumtime]}
+            },
+            ...
+        ]
+    }
+
+    With `app_root`, only functions defined in files under it are kept (their
+    callers are kept whatever they are). The table is sorted by `sort` and cut
+    to the `top` first functions.
+    """
+    functions = []
+    total_calls = 0
+    total_time = 0.0
+    for function, (primitive_calls, ncalls, tottime, cumtime, callers) in stats.items():
+        total_calls += ncalls
+        total_time += tottime
+        if app_root and not function[0].startswith(app_root):
+            continue
+        functions.append({
+            'function': get_function_label(function),
+            'ncalls': ncalls,
+            'primitive_calls': primitive_calls,
+            'tottime': round(tottime, TIME_PRECISION),
+            'cumtime': round(cumtime, TIME_PRECISION),
+            'callers': dict(
+                (get_function_label(caller), [
+                    caller_stats[0], caller_stats[1],
+                    round(caller_stats[2], TIME_PRECISION), round(caller_stats[3], TIME_PRECISION)
+                ])
+                for caller, caller_stats in callers.items())
+        })
+    sort_field = SORT_FIELDS[sort]
+    functions.sort(key=lambda row: row[sort_field], reverse=True)
+
+    dropped_functions = len(stats) - len(functions)
+    if top and len(functions) > top:
+        dropped_functions += len(functions) - top
+        functions = functions[:top]
+
+    return {
+        'total_calls': total_calls,
+        'total_time': round(total_time, TIME_PRECISION),
+        'dropped_functions': dropped_functions,
+        'functions': functions
+    }
+
+
+def to_pstats(table):
+    """
+    Rebuilds a `pstats.Stats.stats` style dict from a profile table. Only
+    complete when the table was neither filtered nor cut.
+    """
+    stats = {}
+    for row in table['functions']:
+        callers = dict(
+            (parse_function_label(label), tuple(caller_stats))
+            for label, caller_stats in row['callers'].items())
+        stats[parse_function_label(row['function'])] = (
+            row['primitive_calls'], row['ncalls'], row['tottime'], row['cumtime'], callers)
+    return stats
+
+
+def collapse_pstats(stats):
+    """
+    Builds collapsed stacks from cProfile data (the `stats` dict of a
+    `pstats.Stats`). cProfile only knows about caller / callee pairs, so the
+    time of a function is split between its callers in proportion to the
+    cumulative time each of them accounts for, as flameprof / gprof2dot do.
+    Recursive calls are cut at the first repetition.
+    """
+    callees = {}
+    roots = []
+    for function, (_, _, _, _, callers) in stats.items():
+        # A recursive function entered first only has itself as caller
+        if not [caller for caller in callers if caller != function]:
+            roots.append(function)
+        for caller in callers:
+            callees.setdefault(caller, []).append(function)
+
+    stacks = {}
+    pending = [(function, (function,), 1.0) for function in roots]
+    while pending:
+        function, path, share = pending.pop()
+        _, _, total_time, _, _ = stats[function]
+        if total_time * share > 0:
+            stack = ';'.join(get_function_label(item) for item in path)
+            stacks[stack] = stacks.get(stack, 0.0) + total_time * share
+        if len(path) >= MAX_COLLAPSE_DEPTH:
+            continue
+        for callee in callees.get(function, ()):
+            if callee in path:
+                continue
+            _, _, _, callee_cumulative_time, callee_callers = stats[callee]
+            if not callee_cumulative_time:
+                continue
+            edge_cumulative_time = callee_callers[function][3]
+            callee_share = share * edge_cumulative_time / callee_cumulative_time
+            if callee_share * callee_cumulative_time < MIN_PSTATS_WEIGHT:
+                continue
+            pending.append((callee, path + (callee,), callee_share))
+    return stacks
+
+
+class ProfileStatsMerger(object):
+    """
+    Adds up the profile tables of many requests into one table of hot
+    functions.
+    """
+    def __init__(self):
+        self.functions = {}
+        self.total_calls = 0
+        self.total_time = 0.0
+        self.requests = 0
+
+
+    def add(self, table):
+        self.requests += 1
+        self.total_calls += table['total_calls']
+        self.total_time += table['total_time']
+        for row in table['functions']:
+            merged = self.functions.get(row['function'])
+            if merged is None:
+                merged = self.functions[row['function']] = {
+                    'function': row['function'],
+                    'ncalls': 0,
+                    'primitive_calls': 0,
+                    'tottime': 0.0,
+                    'cumtime': 0.0,
+                    'requests': 0,
+                    'callers': {}
+                }
+            merged['ncalls'] += row['ncalls']
+            merged['primitive_calls'] += row['primitive_calls']
+            merged['tottime'] += row['tottime']
+            merged['cumtime'] += row['cumtime']
+            merged['requests'] += 1
+            for label, caller_stats in row['callers'].items():
+                merged_caller = merged['callers'].get(label)
+                if merged_caller is None:
+                    merged['callers'][label] = list(caller_stats)
+                else:
+                    for index, value in enumerate(caller_stats):
+                        merged_caller[index] += value
+
+
+    def get_table(self, top=None, sort=SORT_TOTTIME):
+        sort_field = SORT_FIELDS[sort]
+        functions = sorted(self.functions.values(), key=lambda row: row[sort_field], reverse=True)
+        if top:
+            functions = functions[:top]
+        return {
+            'requests': self.requests,
+            'total_calls': self.total_calls,
+            'total_time': self.total_time,
+            'functions': functions
+        }
+
+
+def merge_capture_profiles(paths):
+    """
+    Merges the cProfile tables of every capture found in `paths`
+    (directories or globs, see `find_capture_files`).
+    """
+    from snoopy.batch_analyzer import find_capture_files, iter_request_records
+
+    merger = ProfileStatsMerger()
+    for path in find_capture_files(paths):
+        for record in iter_request_records(path):
+            if record.get('profiler_stats'):
+                merger.add(record['profiler_stats'])
+    return merger
+
+
+def format_profile_table(table):
+    lines = ['%d requests, %d calls, %0.4f seconds' % (
+        table['requests'], table['total_calls'], table['total_time']), '']
+    lines.append('%10s %10s %10s %10s %10s  %s' % (
+        'ncalls', 'tottime', 'percall', 'cumtime', 'requests', 'function'))
+    for row in table['functions']:
+        lines.append('%10d %10.4f %10.6f %10.4f %10d  %s' % (
+            row['ncalls'], row['tottime'], row['tottime'] / row['ncalls'] if row['ncalls'] else 0.0,
+            row['cumtime'], row['requests'], row['function']))
+    return '\n'.join(lines)
@@ -1,9 +1,16 @@
 import datetime
-import traceback
+import time
 
 from django.db.models.sql.compiler import SQLUpdateCompiler, SQLDeleteCompiler
-from django.db.models.sql.datastructures import EmptyResultSet
 
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from snoopy.callsite import capture_call_stack
+from snoopy.fingerprint import DeferredQuery, fingerprint
 from snoopy.request import SnoopyRequest
 
 QUERY_TYPE_READ = 'read'
@@ -27,6 +34,15 @@ def execute_sql(self, *args, **kwargs):
     is needed, as the filters describe an empty set. In that case, None is
     returned, to avoid any unnecessary database interaction.
     """
+    if not SnoopyRequest.is_active():
+        if not SnoopyRequest.is_counting_queries():
+            return self._snoopy_execute_sql(*args, **kwargs)
+        start_time = time.time()
+        try:
+            return self._snoopy_execute_sql(*args, **kwargs)
+        finally:
+            SnoopyRequest.record_query_timing(time.time() - start_time)
+
     try:
         sql, params = self.as_sql()
         if not sql:
@@ -43,10 +59,6 @@ def execute_sql(self, *args, **kwargs):
         else:
             return
 
-    # There should be a flag to decide whether or not to pass the params through
-    # Useful in order to find generic types of queries
-    sql_query = sql % params
-
     if isinstance(self, SQLUpdateCompiler):
         query_type = QUERY_TYPE_UPDATE
     elif isinstance(self, SQLDeleteCompiler):
@@ -54,9 +66,12 @@ def execute_sql(self, *args, **kwargs):
     else:
         query_type = QUERY_TYPE_READ
 
-    stack_trace = traceback.format_stack()
+    stack_trace = capture_call_stack()
+    query_fingerprint, normalized_sql = fingerprint(sql)
     query_dict = {
-        'query': sql_query,
+        'query': DeferredQuery(sql, params),
+        'fingerprint': query_fingerprint,
+        'normalized_query': normalized_sql,
         'query_type': query_type,
         'traceback': stack_trace,
         'model': "%s.%s" % (self.query.model.__module__, self.query.model.__name__),
@@ -71,7 +86,16 @@ def execute_sql(self, *args, **kwargs):
 
 
 def execute_insert_sql(self, *args, **kwargs):
-    stack_trace = traceback.format_stack()
+    if not SnoopyRequest.is_active():
+        if not SnoopyRequest.is_counting_queries():
+            return self._snoopy_execute_insert_sql(*args, **kwargs)
+        start_time = time.time()
+        try:
+            return self._snoopy_execute_insert_sql(*args, **kwargs)
+        finally:
+            SnoopyRequest.record_query_timing(time.time() - start_time)
+
+    stack_trace = capture_call_stack()
     query_dict = {
         'query': [],
         'query_type': QUERY_TYPE_WRITE,
@@ -80,7 +104,10 @@ def execute_insert_sql(self, *args, **kwargs):
         'start_time': datetime.datetime.now(),
     }
     for sql, params in self.as_sql():
-        query_dict['query'].append(sql % params)
+        query_dict['query'].append(DeferredQuery(sql, params))
+    if query_dict['query']:
+        query_dict['fingerprint'], query_dict['normalized_query'] = \
+            fingerprint(query_dict['query'][0].sql)
 
     try:
         return self._snoopy_execute_insert_sql(*args, **kwargs)
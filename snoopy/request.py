@@ -3,21 +3,30 @@ from collections import OrderedDict
 import cProfile
 import datetime
 import pstats
-import sys
-import StringIO
 import threading
-
+import time
+
+from snoopy import stack_sampler
+from snoopy.call_tree import CallTree
+from snoopy.context import get_request_local, thread_hooks
+from snoopy.db_activity import DatabaseActivity
+from snoopy.detectors import QueryPatternDetector
+from snoopy.fingerprint import query_aggregator
+from snoopy.frame_filter import get_frame_filter
+from snoopy.memory_profiler import memory_profiler
 from snoopy.helpers import get_app_root
+from snoopy.line_profiler import ChainedTrace, LineProfile, get_target_codes
+from snoopy.profile_stats import build_profile_table, collapse_pstats
+from snoopy.trace_buffer import TraceBuffer, EVENT_CALL, EVENT_RETURN
 
 
-_snoopy_request = threading.local()
+PROFILER_MODE_TRACE = 'trace'
+PROFILER_MODE_TREE = 'tree'
 
 
-def clean_profiler_result(result):
-    app_root = _snoopy_request.app_root
-    lines = result.split("\n")
-    relevant_result = lines[:5] + [line for line in lines[6:] if app_root in line]
-    return "\n".join(relevant_result)
+# Per request state: a ContextVar when available so that concurrent requests
+# on an event loop don't mix, a threading.local otherwise.
+_snoopy_request = get_request_local()
 
 
 def get_trace_data(frame):
@@ -29,19 +38,6 @@ def get_trace_data(frame):
     }
 
 
-def get_trace_key(frame):
-    return "%s::%s:%d" % (frame.f_globals.get('__name__'), frame.f_code.co_name, frame.f_lineno)
-
-
-def should_track_frame(frame):
-    module = frame.f_globals.get('__name__')
-    function = frame.f_code.co_name
-    if module.startswith(_snoopy_request.relevant_apps) and not module.startswith('snoopy'):
-        if not function.startswith("_"):
-            return True
-    return False
-
-
 
 class SnoopyRequest:
     """
@@ -52,21 +48,40 @@ class SnoopyRequest:
     def profile(frame, event, args):
         # This still traces almost everything. Need to investigate how to do this less frequently
         # so that it can even be run on production.
-        if (event == 'call' or event == 'return') and should_track_frame(frame):
-            key = get_trace_key(frame)
-
-            now = datetime.datetime.now()
+        if event == 'call' or event == 'return':
+            # The hook is per thread but the state is per context, so when
+            # coroutines of several requests share the thread, events go to
+            # the request that is running.
+            state = _snoopy_request.get_state()
+            if state is None or not getattr(state, 'tracing', False):
+                return
+            key_prefix = state.frame_filter.get_key_prefix(frame)
+            if key_prefix is None:
+                return
+            traces = state.traces
             if event == 'call':
-                _snoopy_request.data['profiler_traces'].append({
-                    'key': key,
-                    'start_time': now
-                })
-                _snoopy_request.current_function_key = [key, now]
-            elif event == 'return':
-                _snoopy_request.data['profiler_traces'].append({
-                    'key': key,
-                    'end_time': now
-                })
+                state.current_function_key = traces.append(EVENT_CALL, frame, key_prefix)
+            else:
+                traces.append(EVENT_RETURN, frame, key_prefix)
+
+    @staticmethod
+    def trace_lines(frame, event, args):
+        # The tracer that was there before, e.g. coverage or a debugger, keeps
+        # getting its events
+        previous_trace = thread_hooks.previous_trace
+        local_trace = None
+        if previous_trace is not None:
+            local_trace = previous_trace(frame, event, args)
+        state = _snoopy_request.get_state()
+        line_profile = getattr(state, 'line_profile', None)
+        if line_profile is None:
+            return local_trace
+        line_trace = line_profile.trace_call(frame, event, args)
+        if line_trace is None:
+            return local_trace
+        if local_trace is None:
+            return line_trace
+        return ChainedTrace(line_trace, local_trace)
 
     @staticmethod
     def register_request(request, settings):
@@ -74,26 +89,138 @@ class SnoopyRequest:
             'request': request.path,
             'method': request.method,
             'queries': [],
-            'profiler_traces': [],
             'custom_attributes': {},
             'start_time': datetime.datetime.now()
         }
+        if settings.get('USE_BUILTIN_PROFILER') and settings.get('BUILTIN_PROFILER_MODE') == PROFILER_MODE_TREE:
+            traces = snoopy_data['profiler_tree'] = CallTree(
+                max_nodes=settings.get('BUILTIN_PROFILER_MAX_EVENTS'))
+        else:
+            traces = snoopy_data['profiler_traces'] = TraceBuffer(
+                min_duration=settings.get('BUILTIN_PROFILER_MIN_DURATION'),
+                max_events=settings.get('BUILTIN_PROFILER_MAX_EVENTS'),
+                max_memory=settings.get('BUILTIN_PROFILER_MAX_MEMORY'),
+                truncation_policy=settings.get('BUILTIN_PROFILER_TRUNCATION_POLICY'))
+        _snoopy_request.reset()
+        _snoopy_request.active = True
         _snoopy_request.request = request
         _snoopy_request.data = snoopy_data
+        _snoopy_request.traces = traces
         _snoopy_request.settings = settings
-        _snoopy_request.current_function_key = [None, None]
+        _snoopy_request.current_function_key = (None, None)
         from django.conf import settings as django_settings
         _snoopy_request.relevant_apps = tuple(django_settings.INSTALLED_APPS)
 
         app_root = get_app_root()
         _snoopy_request.app_root = app_root
 
+        _snoopy_request.query_detector = None
+        if _snoopy_request.settings.get('DETECT_QUERY_PATTERNS'):
+            _snoopy_request.query_detector = QueryPatternDetector(
+                app_root=app_root,
+                n_plus_one_threshold=_snoopy_request.settings.get('N_PLUS_ONE_THRESHOLD'),
+                duplicate_threshold=_snoopy_request.settings.get('DUPLICATE_QUERY_THRESHOLD'))
+
+        # Started before the profilers so that they don't time the start
+        # snapshot, and stopped after them.
+        if _snoopy_request.settings.get('USE_MEMORY_PROFILER'):
+            _snoopy_request.memory_collector = memory_profiler.start(
+                _snoopy_request.settings.get('MEMORY_PROFILER_TRACE_ALLOCATIONS'),
+                _snoopy_request.settings.get('MEMORY_PROFILER_TRACEBACK_LIMIT'))
+
+        _snoopy_request.database_activity = None
+        if _snoopy_request.settings.get('COLLECT_CURSOR_QUERIES'):
+            _snoopy_request.database_activity = DatabaseActivity(
+                max_statements=_snoopy_request.settings.get('CURSOR_QUERIES_MAX_STATEMENTS'))
+
+        _snoopy_request.profiler = None
         if _snoopy_request.settings.get('USE_CPROFILE'):
-            _snoopy_request.profiler = cProfile.Profile()
-            _snoopy_request.profiler.enable()
+            if thread_hooks.acquire_cprofile():
+                _snoopy_request.profiler = cProfile.Profile()
+                _snoopy_request.profiler.enable()
+            else:
+                snoopy_data['profiler_skipped'] = 'cProfile was already running for another request on this thread'
 
         if _snoopy_request.settings.get('USE_BUILTIN_PROFILER'):
-            sys.setprofile(SnoopyRequest.profile)
+            _snoopy_request.frame_filter = get_frame_filter(
+                _snoopy_request.relevant_apps,
+                _snoopy_request.settings.get('BUILTIN_PROFILER_INCLUDE_MODULES'),
+                _snoopy_request.settings.get('BUILTIN_PROFILER_EXCLUDE_MODULES'),
+                _snoopy_request.settings.get('BUILTIN_PROFILER_FILTER_CACHE_SIZE'))
+            _snoopy_request.frame_filter_stats = _snoopy_request.frame_filter.get_stats()
+            _snoopy_request.tracing = True
+            thread_hooks.acquire_profile(SnoopyRequest.profile)
+
+        _snoopy_request.line_profile = None
+        if _snoopy_request.settings.get('USE_LINE_PROFILER'):
+            codes = get_target_codes(_snoopy_request.settings.get('LINE_PROFILER_FUNCTIONS'))
+            if codes:
+                _snoopy_request.line_profile = LineProfile(codes)
+                thread_hooks.acquire_trace(SnoopyRequest.trace_lines)
+
+        if _snoopy_request.settings.get('USE_SAMPLING_PROFILER'):
+            _snoopy_request.stack_sampler = stack_sampler.get_sampler(
+                _snoopy_request.settings.get('SAMPLING_PROFILER_MODE'),
+                _snoopy_request.settings.get('SAMPLING_PROFILER_INTERVAL'))
+            _snoopy_request.sample_collector = _snoopy_request.stack_sampler.start(
+                threading.current_thread().ident)
+
+
+    @staticmethod
+    def unregister_request(count_queries=False):
+        """
+        Used for requests that are not sampled, so that nothing gets collected
+        into the data of a previous request served by this thread.
+
+        With `count_queries`, only the request time and the number / time of
+        SQL queries are tracked, for the view metrics.
+        """
+        _snoopy_request.reset()
+        _snoopy_request.active = False
+        _snoopy_request.request = None
+        _snoopy_request.data = None
+        _snoopy_request.counting = count_queries
+        _snoopy_request.start_timestamp = time.time()
+        _snoopy_request.query_count = 0
+        _snoopy_request.query_time = 0.0
+
+
+    @staticmethod
+    def is_active():
+        return getattr(_snoopy_request, 'active', False)
+
+
+    @staticmethod
+    def is_counting_queries():
+        return getattr(_snoopy_request, 'counting', False)
+
+
+    @staticmethod
+    def record_query_timing(query_time):
+        _snoopy_request.query_count += 1
+        _snoopy_request.query_time += query_time
+
+
+    @staticmethod
+    def register_unsampled_response():
+        """
+        Returns `(request time, SQL time, query count)` for a request that was
+        registered with `unregister_request`.
+        """
+        _snoopy_request.counting = False
+        request_time = time.time() - _snoopy_request.start_timestamp
+        return request_time, _snoopy_request.query_time, _snoopy_request.query_count
+
+
+    @staticmethod
+    def get_database_activity():
+        """
+        The `DatabaseActivity` of the request, None unless it is sampled with
+        `SNOOPY_COLLECT_CURSOR_QUERIES`.
+        """
+        if not getattr(_snoopy_request, 'active', False):
+            return None
+        return _snoopy_request.database_activity
 
 
     @staticmethod
@@ -109,9 +236,24 @@ class SnoopyRequest:
         query_data['total_query_time'] = \
             (query_data['end_time'] - query_data['start_time'])
 
-        query_data['function_call_key'] = _snoopy_request.current_function_key
+        traces = _snoopy_request.traces
+        query_data['function_call_key'] = traces.expand_key(_snoopy_request.current_function_key)
+        # Keep the calls that ran the query even if they are short
+        traces.pin()
+        traces.record_query(_snoopy_request.current_function_key, query_data['total_query_time'].total_seconds())
         _snoopy_request.data['queries'].append(query_data)
 
+        if _snoopy_request.settings.get('QUERY_AGGREGATION') and query_data.get('fingerprint'):
+            query_aggregator.add(
+                query_data['fingerprint'],
+                query_data['normalized_query'],
+                query_data['total_query_time'].total_seconds(),
+                model=query_data['model'],
+                call_site=query_data['traceback'].get_call_site(_snoopy_request.app_root))
+
+        if _snoopy_request.query_detector is not None:
+            _snoopy_request.query_detector.add(query_data)
+
 
     @staticmethod
     def record_custom_attributes(custom_data):
@@ -122,24 +264,102 @@ class SnoopyRequest:
         _snoopy_request.data['custom_attributes'].update(custom_data)
 
     @staticmethod
-    def register_response(response):
+    def stop_request(response):
+        """
+        Stops the profilers of the request and fills in its timings. Nothing
+        is built from what they collected yet: the request data is finished
+        by `register_response`, or thrown away with `discard_request`.
+        """
         if _snoopy_request.settings.get('USE_BUILTIN_PROFILER'):
-            sys.setprofile(None)
+            _snoopy_request.tracing = False
+            thread_hooks.release_profile()
+            if isinstance(_snoopy_request.traces, CallTree):
+                _snoopy_request.traces.finish()
+        if _snoopy_request.line_profile is not None:
+            thread_hooks.release_trace()
+        _snoopy_request.active = False
+
+        if _snoopy_request.profiler is not None:
+            _snoopy_request.profiler.disable()
+            thread_hooks.release_cprofile()
+
+        if _snoopy_request.settings.get('USE_SAMPLING_PROFILER'):
+            _snoopy_request.stack_sampler.stop(_snoopy_request.sample_collector)
 
         snoopy_data = _snoopy_request.data
         snoopy_data['end_time'] = datetime.datetime.now()
+        snoopy_data['status_code'] = getattr(response, 'status_code', None)
         snoopy_data['total_request_time'] = \
             (snoopy_data['end_time'] - snoopy_data['start_time'])
+        return snoopy_data
 
-        if _snoopy_request.settings.get('USE_CPROFILE'):
-            _snoopy_request.profiler.disable()
-            profiler_result = StringIO.StringIO()
-            profiler_stats = pstats.Stats(
-                _snoopy_request.profiler, stream=profiler_result).sort_stats('cumulative')
-            profiler_stats.print_stats()
 
-            result = profiler_result.getvalue()
+    @staticmethod
+    def discard_request():
+        if _snoopy_request.settings.get('USE_MEMORY_PROFILER'):
+            # No allocation snapshot
+            memory_profiler.stop(_snoopy_request.memory_collector, top=0)
+        _snoopy_request.data = None
+        _snoopy_request.traces = None
+        _snoopy_request.profiler = None
+        _snoopy_request.line_profile = None
+        _snoopy_request.sample_collector = None
+
+
+    @staticmethod
+    def register_response():
+        """
+        Builds the profiler payloads of a request stopped with `stop_request`
+        and returns its data.
+        """
+        snoopy_data = _snoopy_request.data
+        if _snoopy_request.settings.get('USE_MEMORY_PROFILER'):
+            app_root = None
+            if not _snoopy_request.settings.get('MEMORY_PROFILER_SHOW_ALL_FUNCTIONS'):
+                app_root = _snoopy_request.app_root
+            snoopy_data['memory_profile'] = memory_profiler.stop(
+                _snoopy_request.memory_collector,
+                app_root=app_root,
+                top=_snoopy_request.settings.get('MEMORY_PROFILER_TOP_ALLOCATIONS'))
+
+        if _snoopy_request.line_profile is not None:
+            snoopy_data['line_profile'] = _snoopy_request.line_profile.to_representation()
+            _snoopy_request.line_profile = None
+        if _snoopy_request.settings.get('USE_BUILTIN_PROFILER'):
+            # Counters are shared by every thread in the process, so these are
+            # approximate when requests are served concurrently.
+            start_stats = _snoopy_request.frame_filter_stats
+            end_stats = _snoopy_request.frame_filter.get_stats()
+            snoopy_data['profiler_filter_stats'] = {
+                'hits': end_stats['hits'] - start_stats['hits'],
+                'misses': end_stats['misses'] - start_stats['misses'],
+                'cache_size': end_stats['cache_size'],
+                'max_size': end_stats['max_size']
+            }
+            traces = _snoopy_request.traces
+            snoopy_data['profiler_trace_stats'] = traces.get_stats()
+            snoopy_data['profiler_truncated'] = traces.is_truncated()
+
+        if _snoopy_request.database_activity is not None:
+            snoopy_data['database_activity'] = _snoopy_request.database_activity
+
+        if _snoopy_request.query_detector is not None:
+            snoopy_data['query_findings'] = _snoopy_request.query_detector.get_findings()
+
+        if _snoopy_request.profiler is not None:
+            profiler_stats = pstats.Stats(_snoopy_request.profiler)
+
+            app_root = None
             if not _snoopy_request.settings.get('CPROFILE_SHOW_ALL_FUNCTIONS'):
-                result = clean_profiler_result(result)
-            snoopy_data['profiler_result'] = result
+                app_root = _snoopy_request.app_root
+            snoopy_data['profiler_stats'] = build_profile_table(
+                profiler_stats.stats,
+                app_root=app_root,
+                top=_snoopy_request.settings.get('CPROFILE_TOP_FUNCTIONS'),
+                sort=_snoopy_request.settings.get('CPROFILE_SORT'))
+            if _snoopy_request.settings.get('CPROFILE_COLLAPSED_STACKS'):
+                snoopy_data['profiler_collapsed_stacks'] = collapse_pstats(profiler_stats.stats)
+
+        if _snoopy_request.settings.get('USE_SAMPLING_PROFILER'):
+            snoopy_data['profiler_samples'] = _snoopy_request.sample_collector.to_representation()
         return snoopy_data
@@ -0,0 +1,139 @@
+import random
+import re
+import threading
+import time
+
+
+class RequestSampler(object):
+    """
+    Decides which requests get profiled.
+
+    The decision is made once, in `process_request`, so that requests which
+    are not sampled skip every collector and never reach the output class.
+
+    Order of precedence:
+    1. Forced capture through a header / cookie
+    2. Per view overrides (dotted view path or url name)
+    3. Per URL pattern overrides (first matching regex wins)
+    4. The global rate
+
+    With adaptive sampling on, the resulting rate is additionally capped so that
+    roughly `adaptive_target` requests per second are profiled regardless of
+    how much traffic the process is serving.
+    """
+    def __init__(self, rate=1.0, url_overrides=None, view_overrides=None,
+                 force_header=None, force_cookie=None, force_token=None,
+                 adaptive=False, adaptive_target=1.0, adaptive_window=10.0):
+        self.rate = float(rate)
+        self.url_overrides = [
+            (re.compile(pattern), float(pattern_rate))
+            for pattern, pattern_rate in (url_overrides or ())
+        ]
+        self.view_overrides = dict(
+            (view, float(view_rate)) for view, view_rate in (view_overrides or {}).items())
+        self.force_header = None
+        if force_header:
+            self.force_header = 'HTTP_' + force_header.upper().replace('-', '_')
+        self.force_cookie = force_cookie
+        self.force_token = force_token
+
+        self.adaptive = adaptive
+        self.adaptive_target = float(adaptive_target)
+        self.adaptive_window = float(adaptive_window)
+        self.adaptive_factor = 1.0
+        self._window_start = time.time()
+        self._window_count = 0
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def from_settings(get_setting):
+        return RequestSampler(
+            rate=get_setting('SAMPLE_RATE'),
+            url_overrides=get_setting('SAMPLE_RATE_URL_OVERRIDES'),
+            view_overrides=get_setting('SAMPLE_RATE_VIEW_OVERRIDES'),
+            force_header=get_setting('SAMPLE_FORCE_HEADER'),
+            force_cookie=get_setting('SAMPLE_FORCE_COOKIE'),
+            force_token=get_setting('SAMPLE_FORCE_TOKEN'),
+            adaptive=get_setting('ADAPTIVE_SAMPLING'),
+            adaptive_target=get_setting('ADAPTIVE_SAMPLING_TARGET'),
+            adaptive_window=get_setting('ADAPTIVE_SAMPLING_WINDOW'))
+
+
+    def is_forced(self, request):
+        values = []
+        if self.force_header:
+            values.append(request.META.get(self.force_header))
+        if self.force_cookie:
+            values.append(request.COOKIES.get(self.force_cookie))
+        for value in values:
+            if not value:
+                continue
+            if self.force_token is None or value == self.force_token:
+                return True
+        return False
+
+
+    def get_view_rate(self, request):
+        try:
+            from django.urls import resolve, Resolver404
+        except ImportError:
+            from django.core.urlresolvers import resolve, Resolver404
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        view = getattr(match.func, 'view_class', match.func)
+        view_path = "%s.%s" % (view.__module__, view.__name__)
+        if view_path in self.view_overrides:
+            return self.view_overrides[view_path]
+        if match.url_name and match.url_name in self.view_overrides:
+            return self.view_overrides[match.url_name]
+        return None
+
+
+    def get_rate(self, request):
+        if self.view_overrides:
+            rate = self.get_view_rate(request)
+            if rate is not None:
+                return rate
+        for pattern, rate in self.url_overrides:
+            if pattern.search(request.path):
+                return rate
+        return self.rate
+
+
+    def record_request(self):
+        """
+        Counts requests in fixed windows and rescales `adaptive_factor` so that
+        the expected number of sampled requests stays around the target.
+        """
+        with self._lock:
+            self._window_count += 1
+            now = time.time()
+            elapsed = now - self._window_start
+            if elapsed < self.adaptive_window:
+                return
+            throughput = self._window_count / elapsed
+            if throughput > self.adaptive_target:
+                self.adaptive_factor = self.adaptive_target / throughput
+            else:
+                self.adaptive_factor = 1.0
+            self._window_start = now
+            self._window_count = 0
+
+
+    def should_sample(self, request):
+        if self.adaptive:
+            self.record_request()
+        if self.is_forced(request):
+            return True
+
+        rate = self.get_rate(request)
+        if self.adaptive:
+            rate *= self.adaptive_factor
+        if rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+        return random.random() < rate
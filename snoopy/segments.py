@@ -0,0 +1,232 @@
+import atexit
+import datetime
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+INDEX_FILE_NAME = 'index.jsonl'
+SEGMENT_EXTENSIONS = {
+    None: '.jsonl',
+    COMPRESSION_GZIP: '.jsonl.gz',
+    COMPRESSION_ZSTD: '.jsonl.zst'
+}
+
+
+def open_segment_for_write(path, compression):
+    raw_file = open(path, 'ab')
+    if compression == COMPRESSION_GZIP:
+        return raw_file, gzip.GzipFile(fileobj=raw_file, mode='ab')
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ImportError('zstd compression needs the `zstandard` package')
+        return raw_file, zstandard.ZstdCompressor().stream_writer(raw_file)
+    return raw_file, raw_file
+
+
+def open_segment_for_read(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('Reading zstd segments needs the `zstandard` package')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+class SegmentWriter(object):
+    """
+    Appends newline delimited JSON records to segment files, starting a new
+    segment once the current one reaches `max_bytes` (uncompressed) or
+    `max_age` seconds.
+
+    Every process writes to its own segments (the pid is part of the file
+    name) and writes from threads are serialized with a lock, so multiple
+    workers can share a directory. When a segment is closed, a line describing
+    its time range is appended to `index.jsonl` in the same directory.
+    """
+    def __init__(self, directory, prefix='snoopy', max_bytes=64 * 1024 * 1024, max_age=300,
+                 compression=None):
+        if compression not in SEGMENT_EXTENSIONS:
+            raise ValueError('Unknown segment compression: %s' % compression)
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.segment = None
+        atexit.register(self.close)
+
+
+    def open_segment(self):
+        opened_at = time.time()
+        name = "%s-%s-%d-%04d%s" % (
+            self.prefix,
+            datetime.datetime.utcfromtimestamp(opened_at).strftime('%Y%m%dT%H%M%S'),
+            os.getpid(),
+            self.sequence,
+            SEGMENT_EXTENSIONS[self.compression])
+        self.sequence += 1
+        path = os.path.join(self.directory, name)
+        raw_file, writer = open_segment_for_write(path, self.compression)
+        self.segment = {
+            'path': path,
+            'pid': os.getpid(),
+            'raw_file': raw_file,
+            'writer': writer,
+            'opened_at': opened_at,
+            'bytes': 0,
+            'records': 0,
+            'start_time': None,
+            'end_time': None
+        }
+
+
+    def close_segment(self):
+        segment, self.segment = self.segment, None
+        if segment is None:
+            return
+        if segment['writer'] is not segment['raw_file']:
+            segment['writer'].close()
+        if not segment['raw_file'].closed:
+            segment['raw_file'].close()
+        if segment['records'] == 0:
+            os.remove(segment['path'])
+            return
+        index_entry = json.dumps({
+            'segment': os.path.basename(segment['path']),
+            'start_time': segment['start_time'],
+            'end_time': segment['end_time'],
+            'records': segment['records'],
+            'bytes': segment['bytes']
+        }) + '\n'
+        # A single small write on an O_APPEND descriptor, so lines from
+        # different processes do not interleave.
+        index_fd = os.open(os.path.join(self.directory, INDEX_FILE_NAME),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(index_fd, index_entry.encode('utf-8'))
+        finally:
+            os.close(index_fd)
+
+
+    def abandon_segment(self):
+        """
+        Drops a segment inherited through a fork, the parent owns that file.
+        Its descriptor is pointed at /dev/null before the file objects are
+        closed, so what they still buffer (e.g. the gzip trailer) does not end
+        up in the parent's segment.
+        """
+        segment, self.segment = self.segment, None
+        null_fd = os.open(os.devnull, os.O_WRONLY)
+        try:
+            os.dup2(null_fd, segment['raw_file'].fileno())
+        finally:
+            os.close(null_fd)
+        if segment['writer'] is not segment['raw_file']:
+            segment['writer'].close()
+        if not segment['raw_file'].closed:
+            segment['raw_file'].close()
+
+
+    def should_rotate(self):
+        segment = self.segment
+        return (segment['bytes'] >= self.max_bytes
+                or time.time() - segment['opened_at'] >= self.max_age)
+
+
+    def write(self, records):
+        """
+        `records` is a list of `(line, start_time, end_time)` where the times
+        are ISO formatted strings used for the segment index.
+        """
+        with self.lock:
+            if self.segment is not None and self.segment['pid'] != os.getpid():
+                self.abandon_segment()
+            if self.segment is not None and self.should_rotate():
+                self.close_segment()
+            if self.segment is None:
+                self.open_segment()
+            segment = self.segment
+            data = ''.join(line + '\n' for line, _, _ in records).encode('utf-8')
+            segment['writer'].write(data)
+            if segment['writer'] is segment['raw_file']:
+                segment['raw_file'].flush()
+            segment['bytes'] += len(data)
+            segment['records'] += len(records)
+            for _, start_time, end_time in records:
+                if segment['start_time'] is None or start_time < segment['start_time']:
+                    segment['start_time'] = start_time
+                if segment['end_time'] is None or end_time > segment['end_time']:
+                    segment['end_time'] = end_time
+
+
+    def close(self):
+        with self.lock:
+            if self.segment is None:
+                return
+            if self.segment['pid'] == os.getpid():
+                self.close_segment()
+            else:
+                self.abandon_segment()
+
+
+def read_index(directory):
+    index_path = os.path.join(directory, INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as index_file:
+        return [json.loads(line) for line in index_file if line.strip()]
+
+
+def find_segments(directory, start_time=None, end_time=None):
+    """
+    Returns paths of closed segments whose records overlap the given range of
+    ISO formatted times, using the index instead of opening every segment.
+    """
+    paths = []
+    for entry in read_index(directory):
+        if start_time is not None and entry['end_time'] < start_time:
+            continue
+        if end_time is not None and entry['start_time'] > end_time:
+            continue
+        paths.append(os.path.join(directory, entry['segment']))
+    return paths
+
+
+def iter_segment_records(path):
+    segment_file = open_segment_for_read(path)
+    try:
+        buffered = b''
+        while True:
+            chunk = segment_file.read(1024 * 1024)
+            if not chunk:
+                break
+            lines = (buffered + chunk).split(b'\n')
+            buffered = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+        if buffered.strip():
+            yield json.loads(buffered.decode('utf-8'))
+    finally:
+        segment_file.close()
+
+
+def list_segment_files(directory):
+    paths = []
+    for extension in SEGMENT_EXTENSIONS.values():
+        paths.extend(glob.glob(os.path.join(directory, '*' + extension)))
+    return sorted(path for path in paths if os.path.basename(path) != INDEX_FILE_NAME)
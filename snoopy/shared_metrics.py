@@ -0,0 +1,378 @@
+import errno
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+from snoopy.histogram import LogHistogram
+
+
+MAGIC = b'SNPY'
+VERSION = 1
+
+KIND_VIEW = 1
+KIND_QUERY = 2
+KIND_NAMES = {
+    KIND_VIEW: 'view',
+    KIND_QUERY: 'query'
+}
+
+SLOT_EMPTY = 0
+SLOT_USED = 1
+
+KEY_SIZE = 200
+LABEL_SIZE = 400
+
+# magic, version, slot count, bucket count, sub buckets, min value, created, dropped
+HEADER_FORMAT = '<4sIIIIddQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DROPPED_OFFSET = HEADER_SIZE - struct.calcsize('<Q')
+
+# state, kind, key length, label length, key, label
+SLOT_KEY_FORMAT = '<BBHH%ds%ds' % (KEY_SIZE, LABEL_SIZE)
+SLOT_KEY_SIZE = struct.calcsize(SLOT_KEY_FORMAT)
+# count, total, max, extra total (SQL time of views), extra count (queries of views)
+SLOT_STATS_FORMAT = '<QdddQ'
+SLOT_STATS_SIZE = struct.calcsize(SLOT_STATS_FORMAT)
+BUCKET_FORMAT = '<Q'
+BUCKET_SIZE = struct.calcsize(BUCKET_FORMAT)
+
+
+def get_default_path():
+    settings_module = os.environ.get('DJANGO_SETTINGS_MODULE', 'default')
+    return os.path.join(tempfile.gettempdir(), 'snoopy-metrics-%s.mmap' % settings_module)
+
+
+def encode(value, size):
+    value = value or b''
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    value = value[:size]
+    return value, len(value)
+
+
+class SharedMetrics(object):
+    """
+    Per host view and query fingerprint statistics, shared by every worker
+    process through a memory mapped file.
+
+    The file has a fixed number of slots, one per (kind, key). Each slot holds
+    counters and a `LogHistogram` of times with the same bucket layout in
+    every slot, so snapshots can be turned back into histograms and merged.
+    Slots are found by hashing the key with linear probing, and claimed under
+    an exclusive `lockf` lock on the header. Updates lock the slot's byte
+    range, and snapshots take a shared lock on the whole file while copying
+    it, which gives a consistent view at the cost of pausing writers for the
+    duration of a memory copy.
+
+    Without `create`, the file has to exist already (e.g. for the
+    `snoop_metrics` command). With `read_only` it is also opened read only
+    and can't be reset.
+    """
+    def __init__(self, path=None, slot_count=1024, min_value=0.000001, sub_buckets=16, bucket_count=512,
+                 create=True, read_only=False):
+        if fcntl is None:
+            raise RuntimeError('Shared metrics need fcntl, which is not available on this platform')
+        self.path = path or get_default_path()
+        self.slot_count = slot_count
+        self.min_value = min_value
+        self.sub_buckets = sub_buckets
+        self.bucket_count = bucket_count
+        self.create = create and not read_only
+        self.read_only = read_only
+        self.slot_size = SLOT_KEY_SIZE + SLOT_STATS_SIZE + BUCKET_SIZE * bucket_count
+        self.size = HEADER_SIZE + self.slot_size * slot_count
+        # lockf locks are per process, threads of a process need their own lock
+        self.lock = threading.Lock()
+        self.pid = None
+        self.file_descriptor = None
+        self.map = None
+        self.slot_indexes = {}
+        self.histogram = LogHistogram(min_value, sub_buckets, bucket_count)
+
+
+    def open(self):
+        if self.pid == os.getpid():
+            return
+        # After a fork, reopen the file so that locks belong to this process
+        self.slot_indexes = {}
+        flags = os.O_RDONLY if self.read_only else os.O_RDWR
+        try:
+            file_descriptor = os.open(self.path, flags | os.O_CREAT if self.create else flags, 0o644)
+        except OSError as error:
+            if error.errno == errno.ENOENT and not self.create:
+                raise ValueError('%s does not exist, no worker has recorded shared metrics yet' % self.path)
+            raise
+        try:
+            fcntl.lockf(file_descriptor, fcntl.LOCK_SH if self.read_only else fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                header = os.read(file_descriptor, HEADER_SIZE)
+                if len(header) < HEADER_SIZE and self.create:
+                    os.ftruncate(file_descriptor, self.size)
+                    os.lseek(file_descriptor, 0, os.SEEK_SET)
+                    os.write(file_descriptor, struct.pack(
+                        HEADER_FORMAT, MAGIC, VERSION, self.slot_count, self.bucket_count,
+                        self.sub_buckets, self.min_value, time.time(), 0))
+                else:
+                    self.check_header(header)
+            finally:
+                fcntl.lockf(file_descriptor, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        except Exception:
+            os.close(file_descriptor)
+            raise
+        self.pid = os.getpid()
+        self.file_descriptor = file_descriptor
+        if self.read_only:
+            self.map = mmap.mmap(file_descriptor, self.size, access=mmap.ACCESS_READ)
+        else:
+            self.map = mmap.mmap(file_descriptor, self.size)
+
+
+    def check_header(self, header):
+        if len(header) < HEADER_SIZE:
+            raise ValueError('%s is not a Snoopy shared metrics file' % self.path)
+        magic, version, slot_count, bucket_count, sub_buckets, min_value, _, _ = \
+            struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a Snoopy shared metrics file' % self.path)
+        if (slot_count, bucket_count, sub_buckets, min_value) != \
+                (self.slot_count, self.bucket_count, self.sub_buckets, self.min_value):
+            raise ValueError('%s was created with a different layout, remove it to start over' % self.path)
+
+
+    def get_slot_offset(self, index):
+        return HEADER_SIZE + index * self.slot_size
+
+
+    def read_slot_key(self, index):
+        state, kind, key_length, _, key, _ = struct.unpack_from(
+            SLOT_KEY_FORMAT, self.map, self.get_slot_offset(index))
+        return state, kind, key[:key_length]
+
+
+    def probe(self, kind, key, claim_label=None):
+        start = int(hashlib.md5(key).hexdigest()[:8], 16) % self.slot_count
+        for step in range(self.slot_count):
+            index = (start + step) % self.slot_count
+            state, slot_kind, slot_key = self.read_slot_key(index)
+            if state == SLOT_EMPTY:
+                if claim_label is None:
+                    return None
+                label, label_length = claim_label
+                offset = self.get_slot_offset(index)
+                # Key first, then the state, so lock free readers never see
+                # a half written key
+                struct.pack_into(SLOT_KEY_FORMAT, self.map, offset,
+                                 SLOT_EMPTY, kind, len(key), label_length, key, label)
+                struct.pack_into('<B', self.map, offset, SLOT_USED)
+                return index
+            if slot_kind == kind and slot_key == key:
+                return index
+        return None
+
+
+    def get_slot_index(self, kind, key, label):
+        cache_key = (kind, key)
+        index = self.slot_indexes.get(cache_key)
+        if index is not None:
+            return index
+        encoded_key, _ = encode(key, KEY_SIZE)
+        index = self.probe(kind, encoded_key)
+        if index is None:
+            fcntl.lockf(self.file_descriptor, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                index = self.probe(kind, encoded_key, claim_label=encode(label, LABEL_SIZE))
+                if index is None:
+                    # Every slot is taken
+                    dropped, = struct.unpack_from('<Q', self.map, DROPPED_OFFSET)
+                    struct.pack_into('<Q', self.map, DROPPED_OFFSET, dropped + 1)
+                    return None
+            finally:
+                fcntl.lockf(self.file_descriptor, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        self.slot_indexes[cache_key] = index
+        return index
+
+
+    def add(self, kind, key, values, label=None, extra_total=0.0, extra_count=0):
+        """
+        Adds `values` (times in seconds) to the slot of `(kind, key)`.
+        """
+        with self.lock:
+            self.open()
+            index = self.get_slot_index(kind, key, label or key)
+            if index is None:
+                return
+            offset = self.get_slot_offset(index)
+            stats_offset = offset + SLOT_KEY_SIZE
+            buckets_offset = stats_offset + SLOT_STATS_SIZE
+            fcntl.lockf(self.file_descriptor, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                count, total, maximum, slot_extra_total, slot_extra_count = \
+                    struct.unpack_from(SLOT_STATS_FORMAT, self.map, stats_offset)
+                for value in values:
+                    bucket_offset = buckets_offset + self.histogram.get_bucket_index(value) * BUCKET_SIZE
+                    bucket, = struct.unpack_from(BUCKET_FORMAT, self.map, bucket_offset)
+                    struct.pack_into(BUCKET_FORMAT, self.map, bucket_offset, bucket + 1)
+                    count += 1
+                    total += value
+                    maximum = max(maximum, value)
+                struct.pack_into(SLOT_STATS_FORMAT, self.map, stats_offset, count, total, maximum,
+                                 slot_extra_total + extra_total, slot_extra_count + extra_count)
+            finally:
+                fcntl.lockf(self.file_descriptor, fcntl.LOCK_UN, self.slot_size, offset)
+
+
+    def add_view(self, view, method, request_time, sql_time, query_count):
+        key = '%s %s' % (method, view or '<unresolved>')
+        self.add(KIND_VIEW, key, (request_time,), extra_total=sql_time, extra_count=query_count)
+
+
+    def add_query(self, query_fingerprint, normalized_query, query_times):
+        self.add(KIND_QUERY, query_fingerprint, query_times, label=normalized_query)
+
+
+    def parse_slot(self, data, index):
+        offset = self.get_slot_offset(index)
+        state, kind, key_length, label_length, key, label = struct.unpack_from(SLOT_KEY_FORMAT, data, offset)
+        if state != SLOT_USED:
+            return None
+        stats_offset = offset + SLOT_KEY_SIZE
+        count, total, maximum, extra_total, extra_count = \
+            struct.unpack_from(SLOT_STATS_FORMAT, data, stats_offset)
+        if not count:
+            return None
+        buckets = struct.unpack_from('<%dQ' % self.bucket_count, data, stats_offset + SLOT_STATS_SIZE)
+        histogram = LogHistogram(self.min_value, self.sub_buckets, self.bucket_count)
+        histogram.buckets = list(buckets)
+        histogram.count = count
+        histogram.total = total
+        histogram.max = maximum
+        return {
+            'kind': KIND_NAMES.get(kind),
+            'key': key[:key_length].decode('utf-8', 'replace'),
+            'label': label[:label_length].decode('utf-8', 'replace'),
+            'histogram': histogram,
+            'extra_total': extra_total,
+            'extra_count': extra_count
+        }
+
+
+    def reset_counters(self):
+        # Keys stay where they are, other processes cache slot indexes
+        empty_stats = b'\0' * (self.slot_size - SLOT_KEY_SIZE)
+        for index in range(self.slot_count):
+            stats_offset = self.get_slot_offset(index) + SLOT_KEY_SIZE
+            self.map[stats_offset:stats_offset + len(empty_stats)] = empty_stats
+        struct.pack_into('<dQ', self.map, DROPPED_OFFSET - struct.calcsize('<d'), time.time(), 0)
+
+
+    def read(self, reset=False):
+        """
+        Copies the whole region under a shared lock (exclusive with `reset`)
+        and returns `(created, dropped, slots)`.
+        """
+        if reset and self.read_only:
+            raise ValueError('%s was opened read only and cannot be reset' % self.path)
+        with self.lock:
+            self.open()
+            lock_type = fcntl.LOCK_EX if reset else fcntl.LOCK_SH
+            fcntl.lockf(self.file_descriptor, lock_type, 0, 0)
+            try:
+                data = self.map[:]
+                if reset:
+                    self.reset_counters()
+            finally:
+                fcntl.lockf(self.file_descriptor, fcntl.LOCK_UN, 0, 0)
+
+        _, _, _, _, _, _, created, dropped = struct.unpack_from(HEADER_FORMAT, data, 0)
+        slots = []
+        for index in range(self.slot_count):
+            slot = self.parse_slot(data, index)
+            if slot is not None:
+                slots.append(slot)
+        return created, dropped, slots
+
+
+def summarize_slot(slot):
+    histogram = slot['histogram']
+    summary = {
+        'count': histogram.count,
+        'total_time': histogram.total,
+        'mean_time': histogram.total / histogram.count,
+        'max_time': histogram.max,
+        'p50': histogram.percentile(50),
+        'p95': histogram.percentile(95),
+        'p99': histogram.percentile(99)
+    }
+    if slot['kind'] == 'view':
+        method, view = slot['key'].split(' ', 1)
+        summary.update({
+            'view': view,
+            'method': method,
+            'sql_time_share': slot['extra_total'] / histogram.total if histogram.total else 0.0,
+            'mean_query_count': float(slot['extra_count']) / histogram.count
+        })
+    else:
+        summary.update({
+            'fingerprint': slot['key'],
+            'query': slot['label']
+        })
+    return summary
+
+
+def build_snapshot(metrics_list, reset=False):
+    """
+    Reads and merges the regions of several `SharedMetrics` (e.g. one per
+    application on the host) into per view and per query fingerprint
+    summaries, heaviest first.
+    """
+    merged = {}
+    dropped = 0
+    created = None
+    for metrics in metrics_list:
+        metrics_created, metrics_dropped, slots = metrics.read(reset=reset)
+        dropped += metrics_dropped
+        created = metrics_created if created is None else min(created, metrics_created)
+        for slot in slots:
+            key = (slot['kind'], slot['key'])
+            if key in merged:
+                merged_slot = merged[key]
+                merged_slot['histogram'].merge(slot['histogram'])
+                merged_slot['extra_total'] += slot['extra_total']
+                merged_slot['extra_count'] += slot['extra_count']
+            else:
+                merged[key] = slot
+
+    views = []
+    queries = []
+    for slot in merged.values():
+        (views if slot['kind'] == 'view' else queries).append(summarize_slot(slot))
+    views.sort(key=lambda summary: summary['total_time'], reverse=True)
+    queries.sort(key=lambda summary: summary['total_time'], reverse=True)
+    return {
+        'record_type': 'shared_metrics',
+        'start_time': created,
+        'end_time': time.time(),
+        'dropped_keys': dropped,
+        'views': views,
+        'queries': queries
+    }
+
+
+_shared_metrics = {}
+
+
+def get_shared_metrics(path=None, slot_count=1024):
+    key = (path, slot_count)
+    if key not in _shared_metrics:
+        _shared_metrics[key] = SharedMetrics(path, slot_count)
+    return _shared_metrics[key]
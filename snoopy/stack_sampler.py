@@ -0,0 +1,213 @@
+import atexit
+import signal
+import sys
+import threading
+import time
+
+
+MODE_THREAD = 'thread'
+MODE_SIGNAL = 'signal'
+MAX_STACK_DEPTH = 256
+MAX_LABEL_CACHE_SIZE = 50000
+
+_label_cache = {}
+
+
+def get_frame_label(code, frame):
+    label = _label_cache.get(code)
+    if label is None:
+        label = "%s::%s" % (frame.f_globals.get('__name__'), code.co_name)
+        if len(_label_cache) >= MAX_LABEL_CACHE_SIZE:
+            _label_cache.clear()
+        _label_cache[code] = label
+    return label
+
+
+def fold_stack(frame):
+    """
+    Returns the stack ending at `frame` in the collapsed format (root first,
+    frames separated by `;`).
+    """
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(get_frame_label(frame.f_code, frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class SampleCollector(object):
+    """
+    Folded stacks with sample counts for a single request.
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.total_samples = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+
+    def add_sample(self, frame):
+        self.add_stack(fold_stack(frame))
+
+
+    def add_stack(self, key):
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.total_samples += 1
+
+
+    def to_representation(self):
+        return {
+            'interval': self.interval,
+            'total_samples': self.total_samples,
+            'duration': (self.end_time or time.time()) - self.start_time,
+            'stacks': self.stacks
+        }
+
+
+class ThreadSampler(object):
+    """
+    A single daemon thread per process that periodically reads
+    `sys._current_frames()` and records the stacks of every thread that is
+    currently serving a profiled request.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.collectors = {}
+        self.lock = threading.Lock()
+        self.has_work = threading.Event()
+        self.thread = None
+        self.stopping = False
+        atexit.register(self.shutdown)
+
+
+    def ensure_running(self):
+        with self.lock:
+            if self.stopping or (self.thread is not None and self.thread.is_alive()):
+                return
+            self.thread = threading.Thread(target=self.run, name='snoopy-stack-sampler')
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def shutdown(self):
+        """
+        Stops the thread at exit, before the interpreter tears down the
+        modules and builtins it uses.
+        """
+        with self.lock:
+            self.stopping = True
+            thread = self.thread
+        self.has_work.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(1.0)
+
+
+    def run(self):
+        # Keep local references, module globals can be torn down before this
+        # daemon thread at interpreter shutdown.
+        sleep = time.sleep
+        current_frames = sys._current_frames
+        has_work = self.has_work
+        while not self.stopping:
+            has_work.wait()
+            sleep(self.interval)
+            if self.stopping:
+                break
+            frames = current_frames()
+            with self.lock:
+                collectors = list(self.collectors.values())
+            # Folded without the lock, only added to the collectors that are
+            # still registered so nothing changes once `stop` returned
+            samples = []
+            for collector in collectors:
+                frame = frames.get(collector.thread_id)
+                if frame is not None:
+                    samples.append((collector, fold_stack(frame)))
+            del frames
+            with self.lock:
+                for collector, key in samples:
+                    if id(collector) in self.collectors:
+                        collector.add_stack(key)
+
+
+    def start(self, thread_id):
+        collector = SampleCollector(thread_id, self.interval)
+        with self.lock:
+            # Keyed by collector, requests served concurrently on one thread
+            # by an event loop each get the samples of that thread.
+            self.collectors[id(collector)] = collector
+            self.has_work.set()
+        self.ensure_running()
+        return collector
+
+
+    def stop(self, collector):
+        with self.lock:
+            self.collectors.pop(id(collector), None)
+            if not self.collectors:
+                self.has_work.clear()
+        collector.end_time = time.time()
+        return collector
+
+
+class SignalSampler(object):
+    """
+    Uses `ITIMER_PROF` so samples are taken on CPU time of the process.
+    Signals are always delivered to the main thread, so this is only usable
+    when requests are served from the main thread (e.g. one process per worker,
+    no threads).
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.collector = None
+        self.previous_handler = None
+        self.previous_timer = None
+
+
+    def handle_signal(self, signum, frame):
+        collector = self.collector
+        if collector is not None and frame is not None:
+            collector.add_sample(frame)
+
+
+    def start(self, thread_id):
+        self.collector = SampleCollector(thread_id, self.interval)
+        previous_handler = signal.signal(signal.SIGPROF, self.handle_signal)
+        previous_timer = signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        if self.previous_timer is None:
+            # Put back at stop, e.g. for another profiler using SIGPROF
+            self.previous_handler = previous_handler
+            self.previous_timer = previous_timer
+        return self.collector
+
+
+    def stop(self, collector):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        self.collector = None
+        collector.end_time = time.time()
+        if self.previous_timer is not None:
+            # None when the handler was not installed from Python
+            signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+            signal.setitimer(signal.ITIMER_PROF, *self.previous_timer)
+            self.previous_handler = None
+            self.previous_timer = None
+        return collector
+
+
+_samplers = {}
+
+
+def get_sampler(mode, interval):
+    if mode == MODE_SIGNAL and not isinstance(threading.current_thread(), threading._MainThread):
+        # Signal handlers can only be installed from the main thread.
+        mode = MODE_THREAD
+    key = (mode, interval)
+    if key not in _samplers:
+        if mode == MODE_SIGNAL:
+            _samplers[key] = SignalSampler(interval)
+        else:
+            _samplers[key] = ThreadSampler(interval)
+    return _samplers[key]
@@ -0,0 +1,110 @@
+import json
+
+
+CHUNK_SIZE = 1024 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+class StreamingRecordReader(object):
+    """
+    Incrementally reads a single JSON object (one captured request) from a
+    file without loading it all in memory.
+
+    Top level arrays listed in `handlers` are never materialized: each of
+    their items is decoded and passed to the matching handler as soon as it
+    has been read. All other top level values are decoded normally and
+    returned from `read`.
+    """
+    def __init__(self, fileobj, handlers, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.handlers = handlers
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+
+    def read_more(self):
+        if self.eof:
+            return False
+        # Grow the read size with the buffer, so retrying the decode of a
+        # large value stays linear overall.
+        chunk = self.fileobj.read(max(self.chunk_size, len(self.buffer) - self.position))
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what has already been consumed so the buffer stays bounded
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                raise ValueError('Unexpected end of JSON input')
+
+
+    def expect(self, characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError('Expected one of %r at offset %d, got %r' % (
+                characters, self.position, character))
+        self.position += 1
+        return character
+
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.read_more():
+                    continue
+                raise
+            if end == len(self.buffer) and not self.eof:
+                # A number may continue in the next chunk, decode it again
+                # once there is more data.
+                if self.read_more():
+                    continue
+            self.position = end
+            return value
+
+
+    def stream_array(self, handler):
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            handler(self.decode_value())
+            if self.expect(',]') == ']':
+                return
+
+
+    def read(self):
+        result = {}
+        self.expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return result
+        while True:
+            key = self.decode_value()
+            self.expect(':')
+            handler = self.handlers.get(key)
+            if handler is not None and self.peek() == '[':
+                self.stream_array(handler)
+            else:
+                result[key] = self.decode_value()
+            if self.expect(',}') == '}':
+                return result
+
+
+def stream_record(fileobj, handlers, chunk_size=CHUNK_SIZE):
+    return StreamingRecordReader(fileobj, handlers, chunk_size).read()
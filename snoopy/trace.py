@@ -1,43 +1,83 @@
+from bisect import bisect_right
 from collections import defaultdict
 
 import datetime
 import json
 import re
 
-from snoopy.helpers import default_json_serializer
+from snoopy.helpers import default_json_serializer, parse_isoformat
 
 
 TRACE_KEY_REGEX = r"([^:]+)::([^:]+):([\d]+)"
 PYTHON_DATEFORMAT = "%Y-%m-%dT%H:%M:%S.%f"
-TRACE_THRESHOLD = 0 #  Bring config for this in the future
+# Calls that took this many seconds or less are left out of the tree. Also see
+# SNOOPY_BUILTIN_PROFILER_MIN_DURATION to drop them while tracing.
+TRACE_THRESHOLD = 0
+# Key of the node added above the top level calls when there are several
+ROOT_KEY = "snoopy.trace::<request>:0"
+
+
+class TraceKeySymbols(object):
+    """
+    Parses each distinct trace key only once. A request produces a huge number
+    of events but only a few distinct keys.
+    """
+    def __init__(self):
+        self.symbols = {}
+
+
+    def get(self, key):
+        symbol = self.symbols.get(key)
+        if symbol is None:
+            symbol = re.search(TRACE_KEY_REGEX, key).groups()
+            self.symbols[key] = symbol
+        return symbol
+
+
+def to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=timestamp)
 
 
 class FunctionCall(object):
-    def __init__(self, trace_data, previous=None):
+    """
+    Times are kept as float seconds (see `parse_isoformat`) and are only turned
+    back into datetimes for the representation.
+    """
+    __slots__ = ('key', 'module', 'function', 'line_number', 'end_line_number', 'start_time',
+                 'end_time', 'total_time', 'queries', 'next', 'previous')
+
+    def __init__(self, trace_data, previous=None, symbols=None):
         self.key = trace_data['key']
         self.queries = []
         self.next = []
         self.previous = previous
-        self.start_time = datetime.datetime.strptime(trace_data['start_time'], PYTHON_DATEFORMAT)
-        self.module, self.function, self.line_number = re.search(TRACE_KEY_REGEX, trace_data['key']).groups()
+        self.start_time = parse_isoformat(trace_data['start_time'])
+        self.end_time = None
+        self.total_time = None
+        self.end_line_number = None
+        symbols = symbols or TraceKeySymbols()
+        self.module, self.function, self.line_number = symbols.get(self.key)
 
 
-    def record_return(self, data):
-        module, function, line_number = re.search(TRACE_KEY_REGEX, data['key']).groups()
+    def record_return(self, data, symbols=None):
+        symbols = symbols or TraceKeySymbols()
+        module, function, line_number = symbols.get(data['key'])
         assert module == self.module
         assert function == self.function
-        self.end_time = datetime.datetime.strptime(data['end_time'], PYTHON_DATEFORMAT)
+        self.end_time = parse_isoformat(data['end_time'])
         self.end_line_number = line_number
-        self.total_time = (self.end_time - self.start_time).total_seconds()
+        self.total_time = round(self.end_time - self.start_time, 6)
 
 
     def record_query(self, query):
         self.queries.append({
             'start_time': query['start_time'],
-            'query_time': query['total_query_time'],
+            'query_time': query.get('total_query_time'),
             'query': query['query'],
-            'model': query['model'],
-            'key': query['function_call_key']
+            'model': query.get('model'),
+            'key': query.get('function_call_key')
         })
 
 
@@ -47,8 +87,8 @@ class FunctionCall(object):
             'total_time': self.total_time,
             'queries': self.queries,
             'stats': {
-                'call': self.start_time,
-                'return': self.end_time,
+                'call': to_datetime(self.start_time),
+                'return': to_datetime(self.end_time),
                 'line_numbers': {
                     'start': self.line_number,
                     'end': self.end_line_number
@@ -96,16 +136,23 @@ class Trace(object):
 
     TODO: Combine trace info with SQL timings
     """
-    def __init__(self, trace_data, query_data):
+    def __init__(self, trace_data, query_data, threshold=TRACE_THRESHOLD):
+        self.threshold = threshold
         self.raw_data = {
             'trace_data': trace_data,
             'query_data': query_data
         }
         self.root = None
+        self.roots = []
 
         self.nodes = []
         self.function_calls = defaultdict(list)
         self.current_node = None
+        self.symbols = TraceKeySymbols()
+
+        # Every call in start time order, used to attribute queries
+        self.calls = []
+        self.call_start_times = []
 
         self.process(trace_data, query_data)
 
@@ -121,41 +168,94 @@ class Trace(object):
     def process_trace(self, entry):
         event = 'call' if 'start_time' in entry else 'return'
         if event == 'call':
-            trace = FunctionCall(entry, previous=self.current_node)
+            trace = FunctionCall(entry, previous=self.current_node, symbols=self.symbols)
+            if self.current_node is None:
+                self.roots.append(trace)
             self.nodes.append(trace)
+            self.calls.append(trace)
+            self.call_start_times.append(trace.start_time)
             self.current_node = trace
         elif event == 'return':
             trace = self.nodes.pop()
-            trace.record_return(entry)
+            trace.record_return(entry, symbols=self.symbols)
             self.function_calls[trace.key].append(trace)
             self.current_node = trace.previous
             if self.current_node:
-                if trace.total_time > TRACE_THRESHOLD:
+                if trace.total_time > self.threshold:
                     self.current_node.next.append(trace)
         return trace
 
 
-    def find_node(self, key_info):
-        key, timestamp = key_info[0], datetime.datetime.strptime(key_info[1], PYTHON_DATEFORMAT)
-        for trace in self.function_calls[key]:
-            if trace.start_time == timestamp:
-                return trace
-        return self.root
+    def find_node(self, timestamp):
+        """
+        Returns the innermost call that was running at `timestamp`: the last
+        call that started before it, or the closest of its parents that had
+        not returned yet.
+        """
+        index = bisect_right(self.call_start_times, timestamp) - 1
+        if index < 0:
+            return self.root
+        node = self.calls[index]
+        while node is not None and node.end_time is not None and node.end_time < timestamp:
+            node = node.previous
+        return node or self.root
+
+
+    def find_query_node(self, query):
+        """
+        Returns the call that ran `query`. Its start time is taken by Snoopy's
+        wrapper, before the traced code that runs it (e.g.
+        `SQLCompiler.execute_sql`) is called, so that is the outermost call
+        that started during the query, if any, or else the innermost call
+        that was running. Calls left out of the tree by the threshold hand
+        their queries to their parent.
+        """
+        start_time = parse_isoformat(query['start_time'])
+        end_time = parse_isoformat(query['end_time']) if query.get('end_time') else start_time
+        node = self.find_node((start_time + end_time) / 2)
+        while node.previous is not None and node.previous.start_time >= start_time:
+            node = node.previous
+        while node.previous is not None and node.total_time is not None and node.total_time <= self.threshold:
+            node = node.previous
+        return node
+
+
+    def make_root(self):
+        """
+        Several top level calls happen when tracing starts outside of the
+        function that ends up calling everything else (e.g. the middleware).
+        They go under a node spanning all of them, so that the trace has a
+        single root either way and queries made between them have a node.
+        """
+        first, last = self.roots[0], self.roots[-1]
+        root = FunctionCall({
+            'key': ROOT_KEY,
+            'start_time': to_datetime(first.start_time).isoformat()
+        }, symbols=self.symbols)
+        root.start_time = first.start_time
+        if last.end_time is not None:
+            root.end_time = last.end_time
+            root.total_time = round(last.end_time - first.start_time, 6)
+        root.next = list(self.roots)
+        for node in self.roots:
+            node.previous = root
+        return root
 
 
     def process(self, trace_data, query_data):
-        first_entry = trace_data.pop(0)
+        entries = iter(trace_data)
 
         # Process traces
-        self.root = self.process_trace(first_entry)
-        for entry in trace_data:
+        self.root = self.process_trace(next(entries))
+        for entry in entries:
             self.process_trace(entry)
+        if len(self.roots) > 1:
+            self.root = self.make_root()
 
         # Process queries
         self.current_node = self.root
         for entry in query_data:
-            node = self.find_node(entry['function_call_key'])
-            node.record_query(entry)
+            self.find_query_node(entry).record_query(entry)
 
         return self.root
 
@@ -197,7 +297,7 @@ def main():
         }
 
     ]
-    print Trace(data, query_data)
+    print(Trace(data, query_data))
 
 
 if __name__ == '__main__':
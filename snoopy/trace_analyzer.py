@@ -1,19 +1,23 @@
+from __future__ import print_function
+
 from collections import defaultdict
 
-from snoopy.helpers import get_app_root, default_json_serializer
-from snoopy.trace import Trace
+from snoopy.call_tree import format_call_tree_summary, summarize_call_tree
+from snoopy.helpers import get_app_root, default_json_serializer, parse_isoformat
+from snoopy.line_profiler import format_line_profile
+from snoopy.streaming import stream_record
+from snoopy.trace import Trace, TRACE_THRESHOLD
 
-import datetime
 import json
-import re
 
 
 DJANGO_DB_QUERY_FILE = "django/db/models/query.py"
 
 
 class TraceAnalyzer(object):
-    def __init__(self, data):
+    def __init__(self, data, trace_threshold=TRACE_THRESHOLD):
         self.trace_data = data
+        self.trace_threshold = trace_threshold
         self.trace = None
         self.query_info = {}
         self.profiler_info = {}
@@ -30,7 +34,7 @@ class TraceAnalyzer(object):
 
 
     def summarize_profiler_result(self):
-        print json.dumps(self.trace, indent=4, default=default_json_serializer)
+        print(json.dumps(self.trace, indent=4, default=default_json_serializer))
 
 
     def process_traceback_line(self, line):
@@ -43,23 +47,32 @@ class TraceAnalyzer(object):
         }
 
 
+    def process_traceback_frame(self, frame):
+        # Older captures store the output of `traceback.format_stack()`
+        if isinstance(frame, dict):
+            return frame
+        return self.process_traceback_line(frame)
+
+
     def process_query(self, query):
         query_data = {
             'model': query['model'],
             'total_query_time': query['total_query_time'],
-            'query_type': 'read'
+            'query_type': query.get('query_type', 'read')
         }
-        previous_line = ""
+        previous_file_name = ""
         best_non_app_code_line = ""
         best_app_code_line = ""
 
-        for line in reversed(query['traceback']):
-            if DJANGO_DB_QUERY_FILE in previous_line and not DJANGO_DB_QUERY_FILE in line:
-                best_non_app_code_line = self.process_traceback_line(line)
-            if self.app_root in line:
-                best_app_code_line = self.process_traceback_line(line)
+        for frame in reversed(query['traceback']):
+            frame = self.process_traceback_frame(frame)
+            file_name = frame['file_name']
+            if previous_file_name.endswith(DJANGO_DB_QUERY_FILE) and not file_name.endswith(DJANGO_DB_QUERY_FILE):
+                best_non_app_code_line = frame
+            if file_name.startswith(self.app_root):
+                best_app_code_line = frame
                 break
-            previous_line = line
+            previous_file_name = file_name
 
         if best_app_code_line != "":
             best_line = best_app_code_line
@@ -69,58 +82,98 @@ class TraceAnalyzer(object):
         return query_data
 
 
-    def process_queries(self):
-        self.query_info['total_queries'] = len(self.trace_data['queries'])
-        if self.query_info['total_queries'] == 0:
-            return
-
+    def init_query_info(self):
+        self.query_info['total_queries'] = 0
         self.query_info['stats'] = {
             'query_type': defaultdict(int),
             'model': {},
         }
         self.query_info['total_time_on_queries'] = 0.0
+
+
+    def add_query(self, query):
+        query_data = self.process_query(query)
+        if not query_data:
+            return
+        self.query_info['total_queries'] += 1
+        self.query_info['stats']['query_type'][query_data['query_type']] += 1
+
+        model_info = self.query_info['stats']['model'].setdefault(query_data['model'], {
+            'query_type': {},
+            'total_query_count': 0
+        })
+        model_info['total_query_count'] += 1
+        model_query_type_info = model_info['query_type'].setdefault(query_data['query_type'], {
+            'count': 0,
+            'total_query_time': 0.0,
+            'max_query_time': 0.0,
+            'max_query_time_code': None
+        })
+        model_query_type_info['count'] += 1
+        model_query_type_info['total_query_time'] += query_data['total_query_time']
+
+        if model_query_type_info['max_query_time'] < query_data['total_query_time']:
+            model_query_type_info['max_query_time'] = query_data['total_query_time']
+            model_query_type_info['max_query_time_code'] = query_data['code']
+
+        self.query_info['total_time_on_queries'] += query_data['total_query_time']
+
+
+    def process_queries(self):
+        self.init_query_info()
         for query in self.trace_data['queries']:
-            query_data = self.process_query(query)
-            if not query_data:
-                continue
-            self.query_info['stats']['query_type'][query_data['query_type']] += 1
-
-            if query_data['model'] not in self.query_info['stats']['model']:
-                new_model_info = {
-                    'query_type': {
-                        query_data['query_type'] : {
-                            'count': 0,
-                            'total_query_time': 0.0,
-                            'max_query_time': 0.0,
-                            'max_query_time_code': None
-                        }
-                    },
-                    'total_query_count': 0
-                }
-
-            self.query_info['stats']['model'][query_data['model']] = new_model_info
-
-            model_info = self.query_info['stats']['model'][query_data['model']]
-            model_info['total_query_count'] += 1
-            model_query_type_info = model_info['query_type'][query_data['query_type']]
-            model_query_type_info['count'] += 1
-            model_query_type_info['total_query_time'] += query_data['total_query_time']
-
-            if model_query_type_info['max_query_time'] < query_data['total_query_time']:
-                model_query_type_info['max_query_time'] = query_data['total_query_time']
-                model_query_type_info['max_query_time_code'] = query_data['code']
-
-            self.query_info['total_time_on_queries'] += query_data['total_query_time']
+            self.add_query(query)
 
 
     def summarize_queries(self):
         if self.query_info['total_queries'] == 0:
             return
 
-        print "Total SQL Queries: %d" % self.query_info['total_queries']
-        print 'Total time on SQL Queries: %0.4f' % self.query_info['total_time_on_queries']
-        print 'Stats on SQL Queries:'
-        print json.dumps(self.query_info['stats'], indent=4)
+        print("Total SQL Queries: %d" % self.query_info['total_queries'])
+        print('Total time on SQL Queries: %0.4f' % self.query_info['total_time_on_queries'])
+        print('Stats on SQL Queries:')
+        print(json.dumps(self.query_info['stats'], indent=4))
+
+
+    def summarize_memory_profile(self):
+        memory_profile = self.trace_data.get('memory_profile')
+        if not memory_profile:
+            return
+
+        if 'peak_memory' in memory_profile:
+            print('Peak traced memory: %d bytes' % memory_profile['peak_memory'])
+            print('Net allocated memory: %d bytes' % memory_profile['net_allocated'])
+        for allocation in memory_profile.get('top_allocations', []):
+            print('%12d bytes %8d blocks  %s' % (allocation['size'], allocation['count'], allocation['site']))
+        gc_stats = memory_profile.get('gc')
+        if gc_stats:
+            print('GC collections (gen 0/1/2): %d/%d/%d, %0.4f seconds paused (max %0.4f)' % (
+                tuple(gc_stats['collections']) + (gc_stats['pause_time'], gc_stats['max_pause_time'])))
+        if 'max_rss_growth' in memory_profile:
+            print('Max RSS growth: %d bytes' % memory_profile['max_rss_growth'])
+            print('GC counts (gen 0/1/2): %d/%d/%d at start, %d/%d/%d at end' % (
+                tuple(memory_profile['gc_count']['start']) + tuple(memory_profile['gc_count']['end'])))
+
+
+    def summarize_line_profile(self):
+        if self.trace_data.get('line_profile'):
+            print(format_line_profile(self.trace_data['line_profile']))
+
+
+    def summarize_database_activity(self):
+        database_activity = self.trace_data.get('database_activity')
+        if not database_activity:
+            return
+
+        for alias, stats in sorted(database_activity['aliases'].items()):
+            print('%s: %d statements in %0.4f seconds, %d rows fetched, %d rows affected' % (
+                alias, stats['statements'], stats['statement_time'], stats['rows_fetched'], stats['rows_affected']))
+            print('    %d connections opened in %0.4f seconds' % (stats['connections_opened'], stats['connect_time']))
+            print('    %d transactions (%d commits, %d rollbacks) open for %0.4f seconds, %0.4f idle' % (
+                stats['transactions'], stats['commits'], stats['rollbacks'],
+                stats['transaction_time'], stats['transaction_idle_time']))
+        if database_activity['dropped_statements']:
+            print('%d statements not kept (SNOOPY_CURSOR_QUERIES_MAX_STATEMENTS)' % database_activity['dropped_statements'])
 
 
     def summarize(self):
@@ -128,14 +181,120 @@ class TraceAnalyzer(object):
         # print "URL: " + self.trace_data['request']
         # self.summarize_queries()
         self.summarize_profiler_result()
-        pass
+        self.summarize_memory_profile()
+        self.summarize_line_profile()
+        self.summarize_database_activity()
 
 
     def analyze(self):
         self.process_queries()
+        if 'profiler_tree' in self.trace_data:
+            # Calls are already merged, there is no event to rebuild the tree from
+            print(format_call_tree_summary(summarize_call_tree(self.trace_data['profiler_tree'])))
+            self.summarize_memory_profile()
+            self.summarize_line_profile()
+            self.summarize_database_activity()
+            return
+
         self.process_builtin_profiler_result()
 
-        self.trace = Trace(self.trace_data['profiler_traces'], self.trace_data['queries'])
+        self.trace = Trace(self.trace_data['profiler_traces'], self.trace_data['queries'],
+                           threshold=self.trace_threshold)
 
         # TODO: Do the cProfiler processing as well
         self.summarize()
+
+
+class StreamingTraceAnalyzer(TraceAnalyzer):
+    """
+    Analyzes a capture file without loading it in memory.
+
+    `profiler_traces` and `queries` are read one item at a time and folded into
+    per function and per model aggregates, so memory use depends on the number
+    of distinct functions and the call depth rather than on the number of
+    events. The full call tree is not built.
+    """
+    def __init__(self, trace_file):
+        super(StreamingTraceAnalyzer, self).__init__({})
+        self.trace_file = trace_file
+        self.call_stack = []
+        self.function_stats = {}
+        self.unmatched_returns = 0
+        self.profiler_info['total_traces'] = 0
+        self.init_query_info()
+
+
+    def get_function_stats(self, key):
+        # Keys look like `module::function:line`, the line differs between
+        # the call and the return event.
+        function_key = key.rsplit(':', 1)[0]
+        stats = self.function_stats.get(function_key)
+        if stats is None:
+            stats = {
+                'count': 0,
+                'total_time': 0.0,
+                'self_time': 0.0,
+                'max_time': 0.0,
+                'query_count': 0,
+                'total_query_time': 0.0
+            }
+            self.function_stats[function_key] = stats
+        return function_key, stats
+
+
+    def add_trace(self, entry):
+        if 'start_time' in entry:
+            _, stats = self.get_function_stats(entry['key'])
+            # [function stats, start time, time spent in children]
+            self.call_stack.append([stats, parse_isoformat(entry['start_time']), 0.0])
+            return
+
+        if not self.call_stack:
+            # Return of a call made before tracing started
+            self.unmatched_returns += 1
+            return
+        # Like `Trace`, a return always ends the innermost running call
+        stats, start_time, child_time = self.call_stack.pop()
+        total_time = parse_isoformat(entry['end_time']) - start_time
+        self.profiler_info['total_traces'] += 1
+        stats['count'] += 1
+        stats['total_time'] += total_time
+        stats['self_time'] += total_time - child_time
+        stats['max_time'] = max(stats['max_time'], total_time)
+        if self.call_stack:
+            self.call_stack[-1][2] += total_time
+
+
+    def add_query(self, query):
+        super(StreamingTraceAnalyzer, self).add_query(query)
+        function_call_key = query.get('function_call_key')
+        if function_call_key and function_call_key[0]:
+            _, stats = self.get_function_stats(function_call_key[0])
+            stats['query_count'] += 1
+            stats['total_query_time'] += query['total_query_time']
+
+
+    def summarize_profiler_result(self):
+        print("Total traced calls: %d" % self.profiler_info['total_traces'])
+        if self.unmatched_returns or self.call_stack:
+            print("Unbalanced events: %d returns without calls, %d calls without returns" % (
+                self.unmatched_returns, len(self.call_stack)))
+        functions = sorted(self.function_stats.items(), key=lambda item: item[1]['total_time'], reverse=True)
+        print(json.dumps(functions, indent=4))
+
+
+    def summarize(self):
+        if 'total_request_time' in self.trace_data:
+            print("Total Request Time: %0.4f" % self.trace_data['total_request_time'])
+        if 'request' in self.trace_data:
+            print("URL: " + self.trace_data['request'])
+        self.summarize_queries()
+        self.summarize_profiler_result()
+
+
+    def analyze(self):
+        self.trace_data = stream_record(self.trace_file, {
+            'profiler_traces': self.add_trace,
+            'queries': self.add_query
+        })
+        self.summarize()
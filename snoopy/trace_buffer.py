@@ -0,0 +1,280 @@
+from array import array
+
+import datetime
+import sys
+import threading
+import time
+import timeit
+
+
+EVENT_CALL = 0
+EVENT_RETURN = 1
+
+TRUNCATION_STOP = 'stop'
+TRUNCATION_RAISE_THRESHOLD = 'raise_threshold'
+
+# Smallest threshold used when the raise_threshold policy kicks in
+MIN_RAISED_THRESHOLD_NS = 1000
+
+
+if hasattr(time, 'perf_counter_ns'):
+    now_ns = time.perf_counter_ns
+else:
+    def now_ns():
+        return int(timeit.default_timer() * 1000000000)
+
+
+def _get_timestamp_typecode():
+    # 'q' is only available from Python 3.3 onwards
+    try:
+        array('q')
+        return 'q'
+    except ValueError:
+        return 'l' if array('l').itemsize >= 8 else 'd'
+
+
+TIMESTAMP_TYPECODE = _get_timestamp_typecode()
+
+
+class SymbolTable(object):
+    """
+    Process wide table of code locations. Each location gets a small integer
+    id the first time it is seen, and the trace key string for it is only
+    formatted once.
+
+    Locations are identified by the file, first line and name of the code and
+    the line number rather than by the code object, so the table doesn't keep
+    code objects alive (e.g. of templates compiled at runtime), and code that
+    gets compiled again reuses its ids.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.lock = threading.Lock()
+
+
+    def intern(self, frame, key_prefix=None):
+        code = frame.f_code
+        location = (code.co_filename, code.co_firstlineno, code.co_name, frame.f_lineno)
+        location_id = self.ids.get(location)
+        if location_id is None:
+            if key_prefix is None:
+                key_prefix = "%s::%s:" % (frame.f_globals.get('__name__'), code.co_name)
+            key = "%s%d" % (key_prefix, frame.f_lineno)
+            with self.lock:
+                location_id = self.ids.get(location)
+                if location_id is None:
+                    location_id = len(self.keys)
+                    self.keys.append(key)
+                    self.ids[location] = location_id
+        return location_id
+
+
+    def get_key(self, location_id):
+        return self.keys[location_id]
+
+
+symbol_table = SymbolTable()
+
+
+class TraceBuffer(object):
+    """
+    Column oriented store for the builtin profiler events of a single request.
+
+    Events are kept as three parallel arrays (event type, location id and
+    nanoseconds since the buffer was created) instead of one dict per event.
+    They are only expanded to the `{'key': ..., 'start_time' / 'end_time': ...}`
+    dicts the analyzers expect when the request data gets serialized.
+
+    Limits are applied while tracing:
+
+    - Calls that return within `min_duration` seconds without having made any
+      traced call or SQL query are dropped, so only their parent's time is
+      left.
+    - At most `max_events` events (or `max_memory` bytes worth of them) are
+      kept. Once the buffer is full, `TRUNCATION_STOP` ignores new calls
+      (returns of calls already recorded are still kept) and
+      `TRUNCATION_RAISE_THRESHOLD` doubles `min_duration` and drops the
+      recorded calls that are now too short, so the buffer ends up with the
+      slowest calls of the whole request. The cap is never exceeded: when
+      the calls still running and the pinned ones fill the buffer, new calls
+      are dropped as with `TRUNCATION_STOP`.
+    """
+    def __init__(self, symbols=symbol_table, min_duration=0, max_events=None, max_memory=None,
+                 truncation_policy=TRUNCATION_STOP):
+        self.symbols = symbols
+        self.events = array('b')
+        self.locations = array('i')
+        self.timestamps = array(TIMESTAMP_TYPECODE)
+        self.start_ns = now_ns()
+        self.start_time = datetime.datetime.now()
+
+        self.min_duration_ns = int((min_duration or 0) * 1000000000)
+        self.max_events = max_events or sys.maxsize
+        if max_memory:
+            self.max_events = min(self.max_events, max(max_memory // self.get_event_size(), 2))
+        self.truncation_policy = truncation_policy
+
+        # Index of the call event of every call that has not returned yet,
+        # None for the calls that were not recorded
+        self.open_calls = []
+        # Calls that started before this length ran a query and are kept
+        self.pinned_length = 0
+        self.pruned_calls = 0
+        self.dropped_calls = 0
+        self.dropped_returns = 0
+        self.raised_threshold = False
+
+
+    def __len__(self):
+        return len(self.events)
+
+
+    def get_event_size(self):
+        return self.events.itemsize + self.locations.itemsize + self.timestamps.itemsize
+
+
+    def pin(self):
+        """
+        Keeps the calls currently running from being dropped by
+        `min_duration` when they return, e.g. because they ran a SQL query.
+        """
+        self.pinned_length = len(self.events)
+
+
+    def record_query(self, function_key, query_time):
+        """
+        Queries are matched with the calls when the trace is analyzed, from
+        their start time.
+        """
+        pass
+
+
+    def append(self, event, frame, key_prefix=None):
+        timestamp = now_ns() - self.start_ns
+        if event == EVENT_CALL:
+            if len(self.events) >= self.max_events and not self.make_room():
+                self.open_calls.append(None)
+                self.dropped_calls += 1
+                return None, timestamp
+            self.open_calls.append(len(self.events))
+        elif self.open_calls:
+            index = self.open_calls.pop()
+            if index is None:
+                # The call was not recorded either
+                return None, timestamp
+            if index == len(self.events) - 1 and index >= self.pinned_length and \
+                    timestamp - self.timestamps[index] < self.min_duration_ns:
+                # A leaf call that was too short, forget about it
+                self.events.pop()
+                self.locations.pop()
+                self.timestamps.pop()
+                self.pruned_calls += 1
+                return None, timestamp
+        elif len(self.events) >= self.max_events:
+            # Return of a call made before tracing started, with no room left
+            self.dropped_returns += 1
+            return None, timestamp
+
+        location_id = self.symbols.intern(frame, key_prefix)
+        self.events.append(event)
+        self.locations.append(location_id)
+        self.timestamps.append(timestamp)
+        return location_id, timestamp
+
+
+    def make_room(self):
+        if self.truncation_policy != TRUNCATION_RAISE_THRESHOLD:
+            return False
+        target = self.max_events * 3 // 4
+        # No finished call can be longer than the whole buffer
+        elapsed = self.timestamps[-1] - self.timestamps[0]
+        while len(self.events) > target and self.min_duration_ns <= elapsed:
+            self.compact(max(self.min_duration_ns * 2, MIN_RAISED_THRESHOLD_NS))
+        return len(self.events) < self.max_events
+
+
+    def compact(self, threshold):
+        """
+        Drops every finished call shorter than `threshold` nanoseconds, with
+        its return, unless it is pinned. All of the calls it made are shorter
+        and none of them is pinned, so they go too.
+        """
+        events, locations, timestamps = self.events, self.locations, self.timestamps
+        pinned_length = self.pinned_length
+        keep = [True] * len(events)
+        stack = []
+        for index, event in enumerate(events):
+            if event == EVENT_CALL:
+                stack.append(index)
+            elif stack:
+                call_index = stack.pop()
+                if call_index >= pinned_length and timestamps[index] - timestamps[call_index] < threshold:
+                    keep[call_index] = keep[index] = False
+
+        self.min_duration_ns = threshold
+        removed = keep.count(False)
+        if not removed:
+            return
+        self.raised_threshold = True
+
+        new_indexes = {}
+        new_events = array('b')
+        new_locations = array('i')
+        new_timestamps = array(TIMESTAMP_TYPECODE)
+        for index, kept in enumerate(keep):
+            if not kept:
+                continue
+            new_indexes[index] = len(new_events)
+            new_events.append(events[index])
+            new_locations.append(locations[index])
+            new_timestamps.append(timestamps[index])
+
+        # The pinned events come first and are all kept, pinned_length holds
+        self.events, self.locations, self.timestamps = new_events, new_locations, new_timestamps
+        self.open_calls = [None if index is None else new_indexes[index] for index in self.open_calls]
+        self.pruned_calls += removed // 2
+
+
+    def get_stats(self):
+        return {
+            'events': len(self.events),
+            'max_events': self.max_events if self.max_events != sys.maxsize else None,
+            'min_duration': self.min_duration_ns / 1000000000.0,
+            'truncation_policy': self.truncation_policy,
+            'pruned_calls': self.pruned_calls,
+            'dropped_calls': self.dropped_calls,
+            'dropped_returns': self.dropped_returns,
+            'raised_threshold': self.raised_threshold
+        }
+
+
+    def is_truncated(self):
+        return bool(self.dropped_calls or self.dropped_returns or self.raised_threshold)
+
+
+    def to_datetime(self, timestamp):
+        return self.start_time + datetime.timedelta(microseconds=timestamp // 1000)
+
+
+    def expand_key(self, function_key):
+        """
+        Converts a `(location_id, timestamp)` pair returned by `append` into
+        the `[key, datetime]` form used for `function_call_key`.
+        """
+        location_id, timestamp = function_key
+        if location_id is None:
+            return [None, None]
+        return [self.symbols.get_key(location_id), self.to_datetime(timestamp)]
+
+
+    def to_representation(self):
+        result = []
+        get_key = self.symbols.get_key
+        for event, location_id, timestamp in zip(self.events, self.locations, self.timestamps):
+            time_key = 'start_time' if event == EVENT_CALL else 'end_time'
+            result.append({
+                'key': get_key(location_id),
+                time_key: self.to_datetime(timestamp)
+            })
+        return result
@@ -0,0 +1,8 @@
+from django.urls import re_path
+
+from tests import async_views
+
+
+urlpatterns = [
+    re_path(r'^users/(?P<count>\d+)/$', async_views.users),
+]
@@ -0,0 +1,20 @@
+"""
+Python 3 only, see `tests.test_middleware.AsyncMiddlewareTests`.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+
+
+async def users(request, count):
+    for index in range(int(count)):
+        await sync_to_async(list)(User.objects.filter(id=index))
+        # Let the other request run a query in between
+        await asyncio.sleep(0.01)
+    return HttpResponse('ok')
+
+
+async def get_concurrently(client, *paths):
+    return await asyncio.gather(*[client.get(path) for path in paths])
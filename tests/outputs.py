@@ -0,0 +1,9 @@
+from snoopy.output import OutputBase
+
+
+class MemoryOutput(OutputBase):
+    records = []
+
+    @staticmethod
+    def save_request_data(request_data):
+        MemoryOutput.records.append(request_data)
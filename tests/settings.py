@@ -0,0 +1,23 @@
+SECRET_KEY = 'snoopy-tests'
+
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'snoopy',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+# MIDDLEWARE_CLASSES for Django < 1.10
+MIDDLEWARE = MIDDLEWARE_CLASSES = [
+    'snoopy.middleware.SnoopyProfilerMiddleware',
+]
+
+ROOT_URLCONF = 'tests.urls'
+
+SNOOPY_OUTPUT_CLASS = 'tests.outputs.MemoryOutput'
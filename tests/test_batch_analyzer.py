@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+
+from snoopy import segments
+from snoopy.batch_analyzer import BatchAnalyzer, analyze_file, merge_partials
+
+
+class BatchAnalyzerTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def write_capture(self, name, request, view_name, request_time, query_count=0):
+        record = {
+            'request': request,
+            'method': 'GET',
+            'total_request_time': request_time,
+            'queries': [{'total_query_time': 0.001}] * query_count
+        }
+        if view_name is not None:
+            record['view_name'] = view_name
+        with open(os.path.join(self.directory, name), 'w') as capture_file:
+            json.dump(record, capture_file)
+
+
+    def test_groups_by_view_name(self):
+        self.write_capture('1.log', '/users/1/', 'user-detail', 0.1, query_count=2)
+        self.write_capture('2.log', '/users/2/', 'user-detail', 0.3, query_count=4)
+        self.write_capture('3.log', '/missing/', None, 0.05)
+        self.write_capture('4.log', '/missing/', None, 0.05)
+        self.write_capture('5.log', '/other/', None, 0.05)
+        analyzer = BatchAnalyzer([self.directory], processes=1)
+        endpoints = dict((summary['endpoint'], summary) for summary in analyzer.analyze())
+        self.assertEqual(sorted(endpoints), ['/missing/', '/other/', 'user-detail'])
+        self.assertEqual(endpoints['user-detail']['count'], 2)
+        self.assertAlmostEqual(endpoints['user-detail']['p50'], 0.1, delta=0.005)
+        self.assertEqual(endpoints['user-detail']['p99'], 0.3)
+        self.assertEqual(endpoints['user-detail']['max_query_count'], 4)
+        self.assertEqual(endpoints['/missing/']['count'], 2)
+
+
+    def test_merges_worker_summaries(self):
+        for index in range(10):
+            self.write_capture('%d.log' % index, '/users/', 'user-list', (index + 1) / 10.0, query_count=index)
+        merged = {}
+        for index in range(10):
+            merge_partials(merged, analyze_file(os.path.join(self.directory, '%d.log' % index))[0])
+        partial = merged[('user-list', 'GET')]
+        self.assertEqual(partial['request_times'].count, 10)
+        self.assertEqual(sum(partial['query_counts'].values()), 10)
+        self.assertAlmostEqual(partial['sql_time'], 0.045)
+        summary, = BatchAnalyzer([self.directory], processes=2).analyze()
+        self.assertEqual(summary['count'], 10)
+        self.assertAlmostEqual(summary['total_request_time'], 5.5)
+        self.assertAlmostEqual(summary['p95'], 1.0, delta=0.05)
+        self.assertEqual((summary['query_count_p50'], summary['max_query_count']), (4, 9))
+        self.assertEqual(summary['mean_query_count'], 4.5)
+
+
+    def test_zstd_segments_without_zstandard(self):
+        self.write_capture('1.log', '/users/', 'user-list', 0.1)
+        with open(os.path.join(self.directory, 'snoopy-1.jsonl.zst'), 'wb') as segment_file:
+            segment_file.write(b'')
+        zstandard = segments.zstandard
+        segments.zstandard = None
+        try:
+            with self.assertRaises(ImportError):
+                BatchAnalyzer([self.directory], processes=2).analyze()
+            with self.assertRaises(CommandError) as context:
+                call_command('snoop', batch=[self.directory])
+            self.assertIn('zstandard', str(context.exception))
+        finally:
+            segments.zstandard = zstandard
@@ -0,0 +1,61 @@
+import sys
+
+from django.test import SimpleTestCase
+
+from snoopy.call_tree import CPU_CLOCK, CallTree, format_call_tree_summary, summarize_call_tree
+from snoopy.trace_buffer import EVENT_CALL, EVENT_RETURN
+
+
+def record_calls(tree):
+    """
+    Feeds `tree` the calls of `outer`, which calls `inner` three times.
+    """
+    def inner():
+        frame = sys._getframe()
+        tree.append(EVENT_CALL, frame)
+        tree.append(EVENT_RETURN, frame)
+
+    def outer():
+        frame = sys._getframe()
+        tree.append(EVENT_CALL, frame)
+        for _ in range(3):
+            inner()
+        tree.append(EVENT_RETURN, frame)
+
+    outer()
+    tree.finish()
+    return tree.to_representation()
+
+
+class CallTreeTests(SimpleTestCase):
+    def test_merges_calls_by_path(self):
+        nodes = record_calls(CallTree())
+        self.assertEqual([node['calls'] for node in nodes], [1, 3])
+        self.assertEqual(nodes[1]['parent'], 0)
+        self.assertIn('::outer:', nodes[0]['key'])
+        self.assertGreaterEqual(nodes[0]['total_time'], nodes[1]['total_time'])
+
+
+    def test_thread_cpu_time(self):
+        if CPU_CLOCK is None:
+            self.skipTest('needs Python 3.7+')
+        tree = CallTree()
+        nodes = record_calls(tree)
+        self.assertIn('self_cpu_time', nodes[0])
+        self.assertEqual(tree.get_stats()['cpu_clock'], 'thread')
+        functions = summarize_call_tree(nodes)
+        self.assertTrue(all(stats['wait_time'] is not None for stats in functions))
+
+
+    def test_no_cpu_time_without_thread_clock(self):
+        tree = CallTree()
+        tree.cpu_clock = None
+        nodes = record_calls(tree)
+        self.assertNotIn('cpu_time', nodes[0])
+        self.assertNotIn('self_cpu_time', nodes[0])
+        self.assertIsNone(tree.get_stats()['cpu_clock'])
+        functions = summarize_call_tree(nodes)
+        self.assertEqual([stats['self_cpu_time'] for stats in functions], [None, None])
+        self.assertEqual([stats['wait_time'] for stats in functions], [None, None])
+        lines = format_call_tree_summary(functions).split('\n')
+        self.assertEqual(lines[1].split()[2:4], ['-', '-'])
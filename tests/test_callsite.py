@@ -0,0 +1,89 @@
+import os
+import sys
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from snoopy.callsite import StackTable
+
+
+def capture(table):
+    return table.capture(sys._getframe())
+
+
+def capture_elsewhere(table):
+    return table.capture(sys._getframe())
+
+
+class StackTableTests(SimpleTestCase):
+    def test_identical_stacks_share_an_id(self):
+        table = StackTable()
+        stacks = [capture(table) for _ in range(2)]
+        self.assertIsNotNone(stacks[0].stack_id)
+        self.assertEqual(stacks[0].stack_id, stacks[1].stack_id)
+        self.assertNotEqual(capture_elsewhere(table).stack_id, stacks[0].stack_id)
+        self.assertEqual(len(table.stacks), 2)
+
+
+    def test_render(self):
+        table = StackTable()
+        call_stack = capture(table)
+        frames = call_stack.to_representation()
+        self.assertEqual(frames[-1]['function_name'], 'capture')
+        self.assertEqual(frames[-1]['line'], 'return table.capture(sys._getframe())')
+        self.assertEqual(frames[-2]['function_name'], 'test_render')
+        self.assertEqual(frames[-1]['file_name'], capture.__code__.co_filename)
+        # Rendered once
+        self.assertIs(call_stack.to_representation(), frames)
+
+
+    def test_render_from_several_threads(self):
+        table = StackTable()
+        call_stack = capture(table)
+        rendered = []
+        render_stack = table.render_stack
+
+        def slow_render_stack(stack):
+            rendered.append(stack)
+            time.sleep(0.01)
+            return render_stack(stack)
+
+        table.render_stack = slow_render_stack
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(call_stack.to_representation()))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(rendered), 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result is results[0] for result in results))
+
+
+    def test_full_table(self):
+        table = StackTable(max_size=1)
+        # Captured from the same line, so the first and last stacks are equal
+        first, second, again = [function(table) for function in (capture, capture_elsewhere, capture)]
+        self.assertEqual(first.stack_id, 0)
+        # Kept as is instead of being interned
+        self.assertIsNone(second.stack_id)
+        self.assertEqual(len(table.stacks), 1)
+        self.assertEqual(second.to_representation()[-1]['function_name'], 'capture_elsewhere')
+        self.assertEqual(second.get_frames()[-1][0], capture_elsewhere.__code__)
+        self.assertIn('capture_elsewhere', second.get_call_site(os.path.dirname(__file__)))
+        self.assertEqual(table.rendered, {})
+        # Stacks interned before the table was full still are
+        self.assertEqual(again.stack_id, 0)
+
+
+    def test_call_site(self):
+        table = StackTable()
+        call_stack = capture(table)
+        tests_root = os.path.dirname(os.path.abspath(__file__))
+        self.assertEqual(call_stack.get_call_site(tests_root), '%s:%d capture' % (
+            capture.__code__.co_filename, capture.__code__.co_firstlineno + 1))
+        self.assertIs(call_stack.get_call_site(tests_root), call_stack.get_call_site(tests_root))
+        # Without app frames, the innermost frame outside of Django
+        self.assertIn(' capture', call_stack.get_call_site('/nowhere'))
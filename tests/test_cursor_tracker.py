@@ -0,0 +1,111 @@
+from django.db import connection, transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper
+from django.test import TransactionTestCase
+
+from snoopy import cursor_tracker
+from snoopy.core import Snoopy
+from snoopy.db_activity import DatabaseActivity
+from snoopy.request import _snoopy_request
+
+
+class CursorTrackerTests(TransactionTestCase):
+    def setUp(self):
+        Snoopy._injectCursorTrackers()
+        _snoopy_request.reset()
+        _snoopy_request.active = True
+        _snoopy_request.database_activity = self.activity = DatabaseActivity(max_statements=3)
+
+
+    def tearDown(self):
+        _snoopy_request.reset()
+        _snoopy_request.active = False
+
+
+    def test_fetched_rows_and_timings(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1 UNION SELECT 2 UNION SELECT 3')
+            self.assertEqual(len(cursor.fetchall()), 3)
+            cursor.execute('SELECT 1 UNION SELECT 2 UNION SELECT 3')
+            cursor.fetchone()
+            self.assertEqual(len(cursor.fetchmany(5)), 2)
+            cursor.execute('SELECT %s UNION SELECT %s', [1, 2])
+            self.assertEqual(len(list(cursor)), 2)
+            # Past max_statements, only in the totals
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        statements = self.activity.statements
+        self.assertEqual([statement['rows_fetched'] for statement in statements], [3, 3, 2])
+        self.assertEqual(statements[2]['query'].to_representation(), 'SELECT 1 UNION SELECT 2')
+        self.assertFalse(any(statement['in_transaction'] for statement in statements))
+        self.assertIsNotNone(statements[0]['traceback'])
+        self.assertEqual(self.activity.dropped_statements, 1)
+        stats = self.activity.aliases['default']
+        self.assertEqual((stats['statements'], stats['rows_fetched']), (4, 9))
+        self.assertGreaterEqual(stats['statement_time'], sum(statement['duration'] for statement in statements))
+        self.assertEqual(stats['transactions'], 0)
+
+
+    def test_executemany(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE numbers (value integer)')
+            cursor.executemany('INSERT INTO numbers VALUES (%s)', [(1,), (2,), (3,)])
+        statement = self.activity.statements[1]
+        self.assertEqual(statement['batch_size'], 3)
+        self.assertEqual(statement['rowcount'], 3)
+        self.assertEqual(self.activity.aliases['default']['rows_affected'], 3)
+
+
+    def test_transactions(self):
+        _snoopy_request.database_activity = self.activity = DatabaseActivity()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                raise ValueError()
+        except ValueError:
+            pass
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        # Leaves out the BEGIN some backends run
+        self.assertEqual([statement['in_transaction'] for statement in self.activity.statements
+                          if statement['query'] == 'SELECT 1'],
+                         [True, True, False])
+        stats = self.activity.aliases['default']
+        self.assertEqual((stats['transactions'], stats['commits'], stats['rollbacks']), (2, 1, 1))
+        self.assertGreaterEqual(stats['transaction_time'], stats['transaction_idle_time'])
+        self.assertEqual(self.activity.to_representation()['open_transactions'], [])
+
+
+    def test_inactive_request(self):
+        _snoopy_request.active = False
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        self.assertEqual(self.activity.aliases, {})
+
+
+    def test_inject_twice_and_remove(self):
+        original_execute = CursorWrapper.__dict__['_snoopy_execute']
+        Snoopy._injectCursorTrackers()
+        self.assertIs(CursorWrapper.__dict__['_snoopy_execute'], original_execute)
+        Snoopy._removeCursorTrackers()
+        Snoopy._removeCursorTrackers()
+        try:
+            self.assertFalse(hasattr(CursorWrapper, '_snoopy_execute'))
+            self.assertFalse(hasattr(BaseDatabaseWrapper, '_snoopy_commit'))
+            self.assertNotIn('fetchall', vars(CursorWrapper))
+            self.assertNotEqual(CursorWrapper.__dict__['__iter__'], cursor_tracker.cursor_iter)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1 UNION SELECT 2')
+                self.assertEqual(len(list(cursor)), 2)
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            self.assertEqual(self.activity.aliases, {})
+        finally:
+            Snoopy._injectCursorTrackers()
+        self.assertIs(CursorWrapper.__dict__['execute'], cursor_tracker.cursor_execute)
@@ -0,0 +1,90 @@
+import datetime
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from snoopy.detectors import FINDING_DUPLICATE, FINDING_N_PLUS_ONE, QueryPatternDetector
+from snoopy.fingerprint import DeferredQuery
+from tests.outputs import MemoryOutput
+
+
+class FakeCallStack(object):
+    def __init__(self, call_site):
+        self.call_site = call_site
+
+    def get_call_site(self, app_root):
+        return self.call_site
+
+
+def query_data(sql, params, call_site, query_time=0.01):
+    return {
+        'fingerprint': sql,
+        'normalized_query': sql,
+        'query': DeferredQuery(sql, params),
+        'total_query_time': datetime.timedelta(seconds=query_time),
+        'traceback': FakeCallStack(call_site)
+    }
+
+
+class QueryPatternDetectorTests(SimpleTestCase):
+    def test_n_plus_one(self):
+        detector = QueryPatternDetector(n_plus_one_threshold=3)
+        for index in range(4):
+            detector.add(query_data('SELECT ? FROM book', (index,), 'views.py:10', 0.01 * (index + 1)))
+        # Same shape from elsewhere, not part of the loop
+        detector.add(query_data('SELECT ? FROM book', (9,), 'views.py:20'))
+        findings = detector.get_findings()
+        self.assertEqual(len(findings), 1)
+        finding = findings[0]
+        self.assertEqual(finding['type'], FINDING_N_PLUS_ONE)
+        self.assertEqual(finding['call_site'], 'views.py:10')
+        self.assertEqual(finding['count'], 4)
+        self.assertAlmostEqual(finding['total_time'], 0.1)
+        self.assertAlmostEqual(finding['estimated_savings'], 0.06)
+
+
+    def test_same_params_in_a_loop_is_a_duplicate(self):
+        detector = QueryPatternDetector(n_plus_one_threshold=3, duplicate_threshold=3)
+        for index in range(2):
+            detector.add(query_data('SELECT ? FROM author', (1,), 'views.py:10'))
+        self.assertEqual(detector.get_findings(), [])
+        detector.add(query_data('SELECT ? FROM author', (1,), 'models.py:5'))
+        findings = detector.get_findings()
+        self.assertEqual([finding['type'] for finding in findings], [FINDING_DUPLICATE])
+        self.assertEqual(findings[0]['call_sites'], ['models.py:5', 'views.py:10'])
+        self.assertEqual(findings[0]['count'], 3)
+        self.assertAlmostEqual(findings[0]['estimated_savings'], 0.02)
+
+
+    def test_unhashable_params_and_inserts(self):
+        detector = QueryPatternDetector()
+        insert = query_data('INSERT INTO book', None, 'views.py:10')
+        insert['query'] = [DeferredQuery('INSERT INTO book', [1]), DeferredQuery('INSERT INTO book', [2])]
+        detector.add(insert)
+        detector.add(dict(insert))
+        detector.add(query_data('SELECT ? FROM book', [1], 'views.py:10'))
+        findings = detector.get_findings()
+        self.assertEqual([finding['type'] for finding in findings], [FINDING_DUPLICATE])
+        self.assertEqual(findings[0]['fingerprint'], 'INSERT INTO book')
+
+
+    def test_sorted_by_savings(self):
+        detector = QueryPatternDetector(n_plus_one_threshold=2)
+        detector.add(query_data('SELECT ? FROM author', (1,), 'views.py:10', 0.5))
+        detector.add(query_data('SELECT ? FROM author', (1,), 'views.py:10', 0.5))
+        detector.add(query_data('SELECT ? FROM book', (1,), 'views.py:20', 0.1))
+        detector.add(query_data('SELECT ? FROM book', (2,), 'views.py:20', 0.2))
+        self.assertEqual([finding['fingerprint'] for finding in detector.get_findings()],
+                         ['SELECT ? FROM author', 'SELECT ? FROM book'])
+
+
+@override_settings(SNOOPY_DETECT_QUERY_PATTERNS=True)
+class QueryPatternMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        del MemoryOutput.records[:]
+
+
+    def test_finds_the_view_loop(self):
+        self.client.get('/users/6/')
+        findings = MemoryOutput.records[0]['query_findings']
+        self.assertEqual([finding['type'] for finding in findings], [FINDING_N_PLUS_ONE])
+        self.assertEqual(findings[0]['count'], 6)
@@ -0,0 +1,194 @@
+import datetime
+import json
+import logging
+import threading
+import time
+
+try:
+    import BaseHTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    import http.server as BaseHTTPServer
+    from socketserver import ThreadingMixIn
+
+from django.test import SimpleTestCase, override_settings
+
+from snoopy.output import ElasticsearchBulkOutput
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Records the bulk requests it gets. Drops the connection without an answer
+    for the next `server.drop_requests` requests, answers with
+    `server.response_body` after `server.delay` seconds otherwise.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.headers['Content-Type'], body.decode('utf-8')))
+        if self.server.drop_requests:
+            self.server.drop_requests -= 1
+            self.close_connection = True
+            return
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.server.response_body)))
+        self.end_headers()
+        self.wfile.write(self.server.response_body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LogCapture(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class StubServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.requests = []
+        self.drop_requests = 0
+        self.delay = 0
+        self.response_body = b'{"errors": false, "items": []}'
+
+
+def make_request_data(day, path='/users/'):
+    start_time = datetime.datetime(2016, 3, day, 20, 56, 30)
+    return {
+        'request': path,
+        'method': 'GET',
+        'start_time': start_time,
+        'end_time': start_time + datetime.timedelta(seconds=1)
+    }
+
+
+def parse_bulk_body(body):
+    """
+    Returns `[(action, document)]` for an NDJSON bulk body.
+    """
+    assert body.endswith('\n')
+    lines = [json.loads(line) for line in body[:-1].split('\n')]
+    return list(zip(lines[::2], lines[1::2]))
+
+
+class ElasticsearchBulkOutputTests(SimpleTestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.settings_override = override_settings(
+            SNOOPY_ELASTICSEARCH_OUTPUT_URL='http://127.0.0.1:%d/' % self.server.server_address[1],
+            SNOOPY_ELASTICSEARCH_BULK_SIZE=2,
+            SNOOPY_ELASTICSEARCH_BULK_INTERVAL=60)
+        self.settings_override.enable()
+        self.log = LogCapture()
+        logging.getLogger('snoopy').addHandler(self.log)
+        ElasticsearchBulkOutput.sent = ElasticsearchBulkOutput.failed = 0
+
+
+    def tearDown(self):
+        ElasticsearchBulkOutput.flush()
+        for connection in ElasticsearchBulkOutput.connections:
+            connection.close()
+        ElasticsearchBulkOutput.connections = []
+        self.settings_override.disable()
+        logging.getLogger('snoopy').removeHandler(self.log)
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def test_serialize_without_document_type(self):
+        action, document = parse_bulk_body(ElasticsearchBulkOutput.serialize(make_request_data(12)))[0]
+        self.assertEqual(action, {'index': {'_index': 'snoopy-2016.03.12'}})
+        self.assertEqual(document['request'], '/users/')
+        self.assertEqual(document['start_time'], '2016-03-12T20:56:30')
+
+
+    def test_serialize_with_document_type(self):
+        action, _ = parse_bulk_body(ElasticsearchBulkOutput.serialize(make_request_data(12), 'request'))[0]
+        self.assertEqual(action, {'index': {'_index': 'snoopy-2016.03.12', '_type': 'request'}})
+
+
+    def test_flushes_on_size(self):
+        ElasticsearchBulkOutput.save_request_data(make_request_data(12, '/first/'))
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(ElasticsearchBulkOutput.get_stats(), {'buffered': 1, 'sent': 0, 'failed': 0})
+        ElasticsearchBulkOutput.save_request_data(make_request_data(13, '/second/'))
+        self.assertEqual(ElasticsearchBulkOutput.get_stats(), {'buffered': 0, 'sent': 2, 'failed': 0})
+        self.assertEqual(len(self.server.requests), 1)
+        path, content_type, body = self.server.requests[0]
+        self.assertEqual(path, '/_bulk')
+        self.assertEqual(content_type, 'application/x-ndjson')
+        documents = parse_bulk_body(body)
+        # One daily index per document
+        self.assertEqual(
+            [(action['index']['_index'], document['request']) for action, document in documents],
+            [('snoopy-2016.03.12', '/first/'), ('snoopy-2016.03.13', '/second/')])
+        self.assertEqual(ElasticsearchBulkOutput.buffer, [])
+
+
+    def test_flushes_on_time(self):
+        with override_settings(SNOOPY_ELASTICSEARCH_BULK_INTERVAL=0.05):
+            ElasticsearchBulkOutput.save_request_data(make_request_data(12))
+        self.assertEqual(self.server.requests, [])
+        ElasticsearchBulkOutput.flush_timer.join(5)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(parse_bulk_body(self.server.requests[0][2])), 1)
+        self.assertIsNone(ElasticsearchBulkOutput.flush_timer)
+
+
+    def test_retries_once_on_a_dropped_connection(self):
+        ElasticsearchBulkOutput.save_batch([make_request_data(12), make_request_data(12)])
+        self.assertEqual(len(ElasticsearchBulkOutput.connections), 1)
+        # The pooled keep-alive connection is closed by the server
+        self.server.drop_requests = 1
+        ElasticsearchBulkOutput.save_batch([make_request_data(13), make_request_data(13)])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.requests[1], self.server.requests[2])
+        self.assertEqual(len(ElasticsearchBulkOutput.connections), 1)
+        self.assertEqual(self.log.records, [])
+
+
+    def test_gives_up_after_one_retry(self):
+        ElasticsearchBulkOutput.save_batch([make_request_data(12), make_request_data(12)])
+        self.server.drop_requests = 2
+        ElasticsearchBulkOutput.save_batch([make_request_data(13), make_request_data(13)])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(ElasticsearchBulkOutput.connections, [])
+        self.assertEqual([record.levelname for record in self.log.records], ['ERROR'])
+
+
+    def test_no_retry_on_a_new_connection(self):
+        self.server.drop_requests = 1
+        ElasticsearchBulkOutput.save_batch([make_request_data(12), make_request_data(12)])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual([record.levelname for record in self.log.records], ['ERROR'])
+
+
+    def test_no_retry_on_timeout(self):
+        with override_settings(SNOOPY_ELASTICSEARCH_TIMEOUT=0.2):
+            ElasticsearchBulkOutput.save_batch([make_request_data(12), make_request_data(12)])
+            self.server.delay = 0.5
+            ElasticsearchBulkOutput.save_batch([make_request_data(13), make_request_data(13)])
+        # The request may have been indexed, sending it again could duplicate it
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual([record.levelname for record in self.log.records], ['ERROR'])
+
+
+    def test_invalid_response(self):
+        self.server.response_body = b'<html>Bad gateway</html>'
+        ElasticsearchBulkOutput.save_batch([make_request_data(12), make_request_data(12)])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(ElasticsearchBulkOutput.get_stats()['failed'], 2)
+        self.assertEqual([record.levelname for record in self.log.records], ['ERROR'])
\ No newline at end of file
@@ -0,0 +1,68 @@
+from django.test import SimpleTestCase
+
+from snoopy.fingerprint import DeferredQuery, QueryAggregator, fingerprint, normalize_sql
+
+
+class NormalizeSqlTests(SimpleTestCase):
+    def test_literals_and_placeholders(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM foo WHERE id IN (%s, %s, %s) AND name = 'x'"),
+            'SELECT * FROM foo WHERE id IN (...) AND name = ?')
+        self.assertEqual(
+            normalize_sql("SELECT 1 FROM t WHERE s = 'it''s'  AND\n x = %(x)s"),
+            'SELECT ? FROM t WHERE s = ? AND x = ?')
+
+
+    def test_numbers_in_identifiers_are_kept(self):
+        self.assertEqual(
+            normalize_sql('SELECT "app_2"."id" FROM "app_2" WHERE "app_2"."n" = -12.5 LIMIT 21'),
+            'SELECT "app_2"."id" FROM "app_2" WHERE "app_2"."n" = ? LIMIT ?')
+        self.assertEqual(normalize_sql('SELECT "t1".a FROM t1'), 'SELECT "t1".a FROM t1')
+
+
+    def test_bulk_insert(self):
+        self.assertEqual(
+            normalize_sql('INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s), (%s, %s)'),
+            'INSERT INTO t (a, b) VALUES (...)')
+
+
+    def test_same_shape_same_fingerprint(self):
+        first, first_sql = fingerprint('SELECT * FROM foo WHERE id IN (%s, %s)')
+        second, second_sql = fingerprint('SELECT * FROM foo WHERE id IN (%s, %s, %s, %s)')
+        other, other_sql = fingerprint('SELECT * FROM bar WHERE id IN (%s, %s)')
+        self.assertEqual(first, second)
+        self.assertEqual(first_sql, second_sql)
+        self.assertNotEqual(first, other)
+        self.assertEqual(len(first), 16)
+
+
+    def test_deferred_query(self):
+        self.assertEqual(DeferredQuery('SELECT %s, %s', (1, 'a')).to_representation(), "SELECT 1, a")
+        self.assertEqual(DeferredQuery('SELECT %s, %s', [1, 'a']).to_representation(), "SELECT 1, a")
+        self.assertEqual(DeferredQuery('SELECT %s', ()).to_representation(), "SELECT %s % ()")
+
+
+class QueryAggregatorTests(SimpleTestCase):
+    def test_aggregates_per_fingerprint(self):
+        aggregator = QueryAggregator(max_fingerprints=2, max_call_sites=1)
+        aggregator.add('a', 'SELECT ?', 0.1, model='app.Foo', call_site='views.py:1')
+        aggregator.add('a', 'SELECT ?', 0.3, model='app.Bar', call_site='views.py:2')
+        aggregator.add('b', 'UPDATE t', 0.5)
+        aggregator.add('c', 'DELETE t', 0.5)
+        snapshot = aggregator.snapshot()
+        self.assertEqual(snapshot['dropped_fingerprints'], 1)
+        self.assertEqual([stats['fingerprint'] for stats in snapshot['fingerprints']], ['b', 'a'])
+        stats = snapshot['fingerprints'][1]
+        self.assertEqual(stats['count'], 2)
+        self.assertAlmostEqual(stats['total_time'], 0.4)
+        self.assertEqual(stats['max_time'], 0.3)
+        self.assertEqual(stats['models'], ['app.Bar', 'app.Foo'])
+        self.assertEqual(stats['call_sites'], {'views.py:1': 1})
+
+
+    def test_snapshot_if_due(self):
+        aggregator = QueryAggregator()
+        aggregator.add('a', 'SELECT ?', 0.1)
+        self.assertIsNone(aggregator.snapshot_if_due(60))
+        self.assertEqual(len(aggregator.snapshot_if_due(0)['fingerprints']), 1)
+        self.assertEqual(aggregator.snapshot()['fingerprints'], [])
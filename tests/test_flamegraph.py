@@ -0,0 +1,209 @@
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from snoopy.flamegraph import (collapse_call_tree, collapse_request_data, collapse_samples, collapse_trace,
+                               format_collapsed, render_svg, SOURCE_CPROFILE, SOURCE_SAMPLES, WEIGHT_QUERY)
+from snoopy.helpers import default_json_serializer
+from snoopy.trace import Trace
+from tests.outputs import MemoryOutput
+
+
+def timestamp(seconds):
+    return '2024-01-01T00:00:%09.6f' % seconds
+
+
+def call(function, seconds):
+    return {'key': 'app.views::%s:1' % function, 'start_time': timestamp(seconds)}
+
+
+def ret(function, seconds):
+    return {'key': 'app.views::%s:2' % function, 'end_time': timestamp(seconds)}
+
+
+def query(start, end):
+    return {'query': 'SELECT 1', 'start_time': timestamp(start), 'end_time': timestamp(end),
+            'total_query_time': end - start}
+
+
+TRACES = [
+    call('view', 0),
+    call('a', 1),
+    call('b', 2),
+    ret('b', 3),
+    ret('a', 4),
+    call('execute_sql', 5.2),
+    ret('execute_sql', 5.8),
+    call('c', 6),
+    ret('c', 8),
+    ret('view', 10),
+]
+
+
+class CollapseTests(SimpleTestCase):
+    def assertStacksEqual(self, stacks, expected):
+        self.assertEqual(sorted(stacks), sorted(expected))
+        for stack, value in expected.items():
+            self.assertAlmostEqual(stacks[stack], value)
+
+
+    def test_trace_wall_time(self):
+        self.assertStacksEqual(collapse_trace(Trace(TRACES, [])), {
+            'app.views::view': 4.4,
+            'app.views::view;app.views::a': 2,
+            'app.views::view;app.views::a;app.views::b': 1,
+            'app.views::view;app.views::execute_sql': 0.6,
+            'app.views::view;app.views::c': 2,
+        })
+
+
+    def test_trace_query_time(self):
+        trace = Trace(TRACES, [
+            # Started by the wrapper before `execute_sql` was called
+            query(5.1, 5.9),
+            query(1.5, 1.7),
+            query(9, 9.5),
+        ])
+        self.assertStacksEqual(collapse_trace(trace, WEIGHT_QUERY), {
+            'app.views::view;app.views::execute_sql': 0.8,
+            'app.views::view;app.views::a': 0.2,
+            'app.views::view': 0.5,
+        })
+
+
+    def test_trace_threshold_keeps_query_time(self):
+        trace = Trace(TRACES, [query(5.1, 5.9)], threshold=1)
+        self.assertStacksEqual(collapse_trace(trace, WEIGHT_QUERY), {'app.views::view': 0.8})
+
+
+    def test_call_tree(self):
+        nodes = [
+            {'key': 'app.views::view:1', 'parent': None, 'self_time': 0.5, 'query_time': 0.1},
+            {'key': 'app.views::a:3', 'parent': 0, 'self_time': 0.2, 'query_time': 0.0},
+            {'key': 'app.views::b:5', 'parent': 1, 'self_time': 0.1, 'query_time': 0.3},
+        ]
+        self.assertStacksEqual(collapse_call_tree(nodes), {
+            'app.views::view': 0.5,
+            'app.views::view;app.views::a': 0.2,
+            'app.views::view;app.views::a;app.views::b': 0.1,
+        })
+        self.assertStacksEqual(collapse_call_tree(nodes, WEIGHT_QUERY), {
+            'app.views::view': 0.1,
+            'app.views::view;app.views::a;app.views::b': 0.3,
+        })
+
+
+    def test_samples(self):
+        self.assertStacksEqual(collapse_samples({'interval': 0.01, 'stacks': {'a;b': 3, 'a': 1}}),
+                               {'a;b': 0.03, 'a': 0.01})
+
+
+    def test_format_collapsed(self):
+        self.assertEqual(format_collapsed({'a;b': 0.25, 'a': 1.0, 'c': 0.0000001}), 'a 1000000\na;b 250000\n')
+
+
+    def test_request_data_sources(self):
+        table = {
+            'total_calls': 2,
+            'total_time': 0.3,
+            'dropped_functions': 0,
+            'functions': [
+                {'function': 'app.py:1(view)', 'ncalls': 1, 'primitive_calls': 1, 'tottime': 0.1, 'cumtime': 0.3,
+                 'callers': {}},
+                {'function': 'app.py:5(helper)', 'ncalls': 1, 'primitive_calls': 1, 'tottime': 0.2,
+                 'cumtime': 0.2, 'callers': {'app.py:1(view)': [1, 1, 0.2, 0.2]}},
+            ]
+        }
+        stacks = collapse_request_data({'profiler_stats': table}, SOURCE_CPROFILE)
+        self.assertStacksEqual(stacks, {'app.py:1(view)': 0.1, 'app.py:1(view);app.py:5(helper)': 0.2})
+        self.assertEqual(collapse_request_data({'profiler_stats': table, 'profiler_collapsed_stacks': {'a': 1}},
+                                               SOURCE_CPROFILE), {'a': 1})
+        self.assertEqual(collapse_request_data({'profiler_samples': {'interval': 0.5, 'stacks': {'a': 2}}},
+                                               SOURCE_SAMPLES), {'a': 1.0})
+        with self.assertRaises(ValueError):
+            collapse_request_data({'profiler_stats': table}, SOURCE_CPROFILE, WEIGHT_QUERY)
+        with self.assertRaises(ValueError):
+            collapse_request_data({'profiler_traces': []})
+        with self.assertRaises(ValueError):
+            collapse_request_data({}, SOURCE_CPROFILE)
+        with self.assertRaises(ValueError):
+            collapse_request_data({}, SOURCE_SAMPLES)
+
+
+    def test_render_svg(self):
+        svg = render_svg({'app::view;app::<lambda>': 0.75, 'app::view': 0.25}, title='GET /users/')
+        self.assertTrue(svg.startswith('<?xml'))
+        self.assertIn('GET /users/', svg)
+        self.assertIn('app::&lt;lambda&gt; (0.750000 s, 75.00%)', svg)
+        self.assertIn('all (1.000000 s, 100.00%)', svg)
+
+
+@override_settings(SNOOPY_USE_BUILTIN_PROFILER=True, SNOOPY_USE_CPROFILE=True, SNOOPY_CPROFILE_COLLAPSED_STACKS=True,
+                   SNOOPY_BUILTIN_PROFILER_INCLUDE_MODULES=['tests.*', 'django.db.models.*'])
+class CaptureExportTests(TransactionTestCase):
+    def setUp(self):
+        del MemoryOutput.records[:]
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def capture(self, url):
+        self.client.get(url)
+        request_data = json.loads(json.dumps(MemoryOutput.records[-1], default=default_json_serializer))
+        path = os.path.join(self.directory, 'capture.json')
+        with open(path, 'w') as capture_file:
+            json.dump(request_data, capture_file)
+        return request_data, path
+
+
+    def test_query_time_goes_to_the_calls_running_the_queries(self):
+        request_data, path = self.capture('/nested-users/3/')
+        stacks = collapse_request_data(request_data, weight=WEIGHT_QUERY)
+        self.assertEqual(list(stacks), [
+            'tests.views::nested_users;tests.views::load_user;django.db.models.sql.compiler::execute_sql'])
+        query_time = sum(entry['total_query_time'] for entry in request_data['queries'])
+        self.assertAlmostEqual(sum(stacks.values()), query_time)
+
+        output = StringIO()
+        flamegraph_path = os.path.join(self.directory, 'flamegraph.svg')
+        call_command('snoop', trace_file_path=path, collapsed='-', flamegraph=flamegraph_path, weight=WEIGHT_QUERY,
+                     stdout=output)
+        self.assertEqual(output.getvalue(), format_collapsed(stacks))
+        with open(flamegraph_path) as flamegraph_file:
+            self.assertIn('execute_sql', flamegraph_file.read())
+
+
+    def test_wall_time_adds_up_to_the_view(self):
+        request_data, _ = self.capture('/nested-users/3/')
+        stacks = collapse_request_data(request_data)
+        view_time = Trace(request_data['profiler_traces'], []).root.total_time
+        self.assertAlmostEqual(sum(stacks.values()), view_time, places=5)
+        self.assertTrue(all(stack.startswith('tests.views::nested_users') for stack in stacks))
+
+
+    @override_settings(SNOOPY_USE_BUILTIN_PROFILER=False)
+    def test_cprofile_stacks(self):
+        # Both profilers hook `sys.setprofile`, only one of them can run
+        request_data, _ = self.capture('/nested-users/3/')
+        stacks = collapse_request_data(request_data, SOURCE_CPROFILE)
+        self.assertTrue(any(stack.endswith('(load_user)') for stack in stacks))
+        # Never more than the profiled time, less only where recursion was
+        # cut or shares were too small to keep
+        total_time = request_data['profiler_stats']['total_time']
+        self.assertLessEqual(sum(stacks.values()), total_time + 0.00001)
+        self.assertGreater(sum(stacks.values()), total_time * 0.8)
+        del request_data['profiler_collapsed_stacks']
+        rebuilt = collapse_request_data(request_data, SOURCE_CPROFILE)
+        self.assertAlmostEqual(sum(rebuilt.values()), sum(stacks.values()), places=4)
@@ -0,0 +1,76 @@
+import sys
+
+from django.test import SimpleTestCase
+
+from snoopy.frame_filter import DEFAULT_EXCLUDED_MODULES, FrameFilter, get_frame_filter
+
+
+def get_frame(module, function_name='handle'):
+    # The same body for every module, in a file named after the module
+    namespace = {'__name__': module, 'sys': sys}
+    exec(compile('def %s():\n    return sys._getframe()\n' % function_name, module + '.py', 'exec'), namespace)
+    return namespace[function_name]()
+
+
+class FrameFilterTests(SimpleTestCase):
+    def test_relevant_apps(self):
+        frame_filter = FrameFilter(['shop', 'blog'])
+        self.assertEqual(frame_filter.get_key_prefix(get_frame('shop.views')), 'shop.views::handle:')
+        self.assertIsNone(frame_filter.get_key_prefix(get_frame('django.db.models')))
+        self.assertIsNone(frame_filter.get_key_prefix(get_frame('shop.views', '_private')))
+
+
+    def test_snoopy_is_excluded_by_default_only(self):
+        apps = ['snoopy', 'snoopy_shop']
+        frame_filter = FrameFilter(apps)
+        self.assertIsNone(frame_filter.get_key_prefix(get_frame('snoopy.request')))
+        self.assertIsNone(frame_filter.get_key_prefix(get_frame('snoopy')))
+        # Only the default patterns, not a prefix match
+        self.assertEqual(frame_filter.get_key_prefix(get_frame('snoopy_shop.views')), 'snoopy_shop.views::handle:')
+        frame_filter = FrameFilter(apps, exclude_modules=())
+        self.assertEqual(frame_filter.get_key_prefix(get_frame('snoopy.request')), 'snoopy.request::handle:')
+
+
+    def test_include_and_exclude_patterns(self):
+        frame_filter = FrameFilter(['shop'], include_modules=['django.db.*', 'shop.*'],
+                                   exclude_modules=['shop.admin', 'shop.admin.*'] + list(DEFAULT_EXCLUDED_MODULES))
+        self.assertIsNotNone(frame_filter.get_key_prefix(get_frame('django.db.models.query')))
+        self.assertIsNotNone(frame_filter.get_key_prefix(get_frame('shop.views')))
+        # Include patterns replace the installed apps
+        self.assertIsNone(frame_filter.get_key_prefix(get_frame('shop')))
+        self.assertIsNone(frame_filter.get_key_prefix(get_frame('django.http')))
+        # Exclude patterns win
+        self.assertIsNone(frame_filter.get_key_prefix(get_frame('shop.admin.forms')))
+        self.assertFalse(frame_filter.is_relevant_module(None))
+
+
+    def test_same_code_in_other_modules(self):
+        frame_filter = FrameFilter(['shop'])
+        shop_frame = get_frame('shop.views')
+        django_frame = get_frame('django.views')
+        # Equal code objects, the memo must still tell them apart
+        self.assertEqual(shop_frame.f_code, django_frame.f_code)
+        self.assertEqual(frame_filter.get_key_prefix(shop_frame), 'shop.views::handle:')
+        self.assertIsNone(frame_filter.get_key_prefix(django_frame))
+
+
+    def test_memo_hits_and_misses(self):
+        frame_filter = FrameFilter(['shop'], max_size=2)
+        first_frame = get_frame('shop.views')
+        second_frame = get_frame('django.http')
+        for _ in range(3):
+            frame_filter.get_key_prefix(first_frame)
+            # Left out frames are remembered too
+            frame_filter.get_key_prefix(second_frame)
+        self.assertEqual(frame_filter.get_stats(), {'hits': 4, 'misses': 2, 'cache_size': 2, 'max_size': 2})
+        # Starts over once full
+        frame_filter.get_key_prefix(get_frame('shop.models'))
+        self.assertEqual(frame_filter.get_stats()['cache_size'], 1)
+        frame_filter.get_key_prefix(first_frame)
+        self.assertEqual(frame_filter.get_stats()['misses'], 4)
+
+
+    def test_shared_per_configuration(self):
+        frame_filter = get_frame_filter(['shop'], ['shop.*'])
+        self.assertIs(get_frame_filter(('shop',), ('shop.*',)), frame_filter)
+        self.assertIsNot(get_frame_filter(['shop'], ['shop.*'], exclude_modules=()), frame_filter)
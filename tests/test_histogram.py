@@ -0,0 +1,110 @@
+import time
+
+from django.test import SimpleTestCase
+
+from snoopy.histogram import LogHistogram, ViewMetrics
+
+
+class LogHistogramTests(SimpleTestCase):
+    def assertClose(self, value, expected):
+        # Relative error of one bucket with 16 sub buckets
+        self.assertLessEqual(abs(value - expected) / expected, 2 ** (1 / 16.0) - 1)
+
+
+    def test_percentiles(self):
+        histogram = LogHistogram()
+        for value in range(1, 1001):
+            histogram.add(value / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.min, 0.001)
+        self.assertEqual(histogram.max, 1.0)
+        self.assertClose(histogram.percentile(50), 0.5)
+        self.assertClose(histogram.percentile(95), 0.95)
+        self.assertClose(histogram.percentile(99), 0.99)
+        self.assertEqual(histogram.percentile(100), 1.0)
+
+
+    def test_percentile_of_empty_histogram(self):
+        self.assertIsNone(LogHistogram().percentile(50))
+
+
+    def test_values_below_min_value(self):
+        histogram = LogHistogram(min_value=1)
+        histogram.add(0)
+        histogram.add(0)
+        histogram.add(10)
+        self.assertEqual(histogram.buckets[0], 2)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertClose(histogram.percentile(100), 10)
+
+
+    def test_merge(self):
+        fast, slow, merged = LogHistogram(), LogHistogram(), LogHistogram()
+        for value in range(1, 501):
+            fast.add(value / 1000.0)
+            merged.add(value / 1000.0)
+        for value in range(501, 1001):
+            slow.add(value / 1000.0)
+            merged.add(value / 1000.0)
+        fast.merge(slow)
+        self.assertEqual(fast.buckets, merged.buckets)
+        self.assertEqual(fast.count, 1000)
+        self.assertEqual(fast.min, 0.001)
+        self.assertEqual(fast.max, 1.0)
+        self.assertAlmostEqual(fast.total, merged.total)
+        self.assertEqual(fast.percentile(95), merged.percentile(95))
+
+
+    def test_merge_needs_the_same_layout(self):
+        with self.assertRaises(ValueError):
+            LogHistogram().merge(LogHistogram(sub_buckets=8))
+
+
+    def test_representation_round_trip(self):
+        histogram = LogHistogram()
+        for value in (0.002, 0.01, 0.01, 0.3):
+            histogram.add(value)
+        data = histogram.to_representation()
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(sum(data['buckets'].values()), 4)
+        # JSON turns the bucket indexes into strings
+        data['buckets'] = dict((str(index), count) for index, count in data['buckets'].items())
+        copy = LogHistogram.from_representation(data)
+        self.assertEqual(copy.buckets, histogram.buckets)
+        self.assertEqual(copy.to_representation()['p95'], data['p95'])
+
+
+class ViewMetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.view_metrics = ViewMetrics()
+        self.snapshots = []
+
+
+    def tearDown(self):
+        self.view_metrics.shutdown()
+
+
+    def test_flushes_without_further_requests(self):
+        self.view_metrics.add('app.views.home', 'GET', 0.2, 0.05, 3)
+        self.view_metrics.start_flushing(0.05, self.snapshots.append)
+        deadline = time.time() + 5
+        while not self.snapshots and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.snapshots), 1)
+        views = self.snapshots[0]['views']
+        self.assertEqual([(view['view'], view['method']) for view in views], [('app.views.home', 'GET')])
+        self.assertEqual(views[0]['query_count']['count'], 1)
+        # Nothing is sent for the windows without requests
+        time.sleep(0.15)
+        self.assertEqual(len(self.snapshots), 1)
+
+
+    def test_flushes_at_shutdown(self):
+        self.view_metrics.start_flushing(60, self.snapshots.append)
+        self.view_metrics.add('app.views.home', 'GET', 0.2, 0.05, 3)
+        self.view_metrics.add('app.views.home', 'POST', 0.4, 0.1, 5)
+        self.view_metrics.shutdown()
+        self.assertFalse(self.view_metrics.flush_thread.is_alive())
+        self.assertEqual(len(self.snapshots), 1)
+        self.assertEqual(len(self.snapshots[0]['views']), 2)
+        self.assertEqual(self.view_metrics.views, {})
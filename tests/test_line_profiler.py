@@ -0,0 +1,123 @@
+import sys
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from snoopy.line_profiler import LineProfile, format_line_profile, resolve_function_codes
+from tests import views
+from tests.outputs import MemoryOutput
+
+
+def add_up(count):
+    total = 0
+    for index in range(count):
+        total += index
+    return total
+
+
+def count_up(count):
+    for index in range(count):
+        yield index
+
+
+def helper():
+    return 1
+
+
+def calls_helper():
+    return helper()
+
+
+class Views(object):
+    def get(self):
+        pass
+
+    @staticmethod
+    def post():
+        pass
+
+
+class RecordingTrace(object):
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, frame, event, arg):
+        self.events.append((frame.f_code.co_name, event))
+        return self
+
+
+class LineProfileTests(SimpleTestCase):
+    def profile(self, codes, function, *args):
+        line_profile = LineProfile(frozenset(codes))
+        previous_trace = sys.gettrace()
+        sys.settrace(line_profile.trace_call)
+        try:
+            function(*args)
+        finally:
+            sys.settrace(previous_trace)
+        return line_profile
+
+
+    def get_line_hits(self, function_data):
+        first_line = function_data['first_line_number']
+        return dict((line['line_number'] - first_line, line['hits']) for line in function_data['lines'])
+
+
+    def test_lines_of_target_function(self):
+        line_profile = self.profile([add_up.__code__], add_up, 5)
+        function_data, = line_profile.to_representation()
+        self.assertEqual(function_data['function'], 'add_up')
+        self.assertEqual(function_data['calls'], 1)
+        hits = self.get_line_hits(function_data)
+        self.assertEqual(hits[1], 1)
+        self.assertEqual(hits[3], 5)
+        self.assertEqual(hits[4], 1)
+        self.assertIn('total += index', format_line_profile([function_data]))
+
+
+    def test_other_frames_are_not_traced(self):
+        line_profile = LineProfile(frozenset([calls_helper.__code__]))
+        self.assertIsNone(line_profile.trace_call(sys._getframe(), 'call', None))
+        line_profile = self.profile([calls_helper.__code__], calls_helper)
+        self.assertEqual([function['function'] for function in line_profile.to_representation()],
+                         ['calls_helper'])
+
+
+    def test_resumed_generator_is_one_call(self):
+        line_profile = self.profile([count_up.__code__], list, count_up(3))
+        function_data, = line_profile.to_representation()
+        self.assertEqual(function_data['calls'], 1)
+        self.assertEqual(self.get_line_hits(function_data)[2], 3)
+        self.assertEqual(line_profile.frames, {})
+
+
+    def test_resolve_function_codes(self):
+        self.assertEqual(resolve_function_codes('tests.test_line_profiler.add_up'), [add_up.__code__])
+        self.assertEqual(set(resolve_function_codes('tests.test_line_profiler.Views')),
+                         set([Views.get.__code__, Views.post.__code__]))
+        with self.assertRaises(ValueError):
+            resolve_function_codes('tests.test_line_profiler.missing')
+
+
+@override_settings(SNOOPY_LINE_PROFILER_FUNCTIONS=['tests.views.users'])
+class LineProfilerMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        del MemoryOutput.records[:]
+
+
+    def test_profiles_the_view_and_keeps_the_previous_tracer(self):
+        recording_trace = RecordingTrace()
+        previous_trace = sys.gettrace()
+        sys.settrace(recording_trace)
+        try:
+            self.client.get('/users/3/')
+            self.assertIs(sys.gettrace(), recording_trace)
+        finally:
+            sys.settrace(previous_trace)
+        function_data, = MemoryOutput.records[0]['line_profile']
+        self.assertEqual(function_data['function'], 'users')
+        self.assertEqual(function_data['calls'], 1)
+        first_line = views.users.__code__.co_firstlineno
+        hits = dict((line['line_number'] - first_line, line['hits']) for line in function_data['lines'])
+        self.assertEqual(hits[2], 3)
+        # The previous tracer saw the view's lines too
+        self.assertIn(('users', 'line'), recording_trace.events)
@@ -0,0 +1,67 @@
+import gc
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+
+from snoopy import memory_profiler as memory_profiler_module
+from snoopy.memory_profiler import MemoryProfiler, memory_profiler
+from snoopy.middleware import SnoopyProfilerMiddleware
+
+
+class FallbackMemoryProfiler(MemoryProfiler):
+    # What Python 2.7 has
+    def has_gc_callbacks(self):
+        return False
+
+
+class MemoryProfilerTests(TestCase):
+    def test_rusage_fallback(self):
+        if memory_profiler_module.resource is None:
+            self.skipTest('needs the resource module')
+        profiler = FallbackMemoryProfiler()
+        collector = profiler.start(trace_allocations=False)
+        [bytearray(1024) for _ in range(1000)]
+        result = profiler.stop(collector)
+        self.assertEqual(sorted(result), ['gc_count', 'max_rss_growth'])
+        self.assertGreaterEqual(result['max_rss_growth'], 0)
+        self.assertEqual(len(result['gc_count']['start']), 3)
+        self.assertEqual(len(result['gc_count']['end']), 3)
+
+
+    def test_gc_callbacks(self):
+        if not memory_profiler.has_gc_callbacks():
+            self.skipTest('needs gc.callbacks')
+        collector = memory_profiler.start(trace_allocations=False)
+        gc.collect()
+        result = memory_profiler.stop(collector)
+        self.assertNotIn('max_rss_growth', result)
+        self.assertEqual(result['gc']['collections'][2], 1)
+
+
+    @override_settings(SNOOPY_USE_MEMORY_PROFILER=True)
+    def test_no_backend(self):
+        memory_profiler.is_available = lambda: False
+        try:
+            with self.assertRaises(ImproperlyConfigured):
+                SnoopyProfilerMiddleware(lambda request: None)
+            with self.assertRaises(ImproperlyConfigured):
+                self.client.get('/users/0/')
+        finally:
+            del memory_profiler.is_available
+
+
+    @override_settings(SNOOPY_USE_MEMORY_PROFILER=True)
+    def test_backend_is_checked_once(self):
+        checks = []
+
+        def is_available():
+            checks.append(True)
+            return True
+
+        memory_profiler.is_available = is_available
+        try:
+            self.client.get('/users/0/')
+            self.client.get('/users/0/')
+        finally:
+            del memory_profiler.is_available
+        self.assertEqual(len(checks), 1)
@@ -0,0 +1,42 @@
+from unittest import skipIf
+
+from django.test import TransactionTestCase, override_settings
+
+from tests.outputs import MemoryOutput
+
+try:
+    import asyncio
+    from django.test import AsyncClient
+    from tests.async_views import get_concurrently
+except ImportError:
+    # Python 2 / Django < 3.1
+    AsyncClient = None
+
+
+class SyncMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        del MemoryOutput.records[:]
+
+
+    def test_records_request_queries(self):
+        response = self.client.get('/users/3/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(MemoryOutput.records), 1)
+        self.assertEqual(MemoryOutput.records[0]['request'], '/users/3/')
+        self.assertEqual(MemoryOutput.records[0]['view_name'], 'tests.views.users')
+        self.assertEqual(len(MemoryOutput.records[0]['queries']), 3)
+
+
+@skipIf(AsyncClient is None, 'needs Django 3.1+ on Python 3')
+@override_settings(ROOT_URLCONF='tests.async_urls')
+class AsyncMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        del MemoryOutput.records[:]
+
+
+    def test_concurrent_requests_keep_their_queries(self):
+        responses = asyncio.run(get_concurrently(AsyncClient(), '/users/3/', '/users/5/'))
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        query_counts = dict(
+            (record['request'], len(record['queries'])) for record in MemoryOutput.records)
+        self.assertEqual(query_counts, {'/users/3/': 3, '/users/5/': 5})
@@ -0,0 +1,132 @@
+import logging
+import threading
+
+from django.test import SimpleTestCase
+
+from snoopy.output import OutputBase
+from snoopy.pipeline import POLICY_DROP_NEWEST, OutputPipeline
+
+
+class GatedOutput(OutputBase):
+    """
+    Blocks in `save_batch` until `gate` is set.
+    """
+    gate = threading.Event()
+    started = threading.Event()
+    records = []
+    closed = False
+
+    @classmethod
+    def save_batch(cls, batch):
+        cls.started.set()
+        cls.gate.wait(5)
+        cls.records.extend(batch)
+
+    @classmethod
+    def close(cls):
+        cls.closed = True
+
+
+class FailingOutput(OutputBase):
+    records = []
+
+    @classmethod
+    def save_batch(cls, batch):
+        if batch[0] == 'bad':
+            raise IOError('output is down')
+        cls.records.extend(batch)
+
+
+class BufferingOutput(OutputBase):
+    buffer = []
+
+    @classmethod
+    def save_batch(cls, batch):
+        cls.buffer.extend(batch)
+
+    @classmethod
+    def get_stats(cls):
+        return {'buffered': len(cls.buffer), 'sent': 0, 'failed': 0}
+
+
+class OutputPipelineTests(SimpleTestCase):
+    def setUp(self):
+        GatedOutput.gate.clear()
+        GatedOutput.started.clear()
+        GatedOutput.records = []
+        GatedOutput.closed = False
+        FailingOutput.records = []
+        BufferingOutput.buffer = []
+        logging.getLogger('snoopy').disabled = True
+
+
+    def tearDown(self):
+        GatedOutput.gate.set()
+        logging.getLogger('snoopy').disabled = False
+
+
+    def block_worker(self, pipeline):
+        pipeline.put('in flight')
+        GatedOutput.started.wait(5)
+
+
+    def test_drops_oldest_when_full(self):
+        pipeline = OutputPipeline(GatedOutput, max_queue_size=2, batch_size=1)
+        self.block_worker(pipeline)
+        for record in ('first', 'second', 'third'):
+            self.assertTrue(pipeline.put(record))
+        stats = pipeline.get_stats()
+        self.assertEqual((stats['queued'], stats['dropped'], stats['queue_size']), (4, 1, 2))
+        GatedOutput.gate.set()
+        self.assertTrue(pipeline.flush(5))
+        self.assertEqual(GatedOutput.records, ['in flight', 'second', 'third'])
+        self.assertEqual(pipeline.get_stats()['sent'], 3)
+
+
+    def test_drops_newest_when_full(self):
+        pipeline = OutputPipeline(GatedOutput, max_queue_size=2, batch_size=1, full_policy=POLICY_DROP_NEWEST)
+        self.block_worker(pipeline)
+        self.assertTrue(pipeline.put('first'))
+        self.assertTrue(pipeline.put('second'))
+        self.assertFalse(pipeline.put('third'))
+        GatedOutput.gate.set()
+        self.assertTrue(pipeline.flush(5))
+        self.assertEqual(GatedOutput.records, ['in flight', 'first', 'second'])
+
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutputPipeline(GatedOutput, full_policy='drop_all')
+
+
+    def test_shutdown_flushes_and_closes(self):
+        pipeline = OutputPipeline(GatedOutput, batch_size=2)
+        self.block_worker(pipeline)
+        for index in range(5):
+            pipeline.put(index)
+        self.assertFalse(pipeline.flush(0.05))
+        self.assertFalse(GatedOutput.closed)
+        GatedOutput.gate.set()
+        pipeline.shutdown()
+        self.assertEqual(GatedOutput.records, ['in flight', 0, 1, 2, 3, 4])
+        self.assertTrue(GatedOutput.closed)
+        self.assertEqual(pipeline.get_stats()['queue_size'], 0)
+
+
+    def test_failing_output(self):
+        pipeline = OutputPipeline(FailingOutput, batch_size=1)
+        pipeline.put('bad')
+        self.assertTrue(pipeline.flush(5))
+        pipeline.put('good')
+        self.assertTrue(pipeline.flush(5))
+        stats = pipeline.get_stats()
+        self.assertEqual((stats['sent'], stats['failed']), (1, 1))
+        self.assertEqual(FailingOutput.records, ['good'])
+
+
+    def test_buffered_records_are_not_sent(self):
+        pipeline = OutputPipeline(BufferingOutput, batch_size=1)
+        pipeline.put('first')
+        self.assertTrue(pipeline.flush(5))
+        stats = pipeline.get_stats()
+        self.assertEqual((stats['buffered'], stats['sent'], stats['failed']), (1, 0, 0))
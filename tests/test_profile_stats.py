@@ -0,0 +1,164 @@
+import cProfile
+import json
+import os
+import pstats
+import shutil
+import tempfile
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from snoopy.profile_stats import (build_profile_table, collapse_pstats, format_profile_table, merge_capture_profiles,
+                                  parse_function_label, ProfileStatsMerger, to_pstats, SORT_NCALLS)
+
+
+VIEW = ('app/views.py', 1, 'view')
+HELPER = ('app/utils.py', 5, 'helper')
+WALK = ('app/utils.py', 9, 'walk')
+JOIN = ('~', 0, "<method 'join' of 'str' objects>")
+
+# view calls helper twice and walk once, helper calls walk, walk recurses
+STATS = {
+    VIEW: (1, 1, 1.0, 10.0, {}),
+    HELPER: (2, 2, 2.0, 4.0, {VIEW: (2, 2, 2.0, 4.0)}),
+    WALK: (3, 5, 5.0, 6.0, {VIEW: (1, 2, 3.0, 3.5), HELPER: (2, 2, 1.5, 2.0), WALK: (2, 0, 0.5, 0.5)}),
+    JOIN: (1, 1, 1.0, 1.0, {WALK: (1, 1, 1.0, 1.0)}),
+}
+
+
+def fibonacci(n):
+    return n if n < 2 else fibonacci(n - 1) + fibonacci(n - 2)
+
+
+def profile(function, *args):
+    profiler = cProfile.Profile()
+    profiler.runcall(function, *args)
+    return pstats.Stats(profiler).stats
+
+
+class ProfileTableTests(SimpleTestCase):
+    def test_labels(self):
+        self.assertEqual(parse_function_label('app/views.py:1(view)'), VIEW)
+        self.assertEqual(parse_function_label("<method 'join' of 'str' objects>"), JOIN)
+
+
+    def test_build_and_rebuild(self):
+        table = build_profile_table(STATS)
+        self.assertEqual(table['total_calls'], 9)
+        self.assertEqual(table['total_time'], 9.0)
+        self.assertEqual(table['dropped_functions'], 0)
+        self.assertEqual([row['function'] for row in table['functions']], [
+            'app/views.py:1(view)', 'app/utils.py:9(walk)', 'app/utils.py:5(helper)', "<method 'join' of 'str' objects>"
+        ])
+        self.assertEqual(to_pstats(json.loads(json.dumps(table))), STATS)
+
+
+    def test_filter_and_cut(self):
+        table = build_profile_table(STATS, app_root='app/utils', top=1, sort=SORT_NCALLS)
+        self.assertEqual([row['function'] for row in table['functions']], ['app/utils.py:9(walk)'])
+        self.assertEqual(table['dropped_functions'], 3)
+        # Totals are over every function
+        self.assertEqual(table['total_time'], 9.0)
+
+
+    def test_real_profile(self):
+        stats = profile(fibonacci, 10)
+        table = build_profile_table(stats)
+        row = [row for row in table['functions'] if row['function'].endswith('(fibonacci)')][0]
+        self.assertEqual(row['ncalls'], 177)
+        self.assertEqual(row['primitive_calls'], 1)
+        self.assertIn(row['function'], row['callers'])
+        rebuilt = to_pstats(table)
+        self.assertEqual(sorted(rebuilt), sorted(stats))
+        for function, function_stats in stats.items():
+            self.assertEqual(rebuilt[function][:2], function_stats[:2])
+            self.assertAlmostEqual(rebuilt[function][2], function_stats[2], places=5)
+
+
+class CollapsePstatsTests(SimpleTestCase):
+    def test_split_between_callers(self):
+        stacks = collapse_pstats(STATS)
+        expected = {
+            'app/views.py:1(view)': 1.0,
+            'app/views.py:1(view);app/utils.py:5(helper)': 2.0,
+            # walk spends 3.5 of its 6 seconds under view, 2 under helper
+            'app/views.py:1(view);app/utils.py:9(walk)': 5.0 * 3.5 / 6,
+            'app/views.py:1(view);app/utils.py:5(helper);app/utils.py:9(walk)': 5.0 * 2 / 6,
+            "app/views.py:1(view);app/utils.py:9(walk);<method 'join' of 'str' objects>": 3.5 / 6,
+            "app/views.py:1(view);app/utils.py:5(helper);app/utils.py:9(walk);<method 'join' of 'str' objects>":
+                2.0 / 6,
+        }
+        self.assertEqual(sorted(stacks), sorted(expected))
+        for stack, value in expected.items():
+            self.assertAlmostEqual(stacks[stack], value)
+        # The recursive share of walk (0.5 of 6 seconds) is cut
+        self.assertAlmostEqual(sum(stacks.values()), 9.0 - (5.0 + 1.0) * 0.5 / 6)
+
+
+    def test_real_recursion_is_cut(self):
+        stacks = collapse_pstats(profile(fibonacci, 10))
+        fibonacci_stacks = [stack for stack in stacks if stack.endswith('(fibonacci)')]
+        self.assertEqual(len(fibonacci_stacks), 1)
+        self.assertEqual(fibonacci_stacks[0].count('(fibonacci)'), 1)
+
+
+class ProfileStatsMergerTests(SimpleTestCase):
+    def test_merge(self):
+        merger = ProfileStatsMerger()
+        merger.add(build_profile_table(STATS))
+        merger.add(build_profile_table({HELPER: (1, 1, 0.5, 0.5, {VIEW: (1, 1, 0.5, 0.5)})}))
+        table = merger.get_table(top=2)
+        self.assertEqual(table['requests'], 2)
+        self.assertEqual(table['total_calls'], 10)
+        self.assertEqual(table['total_time'], 9.5)
+        self.assertEqual([row['function'] for row in table['functions']],
+                         ['app/utils.py:9(walk)', 'app/utils.py:5(helper)'])
+        helper = table['functions'][1]
+        self.assertEqual(helper['ncalls'], 3)
+        self.assertEqual(helper['requests'], 2)
+        self.assertEqual(helper['tottime'], 2.5)
+        self.assertEqual(helper['callers'], {'app/views.py:1(view)': [3, 3, 2.5, 4.5]})
+        report = format_profile_table(table)
+        self.assertTrue(report.startswith('2 requests, 10 calls, 9.5000 seconds'))
+        self.assertIn('app/utils.py:5(helper)', report)
+
+
+@override_settings(SNOOPY_USE_CPROFILE=True, SNOOPY_OUTPUT_CLASS='snoopy.output.LogOutput')
+class MergeCaptureProfilesTests(TransactionTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_totals_add_up(self):
+        with self.settings(SNOOPY_LOG_OUTPUT_DIR=self.directory):
+            self.client.get('/nested-users/2/')
+            self.client.get('/nested-users/3/')
+        tables = []
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name)) as capture_file:
+                tables.append(json.load(capture_file)['profiler_stats'])
+        self.assertEqual(len(tables), 2)
+
+        table = merge_capture_profiles([self.directory]).get_table()
+        self.assertEqual(table['requests'], 2)
+        self.assertEqual(table['total_calls'], sum(captured['total_calls'] for captured in tables))
+        self.assertAlmostEqual(table['total_time'], sum(captured['total_time'] for captured in tables))
+        load_user = [row for row in table['functions'] if row['function'].endswith('(load_user)')][0]
+        self.assertEqual(load_user['ncalls'], 5)
+        self.assertEqual(load_user['requests'], 2)
+        self.assertAlmostEqual(load_user['cumtime'], sum(
+            row['cumtime'] for captured in tables for row in captured['functions']
+            if row['function'] == load_user['function']))
+
+        output = StringIO()
+        call_command('snoop', profile_report=[self.directory], top=5, stdout=output)
+        self.assertIn('2 requests, %d calls' % table['total_calls'], output.getvalue())
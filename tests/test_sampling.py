@@ -0,0 +1,53 @@
+import threading
+
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+
+from snoopy.sampling import RequestSampler
+
+
+class RequestSamplerTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+
+    def test_rate_precedence(self):
+        sampler = RequestSampler(
+            rate=0.0, url_overrides=[(r'^/users/3/', 0.5), (r'^/users/', 1.0)],
+            view_overrides={'tests.views.users': 0.25}, force_header='X-Snoopy')
+        self.assertEqual(sampler.get_rate(self.factory.get('/users/3/')), 0.25)
+        sampler.view_overrides = {}
+        self.assertEqual(sampler.get_rate(self.factory.get('/users/3/')), 0.5)
+        self.assertEqual(sampler.get_rate(self.factory.get('/users/4/')), 1.0)
+        self.assertEqual(sampler.get_rate(self.factory.get('/other/')), 0.0)
+        self.assertFalse(sampler.should_sample(self.factory.get('/other/')))
+        self.assertTrue(sampler.should_sample(self.factory.get('/other/', HTTP_X_SNOOPY='1')))
+
+
+    def test_counts_concurrent_requests(self):
+        sampler = RequestSampler(adaptive=True, adaptive_window=3600)
+
+        def record():
+            for index in range(10000):
+                sampler.record_request()
+
+        threads = [threading.Thread(target=record) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sampler._window_count, 40000)
+
+
+    def test_adaptive_factor(self):
+        sampler = RequestSampler(adaptive=True, adaptive_target=10, adaptive_window=10)
+        sampler._window_start -= 10
+        for index in range(999):
+            sampler.record_request()
+        # The window rolled over with the first request, at about 0.1 per second
+        self.assertEqual(sampler.adaptive_factor, 1.0)
+        self.assertEqual(sampler._window_count, 998)
+        sampler._window_start -= 10
+        sampler.record_request()
+        self.assertAlmostEqual(sampler.adaptive_factor, 0.1, places=2)
+        self.assertEqual(sampler._window_count, 0)
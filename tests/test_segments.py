@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+from unittest import skipIf
+
+from django.test import SimpleTestCase
+
+from snoopy.segments import COMPRESSION_GZIP, SegmentWriter, iter_segment_records, read_index
+
+
+def make_record(number):
+    return ('{"number": %d}' % number, '2016-03-12T20:56:%02d' % number, '2016-03-12T20:56:%02d' % number)
+
+
+class SegmentWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def read_segments(self):
+        records = {}
+        for entry in read_index(self.directory):
+            path = os.path.join(self.directory, entry['segment'])
+            records[entry['segment']] = [record['number'] for record in iter_segment_records(path)]
+        return records
+
+
+    def test_rotates_and_indexes(self):
+        writer = SegmentWriter(self.directory, max_bytes=10, compression=COMPRESSION_GZIP)
+        for number in range(3):
+            writer.write([make_record(number)])
+        writer.close()
+        index = read_index(self.directory)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index[0]['start_time'], '2016-03-12T20:56:00')
+        self.assertEqual(sorted(self.read_segments().values()), [[0], [1], [2]])
+
+
+    @skipIf(not hasattr(os, 'fork'), 'needs os.fork')
+    def test_child_leaves_the_parent_segment_alone(self):
+        writer = SegmentWriter(self.directory, compression=COMPRESSION_GZIP)
+        writer.write([make_record(1)])
+        pid = os.fork()
+        if pid == 0:
+            try:
+                writer.write([make_record(2)])
+                writer.close()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        writer.write([make_record(3)])
+        writer.close()
+
+        segments = self.read_segments()
+        self.assertEqual(sorted(segments.values()), [[1, 3], [2]])
+        # The two segments and the index
+        self.assertEqual(len(os.listdir(self.directory)), 3)
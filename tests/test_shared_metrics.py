@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+from unittest import skipIf
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, override_settings
+
+from snoopy import shared_metrics
+from snoopy.shared_metrics import SharedMetrics, build_snapshot
+
+
+@skipIf(shared_metrics.fcntl is None, 'needs fcntl')
+class SharedMetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def get_metrics(self, name='metrics', slot_count=16):
+        return SharedMetrics(os.path.join(self.directory, name), slot_count)
+
+
+    def test_views_and_queries(self):
+        metrics = self.get_metrics()
+        metrics.add_view('app.views.home', 'GET', 0.2, 0.05, 3)
+        metrics.add_view('app.views.home', 'GET', 0.4, 0.15, 5)
+        metrics.add_query('abc', 'SELECT ? FROM book', [0.01, 0.02])
+        snapshot = build_snapshot([metrics])
+        self.assertEqual(snapshot['dropped_keys'], 0)
+        view, = snapshot['views']
+        self.assertEqual((view['view'], view['method'], view['count']), ('app.views.home', 'GET', 2))
+        self.assertAlmostEqual(view['total_time'], 0.6)
+        self.assertEqual(view['max_time'], 0.4)
+        self.assertAlmostEqual(view['sql_time_share'], 0.2 / 0.6)
+        self.assertEqual(view['mean_query_count'], 4.0)
+        query, = snapshot['queries']
+        self.assertEqual((query['fingerprint'], query['query'], query['count']), ('abc', 'SELECT ? FROM book', 2))
+
+
+    def test_processes_share_the_file(self):
+        metrics = self.get_metrics()
+        # Another worker process opening the same file
+        other = self.get_metrics()
+        metrics.add_view('app.views.home', 'GET', 0.2, 0.0, 0)
+        other.add_view('app.views.home', 'GET', 0.4, 0.0, 0)
+        other.add_view('app.views.about', 'GET', 0.1, 0.0, 0)
+        _, _, slots = metrics.read()
+        counts = dict((slot['key'], slot['histogram'].count) for slot in slots)
+        self.assertEqual(counts, {'GET app.views.home': 2, 'GET app.views.about': 1})
+
+
+    @skipIf(not hasattr(os, 'fork'), 'needs fork')
+    def test_forked_workers(self):
+        metrics = self.get_metrics()
+        metrics.add_view('app.views.home', 'GET', 0.2, 0.0, 0)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                metrics.add_view('app.views.home', 'GET', 0.4, 0.0, 0)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        view, = build_snapshot([metrics])['views']
+        self.assertEqual(view['count'], 2)
+
+
+    def test_merges_regions(self):
+        first = self.get_metrics('first')
+        second = self.get_metrics('second')
+        for value in range(1, 501):
+            first.add_view('app.views.home', 'GET', value / 1000.0, 0.0, 1)
+        for value in range(501, 1001):
+            second.add_view('app.views.home', 'GET', value / 1000.0, 0.0, 3)
+        second.add_query('abc', 'SELECT ?', [0.5])
+        snapshot = build_snapshot([first, second])
+        view, = snapshot['views']
+        self.assertEqual(view['count'], 1000)
+        self.assertEqual(view['max_time'], 1.0)
+        self.assertEqual(view['mean_query_count'], 2.0)
+        self.assertLessEqual(abs(view['p50'] - 0.5) / 0.5, 2 ** (1 / 16.0) - 1)
+        self.assertEqual(len(snapshot['queries']), 1)
+
+
+    def test_reset(self):
+        metrics = self.get_metrics()
+        other = self.get_metrics()
+        metrics.add_view('app.views.home', 'GET', 0.2, 0.0, 0)
+        self.assertEqual(len(build_snapshot([metrics], reset=True)['views']), 1)
+        snapshot = build_snapshot([metrics])
+        self.assertEqual((snapshot['views'], snapshot['queries']), ([], []))
+        # Slot indexes cached before the reset are still right
+        metrics.add_view('app.views.home', 'GET', 0.3, 0.0, 0)
+        other.add_view('app.views.home', 'GET', 0.4, 0.0, 0)
+        view, = build_snapshot([metrics])['views']
+        self.assertEqual(view['count'], 2)
+        self.assertEqual(view['max_time'], 0.4)
+
+
+    def test_full(self):
+        metrics = self.get_metrics(slot_count=2)
+        for index in range(4):
+            metrics.add_query('fingerprint-%d' % index, 'SELECT ?', [0.1])
+        snapshot = build_snapshot([metrics], reset=True)
+        self.assertEqual(len(snapshot['queries']), 2)
+        self.assertEqual(snapshot['dropped_keys'], 2)
+        self.assertEqual(build_snapshot([metrics])['dropped_keys'], 0)
+
+
+    def test_layout_mismatch(self):
+        self.get_metrics(slot_count=16).read()
+        with self.assertRaises(ValueError):
+            self.get_metrics(slot_count=32).read()
+
+
+    def test_read_only(self):
+        path = os.path.join(self.directory, 'metrics')
+        with self.assertRaises(ValueError):
+            SharedMetrics(path, 16, read_only=True).read()
+        self.assertFalse(os.path.exists(path))
+        self.get_metrics().add_view('app.views.home', 'GET', 0.2, 0.0, 0)
+        metrics = SharedMetrics(path, 16, read_only=True)
+        self.assertEqual(build_snapshot([metrics])['views'][0]['count'], 1)
+        with self.assertRaises(ValueError):
+            metrics.read(reset=True)
+
+
+    @override_settings(SNOOPY_SHARED_METRICS_SLOTS=16)
+    def test_command(self):
+        path = os.path.join(self.directory, 'metrics')
+        with self.assertRaises(CommandError):
+            call_command('snoop_metrics', path=[path], stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('snoop_metrics', path=[path], reset=True, stdout=StringIO())
+        self.assertFalse(os.path.exists(path))
+        self.get_metrics().add_view('app.views.home', 'GET', 0.2, 0.0, 0)
+        with open(path, 'rb') as metrics_file:
+            data = metrics_file.read()
+        output = StringIO()
+        call_command('snoop_metrics', path=[path], stdout=output)
+        self.assertIn('app.views.home', output.getvalue())
+        with open(path, 'rb') as metrics_file:
+            self.assertEqual(metrics_file.read(), data)
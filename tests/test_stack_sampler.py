@@ -0,0 +1,93 @@
+import signal
+import threading
+import time
+from unittest import skipIf
+
+from django.test import SimpleTestCase
+
+from snoopy.stack_sampler import SignalSampler, ThreadSampler
+
+
+def busy_wait(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class ThreadSamplerTests(SimpleTestCase):
+    def setUp(self):
+        self.sampler = ThreadSampler(0.001)
+
+
+    def tearDown(self):
+        self.sampler.shutdown()
+
+
+    def test_samples_the_request_thread(self):
+        collector = self.sampler.start(threading.current_thread().ident)
+        busy_wait(0.05)
+        self.sampler.stop(collector)
+        self.assertGreater(collector.total_samples, 0)
+        self.assertTrue(any('busy_wait' in stack for stack in collector.stacks))
+
+
+    def test_no_samples_after_stop(self):
+        collector = self.sampler.start(threading.current_thread().ident)
+        busy_wait(0.02)
+        self.sampler.stop(collector)
+        stacks = dict(collector.stacks)
+        total_samples = collector.total_samples
+        busy_wait(0.05)
+        self.assertEqual(collector.stacks, stacks)
+        self.assertEqual(collector.total_samples, total_samples)
+
+
+    def get_sampler_threads(self):
+        return [thread for thread in threading.enumerate() if thread.name == 'snoopy-stack-sampler']
+
+
+    def test_starts_a_single_thread(self):
+        running = len(self.get_sampler_threads())
+        threads = [threading.Thread(target=self.sampler.ensure_running) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.get_sampler_threads()), running + 1)
+
+
+    def test_shutdown_stops_the_thread(self):
+        collector = self.sampler.start(threading.current_thread().ident)
+        self.sampler.shutdown()
+        self.assertFalse(self.sampler.thread.is_alive())
+        self.sampler.stop(collector)
+        # Not restarted once stopping
+        self.sampler.ensure_running()
+        self.assertFalse(self.sampler.thread.is_alive())
+
+
+def previous_handler(signum, frame):
+    pass
+
+
+@skipIf(not hasattr(signal, 'setitimer'), 'needs setitimer')
+class SignalSamplerTests(SimpleTestCase):
+    def setUp(self):
+        self.handler = signal.signal(signal.SIGPROF, previous_handler)
+        self.timer = signal.setitimer(signal.ITIMER_PROF, 100, 100)
+
+
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_PROF, *self.timer)
+        signal.signal(signal.SIGPROF, self.handler)
+
+
+    def test_samples_and_restores_the_previous_handler(self):
+        sampler = SignalSampler(0.001)
+        collector = sampler.start(threading.current_thread().ident)
+        self.assertEqual(signal.getitimer(signal.ITIMER_PROF)[1], 0.001)
+        busy_wait(0.05)
+        sampler.stop(collector)
+        self.assertGreater(collector.total_samples, 0)
+        self.assertIs(signal.getsignal(signal.SIGPROF), previous_handler)
+        self.assertEqual(signal.getitimer(signal.ITIMER_PROF)[1], 100)
@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from snoopy.streaming import stream_record
+from snoopy.trace_analyzer import StreamingTraceAnalyzer, TraceAnalyzer
+
+
+def call(key, start_time):
+    return {'key': key, 'start_time': '2024-01-01T00:00:%09.6f' % start_time}
+
+
+def ret(key, end_time):
+    return {'key': key, 'end_time': '2024-01-01T00:00:%09.6f' % end_time}
+
+
+class QuietTestMixin(object):
+    # The analyzers print their summary
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+
+class StreamRecordTests(SimpleTestCase):
+    def test_streams_arrays_in_small_chunks(self):
+        record = {
+            'request': '/users/',
+            'total_request_time': 0.123456789,
+            'profiler_traces': [{'key': 'a::b:%d' % index} for index in range(50)],
+            'queries': [],
+            'nested': {'values': [1, 2, [3]]}
+        }
+        traces = []
+        result = stream_record(StringIO(json.dumps(record)), {
+            'profiler_traces': traces.append,
+            'queries': traces.append
+        }, chunk_size=7)
+        self.assertEqual(traces, record['profiler_traces'])
+        self.assertEqual(result, {
+            'request': '/users/',
+            'total_request_time': 0.123456789,
+            'nested': {'values': [1, 2, [3]]}
+        })
+
+
+    def test_truncated_input(self):
+        with self.assertRaises(ValueError):
+            stream_record(StringIO('{"profiler_traces": [{"key": 1}, '), {'profiler_traces': lambda entry: None})
+
+
+class StreamingTraceAnalyzerTests(QuietTestMixin, SimpleTestCase):
+    def analyze(self, traces, queries=()):
+        analyzer = StreamingTraceAnalyzer(StringIO(json.dumps({
+            'profiler_traces': traces,
+            'queries': list(queries)
+        })))
+        analyzer.analyze()
+        return analyzer
+
+
+    def test_recursion_and_self_time(self):
+        analyzer = self.analyze([
+            call('app.views::view:1', 0),
+            call('app.utils::walk:5', 1),
+            call('app.utils::walk:5', 2),
+            ret('app.utils::walk:7', 4),
+            ret('app.utils::walk:7', 7),
+            ret('app.views::view:3', 10),
+        ])
+        walk = analyzer.function_stats['app.utils::walk']
+        self.assertEqual(walk['count'], 2)
+        self.assertAlmostEqual(walk['total_time'], 8)
+        self.assertAlmostEqual(walk['self_time'], 6)
+        self.assertAlmostEqual(walk['max_time'], 6)
+        view = analyzer.function_stats['app.views::view']
+        self.assertAlmostEqual(view['self_time'], 4)
+        self.assertEqual(analyzer.profiler_info['total_traces'], 3)
+
+
+    def test_returns_end_the_innermost_call(self):
+        # The return after `a` has another key, it still ends `a` rather
+        # than being skipped and leaving `a` running
+        analyzer = self.analyze([
+            ret('app.views::before:9', 0),
+            call('app.views::view:1', 1),
+            call('app.views::a:1', 2),
+            ret('app.views::other:1', 3),
+            ret('app.views::view:3', 5),
+        ])
+        self.assertEqual(analyzer.unmatched_returns, 1)
+        self.assertEqual(analyzer.call_stack, [])
+        self.assertAlmostEqual(analyzer.function_stats['app.views::a']['total_time'], 1)
+        self.assertAlmostEqual(analyzer.function_stats['app.views::view']['total_time'], 4)
+        self.assertNotIn('app.views::other', analyzer.function_stats)
+
+
+@override_settings(SNOOPY_USE_BUILTIN_PROFILER=True, SNOOPY_OUTPUT_CLASS='snoopy.output.LogOutput',
+                   SNOOPY_BUILTIN_PROFILER_INCLUDE_MODULES=['tests.*', 'django.db.models.*'])
+class StreamingMatchesTraceAnalyzerTests(QuietTestMixin, TransactionTestCase):
+    def setUp(self):
+        super(StreamingMatchesTraceAnalyzerTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        super(StreamingMatchesTraceAnalyzerTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+
+    def test_same_totals(self):
+        with self.settings(SNOOPY_LOG_OUTPUT_DIR=self.directory):
+            self.client.get('/users/3/')
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+
+        with open(path) as capture_file:
+            analyzer = TraceAnalyzer(json.load(capture_file))
+        analyzer.analyze()
+        expected = {}
+        for calls in analyzer.trace.function_calls.values():
+            for function_call in calls:
+                stats = expected.setdefault('%s::%s' % (function_call.module, function_call.function), [0, 0.0])
+                stats[0] += 1
+                stats[1] += function_call.total_time
+
+        with open(path) as capture_file:
+            streaming_analyzer = StreamingTraceAnalyzer(capture_file)
+            streaming_analyzer.analyze()
+        self.assertIn('tests.views::users', expected)
+        self.assertEqual(sorted(streaming_analyzer.function_stats), sorted(expected))
+        for function_key, (count, total_time) in expected.items():
+            stats = streaming_analyzer.function_stats[function_key]
+            self.assertEqual(stats['count'], count)
+            self.assertAlmostEqual(stats['total_time'], total_time, places=4)
+        self.assertEqual(streaming_analyzer.profiler_info['total_traces'], analyzer.profiler_info['total_traces'])
+        self.assertEqual(streaming_analyzer.query_info['total_queries'], 3)
+        self.assertEqual(streaming_analyzer.query_info['total_queries'], analyzer.query_info['total_queries'])
+        self.assertEqual(streaming_analyzer.unmatched_returns, 0)
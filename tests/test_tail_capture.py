@@ -0,0 +1,62 @@
+from django.test import TransactionTestCase, override_settings
+
+from snoopy import request as snoopy_request
+from snoopy.core import Snoopy
+from tests.outputs import MemoryOutput
+
+
+@override_settings(SNOOPY_TAIL_CAPTURE=True, SNOOPY_TAIL_CAPTURE_MIN_DURATION=10.0,
+                   SNOOPY_TAIL_CAPTURE_MIN_QUERIES=3, SNOOPY_USE_CPROFILE=True)
+class TailCaptureTests(TransactionTestCase):
+    def setUp(self):
+        del MemoryOutput.records[:]
+        # Built from the settings of the first request
+        Snoopy._sampler = None
+        self.built_tables = []
+        self.real_build_profile_table = snoopy_request.build_profile_table
+
+        def build_profile_table(*args, **kwargs):
+            self.built_tables.append(args)
+            return self.real_build_profile_table(*args, **kwargs)
+
+        snoopy_request.build_profile_table = build_profile_table
+
+
+    def tearDown(self):
+        snoopy_request.build_profile_table = self.real_build_profile_table
+        Snoopy._sampler = None
+
+
+    def test_drops_fast_requests_before_building_profiles(self):
+        self.client.get('/users/1/')
+        self.assertEqual(MemoryOutput.records, [])
+        self.assertEqual(self.built_tables, [])
+
+
+    def test_keeps_requests_with_many_queries(self):
+        self.client.get('/users/3/')
+        self.assertEqual(len(MemoryOutput.records), 1)
+        record = MemoryOutput.records[0]
+        self.assertEqual(record['tail_capture_reasons'], ['query_count'])
+        self.assertEqual(record['view_name'], 'tests.views.users')
+        self.assertIn('profiler_stats', record)
+        self.assertEqual(len(self.built_tables), 1)
+
+
+    def test_keeps_failing_requests(self):
+        self.client.get('/status/503/')
+        self.assertEqual(len(MemoryOutput.records), 1)
+        self.assertEqual(MemoryOutput.records[0]['tail_capture_reasons'], ['status_code'])
+        self.assertIn('profiler_stats', MemoryOutput.records[0])
+
+
+    @override_settings(SNOOPY_TAIL_CAPTURE_MIN_DURATION=0.0)
+    def test_keeps_slow_requests(self):
+        self.client.get('/users/1/')
+        self.assertEqual(MemoryOutput.records[0]['tail_capture_reasons'], ['duration'])
+
+
+    @override_settings(SNOOPY_SAMPLE_FORCE_HEADER='X-Snoopy')
+    def test_keeps_forced_requests(self):
+        self.client.get('/users/1/', HTTP_X_SNOOPY='1')
+        self.assertEqual(MemoryOutput.records[0]['tail_capture_reasons'], ['forced'])
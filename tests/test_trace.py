@@ -0,0 +1,118 @@
+from django.test import SimpleTestCase
+
+from snoopy.helpers import parse_isoformat
+from snoopy.trace import ROOT_KEY, Trace
+
+
+def timestamp(seconds):
+    return '2024-01-01T00:00:%09.6f' % seconds
+
+
+def call(key, seconds):
+    return {'key': key, 'start_time': timestamp(seconds)}
+
+
+def ret(key, seconds):
+    return {'key': key, 'end_time': timestamp(seconds)}
+
+
+def query(sql, seconds):
+    return {'query': sql, 'start_time': timestamp(seconds), 'total_query_time': 0.001}
+
+
+def get_query_nodes(trace):
+    nodes = {}
+    pending = [trace.root]
+    while pending:
+        node = pending.pop()
+        for node_query in node.queries:
+            nodes[node_query['query']] = node.function
+        pending.extend(node.next)
+    return nodes
+
+
+class TraceTests(SimpleTestCase):
+    def test_single_root(self):
+        trace = Trace([
+            call('app.views::view:1', 1),
+            call('app.views::helper:5', 2),
+            ret('app.views::helper:6', 3),
+            ret('app.views::view:2', 4),
+        ], [])
+        self.assertEqual(trace.roots, [trace.root])
+        representation = trace.to_representation()
+        self.assertIs(representation, trace.root)
+        self.assertEqual(representation.function, 'view')
+        self.assertEqual(representation.total_time, 3)
+        self.assertEqual([node.function for node in representation.next], ['helper'])
+
+
+    def test_several_roots_get_a_common_root(self):
+        trace = Trace([
+            call('app.middleware::process_request:1', 1),
+            ret('app.middleware::process_request:2', 2),
+            call('app.views::view:1', 3),
+            ret('app.views::view:2', 5),
+        ], [query('SELECT between', 2.5)])
+        root = trace.to_representation()
+        self.assertIs(root, trace.root)
+        self.assertEqual(root.key, ROOT_KEY)
+        self.assertEqual([node.function for node in root.next], ['process_request', 'view'])
+        self.assertEqual(root.total_time, 4)
+        self.assertEqual(get_query_nodes(trace), {'SELECT between': '<request>'})
+        self.assertIn(ROOT_KEY, root.to_representation())
+
+
+    def test_find_node(self):
+        trace = Trace([
+            call('app.views::view:1', 1),
+            call('app.views::helper:5', 2),
+            call('app.views::inner:9', 3),
+            ret('app.views::inner:10', 4),
+            ret('app.views::helper:6', 5),
+            call('app.views::other:12', 6),
+            ret('app.views::other:13', 7),
+            ret('app.views::view:2', 8),
+        ], [])
+        self.assertEqual(trace.find_node(parse_isoformat(timestamp(0.5))).function, 'view')
+        self.assertEqual(trace.find_node(parse_isoformat(timestamp(3.5))).function, 'inner')
+        # inner has returned, helper is still running
+        self.assertEqual(trace.find_node(parse_isoformat(timestamp(4.5))).function, 'helper')
+        self.assertEqual(trace.find_node(parse_isoformat(timestamp(5.5))).function, 'view')
+        self.assertEqual(trace.find_node(parse_isoformat(timestamp(6.5))).function, 'other')
+        self.assertEqual(trace.find_node(parse_isoformat(timestamp(9))).function, 'view')
+
+
+    def test_queries_go_to_the_innermost_running_call(self):
+        trace = Trace([
+            call('app.views::view:1', 1),
+            call('app.views::helper:5', 2),
+            call('app.views::inner:9', 3),
+            ret('app.views::inner:10', 4),
+            ret('app.views::helper:6', 5),
+            ret('app.views::view:2', 8),
+        ], [
+            query('SELECT inner', 3.5),
+            query('SELECT helper', 4.5),
+            query('SELECT view', 6),
+            query('SELECT before', 0.5),
+        ])
+        self.assertEqual(get_query_nodes(trace), {
+            'SELECT inner': 'inner',
+            'SELECT helper': 'helper',
+            'SELECT view': 'view',
+            'SELECT before': 'view'
+        })
+
+
+    def test_threshold_drops_short_calls(self):
+        trace = Trace([
+            call('app.views::view:1', 1),
+            call('app.views::short:5', 2),
+            ret('app.views::short:6', 2.0005),
+            call('app.views::long:9', 3),
+            ret('app.views::long:10', 4),
+            ret('app.views::view:2', 5),
+        ], [], threshold=0.001)
+        self.assertEqual([node.function for node in trace.root.next], ['long'])
+        self.assertEqual(len(trace.function_calls['app.views::short:5']), 1)
@@ -0,0 +1,146 @@
+import sys
+
+from django.test import SimpleTestCase
+
+from snoopy import trace_buffer
+from snoopy.trace_buffer import EVENT_CALL, EVENT_RETURN, TRUNCATION_RAISE_THRESHOLD, SymbolTable, TraceBuffer
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def traces_size(events):
+    return TraceBuffer().get_event_size() * events
+
+
+def get_compiled_frame():
+    # A new code object every time, as for templates compiled at runtime
+    namespace = {'__name__': 'templates.home', 'sys': sys}
+    exec(compile('def render():\n    return sys._getframe()\n', 'home.html', 'exec'), namespace)
+    return namespace['render']()
+
+
+class SymbolTableTests(SimpleTestCase):
+    def test_locations_outlive_code_objects(self):
+        symbols = SymbolTable()
+        first_frame = get_compiled_frame()
+        second_frame = get_compiled_frame()
+        self.assertIsNot(first_frame.f_code, second_frame.f_code)
+        location_id = symbols.intern(first_frame)
+        self.assertEqual(symbols.intern(second_frame), location_id)
+        self.assertEqual(symbols.get_key(location_id), 'templates.home::render:2')
+        self.assertNotEqual(symbols.intern(sys._getframe()), location_id)
+        self.assertFalse(any(isinstance(part, type(first_frame.f_code))
+                             for location in symbols.ids for part in location))
+
+
+class TraceBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.real_now_ns = trace_buffer.now_ns
+        trace_buffer.now_ns = self.clock
+        self.frame = sys._getframe()
+
+
+    def tearDown(self):
+        trace_buffer.now_ns = self.real_now_ns
+
+
+    def call(self, traces, duration, children=()):
+        """
+        Records a call lasting `duration` nanoseconds, `children` being
+        `(duration, children)` pairs of calls it makes after its own time.
+        """
+        traces.append(EVENT_CALL, self.frame)
+        self.clock.now += duration
+        for child in children:
+            self.call(traces, *child)
+        traces.append(EVENT_RETURN, self.frame)
+
+
+    def get_durations(self, traces):
+        durations = []
+        stack = []
+        for event, timestamp in zip(traces.events, traces.timestamps):
+            if event == EVENT_CALL:
+                stack.append(timestamp)
+            else:
+                durations.append(timestamp - stack.pop())
+        return durations
+
+
+    def test_min_duration_prunes_short_leaf_calls(self):
+        traces = TraceBuffer(min_duration=0.000001)
+        self.call(traces, 5000, [(100, ()), (2000, ())])
+        self.assertEqual(self.get_durations(traces), [2000, 7100])
+        self.assertEqual(traces.get_stats()['pruned_calls'], 1)
+
+
+    def test_pinned_calls_are_not_pruned(self):
+        traces = TraceBuffer(min_duration=0.000001)
+        traces.append(EVENT_CALL, self.frame)
+        # A query runs
+        traces.pin()
+        self.clock.now += 10
+        traces.append(EVENT_RETURN, self.frame)
+        self.assertEqual(self.get_durations(traces), [10])
+
+
+    def test_stop_policy_keeps_the_trace_balanced(self):
+        traces = TraceBuffer(max_events=4)
+        self.call(traces, 10, [(10, ()), (10, ()), (10, ())])
+        # Returns of recorded calls still go in past the cap
+        self.assertEqual(list(traces.events), [EVENT_CALL, EVENT_CALL, EVENT_RETURN, EVENT_CALL, EVENT_RETURN,
+                                               EVENT_RETURN])
+        self.assertEqual(traces.get_stats()['dropped_calls'], 1)
+        self.assertTrue(traces.is_truncated())
+
+
+    def test_max_memory(self):
+        traces = TraceBuffer(max_memory=traces_size(10))
+        self.assertEqual(traces.max_events, 10)
+
+
+    def test_raise_threshold_keeps_the_slowest_calls(self):
+        traces = TraceBuffer(max_events=8, truncation_policy=TRUNCATION_RAISE_THRESHOLD)
+        self.call(traces, 100000, [(duration, ()) for duration in (1000, 50000, 2000, 3000, 60000, 4000)])
+        self.assertLessEqual(len(traces), 8)
+        self.assertEqual(sorted(self.get_durations(traces))[-3:], [50000, 60000, 220000])
+        stats = traces.get_stats()
+        self.assertTrue(stats['raised_threshold'])
+        self.assertGreater(stats['min_duration'], 0)
+
+
+    def test_raise_threshold_keeps_pinned_calls(self):
+        traces = TraceBuffer(max_events=6, truncation_policy=TRUNCATION_RAISE_THRESHOLD)
+        traces.append(EVENT_CALL, self.frame)
+        # A short call that ran a query
+        self.call(traces, 10)
+        traces.pin()
+        self.call(traces, 100000, [(1000, ()), (2000, ()), (3000, ())])
+        durations = self.get_durations(traces)
+        self.assertIn(10, durations)
+        self.assertIn(106000, durations)
+        self.assertEqual(traces.pinned_length, 3)
+        self.assertLessEqual(len(traces), 6)
+
+
+    def test_raise_threshold_drops_calls_when_nothing_can_go(self):
+        traces = TraceBuffer(max_events=4, truncation_policy=TRUNCATION_RAISE_THRESHOLD)
+        # Four calls still running leave nothing to compact
+        for _ in range(4):
+            traces.append(EVENT_CALL, self.frame)
+            self.clock.now += 1000
+        self.call(traces, 10)
+        for _ in range(4):
+            traces.append(EVENT_RETURN, self.frame)
+        stats = traces.get_stats()
+        self.assertEqual(stats['dropped_calls'], 1)
+        # Still balanced, the running calls are pruned by the raised threshold
+        self.assertEqual(stats['min_duration'], 0.000004)
+        self.assertEqual(self.get_durations(traces), [4010])
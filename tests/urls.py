@@ -0,0 +1,14 @@
+try:
+    from django.urls import re_path
+except ImportError:
+    # Django < 2.0
+    from django.conf.urls import url as re_path
+
+from tests import views
+
+
+urlpatterns = [
+    re_path(r'^users/(?P<count>\d+)/$', views.users),
+    re_path(r'^nested-users/(?P<count>\d+)/$', views.nested_users),
+    re_path(r'^status/(?P<code>\d+)/$', views.status),
+]
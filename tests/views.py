@@ -0,0 +1,22 @@
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+
+
+def users(request, count):
+    for index in range(int(count)):
+        list(User.objects.filter(id=index))
+    return HttpResponse('ok')
+
+
+def status(request, code):
+    return HttpResponse('status', status=int(code))
+
+
+def load_user(index):
+    return list(User.objects.filter(id=index))
+
+
+def nested_users(request, count):
+    for index in range(int(count)):
+        load_user(index)
+    return HttpResponse('ok')